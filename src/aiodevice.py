@@ -0,0 +1,495 @@
+"""
+2D2FA Asyncio Device Client
+
+A client for sending PINs to servers from asyncio code (e.g. a relay
+submitting PINs on behalf of many devices), in place of the blocking
+`deviceutils.send_message()`. A `Client` keeps a pool of keep-alive
+connections to each server (host and port) it sends to, and pipelines
+the PINs sent concurrently over them, in the JSON or binary framing
+(see `protocol`). Each PIN sent gets a `PinResult`, rather than a
+printed result. Relying applications can also get a user's identifier
+and authorization status with `issue_identifier()` and `auth_status()`.
+A request that times out or loses its connection is retried, with
+exponential backoff, on another connection.
+
+`SyncClient` wraps a `Client` for code that isn't asynchronous:
+
+    with aiodevice.SyncClient() as client:
+        results = client.send_pins("127.0.0.1", 65432, [(user, pin)])
+"""
+
+import asyncio
+import random
+from collections import namedtuple
+
+import deviceutils
+import protocol
+
+
+# connections kept open to each server
+POOL_SIZE = 4
+
+# seconds to wait for a connection to open, and for a response
+CONNECT_TIMEOUT = 5
+REQUEST_TIMEOUT = 5
+
+# times a request is retried after a timeout or connection error, and the
+# delay before the first retry, doubled for each one after up to
+# BACKOFF_MAX seconds
+RETRIES = 2
+BACKOFF = 0.1
+BACKOFF_MAX = 2
+
+
+class PinResult(namedtuple(
+        "PinResult", ["host", "port", "user", "result", "error", "attempts"])):
+    """
+    The outcome of sending a PIN: the server it was sent to, the user,
+    the server's result (e.g. "Authorization granted.", or None if no
+    response arrived), a description of the last error if there was no
+    response, and the number of times the PIN was sent.
+    """
+    __slots__ = ()
+
+    @property
+    def granted(self):
+        return self.result == protocol.RESULTS[0]
+
+
+class Connection(deviceutils.KeepAliveMessage):
+    """
+    A keep-alive connection to a server, over an asyncio transport (kept
+    in `sock`). Requests are sent as they are submitted, each tagged with
+    its own request ID, and the response to each one resolves the future
+    returned by `submit()`. Up to `deviceutils.KEEPALIVE_MAX_REQUESTS`
+    requests are sent over a connection, after which the server closes
+    it.
+    """
+    def __init__(self, transport, addr, binary=False):
+        """
+        As for `deviceutils.KeepAliveMessage`, except that requests are
+        submitted one at a time, and:
+
+        - pending: Maps the ID of each request waiting for a response to
+          its future.
+        - sent, answered: The number of requests sent over the
+          connection, and of responses received.
+        - closing: Whether the connection takes no more requests.
+        """
+        super().__init__(None, transport, addr, [], binary)
+        self.pending = {}
+        self.sent = 0
+        self.answered = 0
+        self.closing = False
+
+    def _set_selector_events_mask(self, mode):
+        # the transport reads, and writes what it is given, by itself
+        pass
+
+    def usable(self):
+        return self.sock is not None and not self.closing
+
+    def submit(self, request):
+        """
+        Send a request created by `deviceutils.create_request()`. Return
+        a future resolved with the server's response.
+        """
+        request_id = self.sent
+        keep_alive = request_id + 1 < deviceutils.KEEPALIVE_MAX_REQUESTS
+        parts = self._pack_request(
+            request, {"request-id": request_id, "keep-alive": keep_alive}
+        )
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.sent += 1
+        self.closing = not keep_alive
+        self.sock.writelines(parts)
+        return future
+
+    async def send(self, request, timeout=REQUEST_TIMEOUT):
+        """
+        Send a request and return the server's response. If it doesn't
+        arrive within `timeout` seconds, close the connection (the
+        responses queued behind it would be held up as well) and raise
+        `asyncio.TimeoutError`.
+        """
+        future = self.submit(request)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.close(ConnectionError("Request timed out."))
+            raise
+
+    def receive(self, data):
+        """
+        Process data read from the connection.
+        """
+        self._recv_buffer.feed(data)
+        self._process_buffer()
+
+    def _process_buffer(self):
+        """
+        Process every response that has been received in full.
+        """
+        while self.sock is not None:
+            answered = self.answered
+            deviceutils.Message._process_buffer(self)
+            if self.answered == answered:
+                # wait for the rest of the next response
+                break
+
+    def _response_received(self, response, request_id, keep_alive):
+        """
+        Resolve the future of the request a response answers, and get
+        ready for the next one. Once the server won't keep the connection
+        open, close it as soon as no response is outstanding.
+        """
+        if deviceutils.DEBUG:
+            print(f"Received response {response!r} from {self.addr}")
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self._frame = None
+        self.answered += 1
+        future = self.pending.pop(request_id, None)
+        if future is not None and not future.done():
+            if isinstance(response, dict):
+                future.set_result(response)
+            else:
+                future.set_exception(ValueError("Unexpected response."))
+        if not keep_alive:
+            self.closing = True
+        if self.closing and not self.pending:
+            self.close()
+
+    def close(self, exc=None):
+        """
+        Close the connection, failing the requests still waiting for a
+        response with `exc` (a `ConnectionError` by default).
+        """
+        if self.sock is not None:
+            if deviceutils.DEBUG:
+                print(f"Closing connection to {self.addr}")
+            self.sock.close()
+            self.sock = None
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(
+                    exc or ConnectionError("Connection closed.")
+                )
+
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    The protocol of a connection to a server, passing the data it
+    receives to its `Connection`.
+    """
+    def __init__(self, addr, binary=False):
+        self.addr = addr
+        self.binary = binary
+        self.connection = None
+
+    def connection_made(self, transport):
+        self.connection = Connection(transport, self.addr, self.binary)
+
+    def data_received(self, data):
+        try:
+            self.connection.receive(data)
+        except Exception as e:
+            self.connection.close(ConnectionError(f"Invalid response: {e}"))
+
+    def connection_lost(self, exc):
+        self.connection.sock = None
+        self.connection.close(
+            ConnectionError(f"Connection lost: {exc}") if exc else None
+        )
+
+
+class Pool:
+    """
+    The connections to one server. A request is sent over an open
+    connection with no request outstanding if there is one; otherwise a
+    new connection is opened, up to `size` of them, after which requests
+    are pipelined over the least busy connection.
+    """
+    def __init__(self, host, port, size=POOL_SIZE, binary=False,
+                 connect_timeout=CONNECT_TIMEOUT):
+        """
+        The Pool class initializer initializes the following attributes:
+
+        - host, port: The address of the server.
+        - size: The most connections kept open to it.
+        - binary: Whether PINs are sent in binary frames.
+        - connect_timeout: Seconds to wait for a connection to open.
+        - connections: The open connections.
+        - _opening: Tasks opening new connections.
+        """
+        self.host = host
+        self.port = port
+        self.size = size
+        self.binary = binary
+        self.connect_timeout = connect_timeout
+        self.connections = []
+        self._opening = set()
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        addr = (self.host, self.port)
+        if deviceutils.DEBUG:
+            print(f"Starting connection to {addr}")
+        transport, protocol_ = await asyncio.wait_for(
+            loop.create_connection(
+                lambda: ClientProtocol(addr, self.binary), self.host, self.port
+            ),
+            self.connect_timeout,
+        )
+        return protocol_.connection
+
+    def _opened(self, task):
+        self._opening.discard(task)
+        if not task.cancelled() and task.exception() is None:
+            self.connections.append(task.result())
+
+    async def acquire(self):
+        """
+        Return a connection to send a request over, opening one if
+        needed. Raise the error if the connection can't be opened.
+        """
+        while True:
+            self.connections = [c for c in self.connections if c.usable()]
+            least = min(self.connections, key=lambda c: len(c.pending),
+                        default=None)
+            if least is not None and not least.pending:
+                return least
+            if len(self.connections) + len(self._opening) < self.size:
+                task = asyncio.ensure_future(self._connect())
+                self._opening.add(task)
+                task.add_done_callback(self._opened)
+                await asyncio.wait({task})
+                connection = task.result()
+                if connection.usable():
+                    return connection
+            elif least is not None:
+                return least
+            else:
+                # every connection is still opening
+                await asyncio.wait(
+                    self._opening, return_when=asyncio.FIRST_COMPLETED
+                )
+
+    def close(self):
+        for task in self._opening:
+            task.cancel()
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+
+class Client:
+    """
+    An asyncio client sending PINs to any number of servers, keeping a
+    `Pool` of connections to each.
+    """
+    def __init__(self, pool_size=POOL_SIZE, binary=False,
+                 timeout=REQUEST_TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+                 retries=RETRIES, backoff=BACKOFF, backoff_max=BACKOFF_MAX):
+        """
+        The Client class initializer initializes the following
+        attributes:
+
+        - pool_size: The most connections kept open to each server.
+        - binary: Whether PINs are sent in binary frames (see
+          `protocol`) instead of JSON.
+        - timeout: Seconds to wait for a response.
+        - connect_timeout: Seconds to wait for a connection to open.
+        - retries: Times a request is retried after a timeout or a
+          connection error.
+        - backoff, backoff_max: The delay before the first retry, in
+          seconds, and the most it is doubled to.
+        - _pools: Maps each server's `(host, port)` to its `Pool`.
+        """
+        self.pool_size = pool_size
+        self.binary = binary
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._pools = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def _pool(self, host, port):
+        pool = self._pools.get((host, port))
+        if pool is None:
+            pool = Pool(host, port, self.pool_size, self.binary,
+                        self.connect_timeout)
+            self._pools[(host, port)] = pool
+        return pool
+
+    def _delay(self, attempt):
+        """
+        Return the delay before retry number `attempt` (from 1): the
+        backoff doubled for each earlier retry, with random jitter so
+        that requests failed together aren't retried together.
+        """
+        delay = min(self.backoff * 2 ** (attempt - 1), self.backoff_max)
+        return random.uniform(delay / 2, delay)
+
+    async def _send(self, host, port, request):
+        """
+        Send a request to the server at `host` and `port`, retrying after
+        a timeout or connection error. Return the server's response (or
+        None), a description of the last error (or None) and the number
+        of attempts.
+        """
+        pool = self._pool(host, port)
+        error = None
+        for attempt in range(1, self.retries + 2):
+            if attempt > 1:
+                await asyncio.sleep(self._delay(attempt - 1))
+            try:
+                connection = await pool.acquire()
+                response = await connection.send(request, self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                error = _describe(e)
+                continue
+            except ValueError as e:
+                # an invalid request or response, which a retry won't fix
+                return None, _describe(e), attempt
+            return response, None, attempt
+        return None, error, self.retries + 1
+
+    async def send_pin(self, host, port, user, pin):
+        """
+        Send `user`'s PIN to the server at `host` and `port`, retrying
+        after a timeout or connection error. Return a `PinResult`.
+        """
+        response, error, attempts = await self._send(
+            host, port, deviceutils.create_request(user, pin)
+        )
+        result = None if response is None else response.get("result")
+        return PinResult(host, port, user, result, error, attempts)
+
+    async def _action(self, host, port, action, user):
+        """
+        Send an action request (see `deviceutils.create_action_request()`)
+        and return the content of the response. Raise `ConnectionError`
+        if no response arrives.
+        """
+        response, error, attempts = await self._send(
+            host, port, deviceutils.create_action_request(action, user)
+        )
+        if response is None:
+            raise ConnectionError(
+                f"No response from {(host, port)} after {attempts} "
+                f"attempts: {error}"
+            )
+        return response
+
+    async def issue_identifier(self, host, port, user):
+        """
+        Get `user`'s identifier from the server, issuing a new one if
+        needed. Return the response, a dict with the "identifier" and
+        when it "expires" (seconds since epoch), or an error "result".
+        """
+        return await self._action(host, port, "issue_identifier", user)
+
+    async def auth_status(self, host, port, user):
+        """
+        Ask the server whether `user` is authorized. Return the response,
+        a dict saying whether they are "authorized" and when that
+        "expires" (seconds since epoch), or an error "result".
+        """
+        return await self._action(host, port, "auth_status", user)
+
+    async def send_pins(self, host, port, pins):
+        """
+        Send many PINs, a list of `(user, pin)` pairs, to one server
+        concurrently. Return their `PinResult`s, in the order of `pins`.
+        """
+        return await asyncio.gather(
+            *(self.send_pin(host, port, user, pin) for user, pin in pins)
+        )
+
+    async def send_many(self, requests):
+        """
+        Send many PINs, a list of `(host, port, user, pin)` tuples, to
+        any number of servers concurrently. Return their `PinResult`s, in
+        the order of `requests`.
+        """
+        return await asyncio.gather(
+            *(self.send_pin(*request) for request in requests)
+        )
+
+    def close(self):
+        """
+        Close every pooled connection.
+        """
+        for pool in self._pools.values():
+            pool.close()
+        self._pools = {}
+
+
+class SyncClient:
+    """
+    A `Client` for code that isn't asynchronous. It runs its own event
+    loop while a call is made, so its pooled connections are kept
+    between calls. It must not be used from inside a running event loop,
+    or from several threads at once.
+    """
+    def __init__(self, **options):
+        """
+        Takes the same options as `Client`.
+        """
+        self._loop = asyncio.new_event_loop()
+        self._client = Client(**options)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def send_pin(self, host, port, user, pin):
+        return self._loop.run_until_complete(
+            self._client.send_pin(host, port, user, pin)
+        )
+
+    def send_pins(self, host, port, pins):
+        return self._loop.run_until_complete(
+            self._client.send_pins(host, port, pins)
+        )
+
+    def send_many(self, requests):
+        return self._loop.run_until_complete(self._client.send_many(requests))
+
+    def issue_identifier(self, host, port, user):
+        return self._loop.run_until_complete(
+            self._client.issue_identifier(host, port, user)
+        )
+
+    def auth_status(self, host, port, user):
+        return self._loop.run_until_complete(
+            self._client.auth_status(host, port, user)
+        )
+
+    def close(self):
+        if not self._loop.is_closed():
+            self._client.close()
+            # let the transports finish closing
+            self._loop.run_until_complete(asyncio.sleep(0))
+            self._loop.close()
+
+
+def _describe(e):
+    """
+    Return a description of the error `e` for a `PinResult`.
+    """
+    if isinstance(e, asyncio.TimeoutError):
+        return "Timed out."
+    return f"{type(e).__name__}: {e}"
@@ -0,0 +1,449 @@
+"""
+2D2FA Asyncio Server
+
+An alternative engine for the server, run with `server.py --engine
+asyncio`: one asyncio event loop serves the devices' TCP connections
+(with the same JSON and binary framing as `serverutils.Message`) and a
+small HTTP endpoint for the identifier page and its event stream, in
+place of the selectors loop and the Flask thread. The lists, the
+verifier and the tick actions are the ones in `server`. If uvloop is
+installed, its faster event loop is used.
+"""
+
+import asyncio
+import json
+import time
+import traceback
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+import server
+import serverutils
+import events
+import pages
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+# largest HTTP request head (request line and headers) and body accepted;
+# a bulk request (see `server.BULK_REQUESTS`) may list many users
+MAX_HTTP_HEAD = 8 * 1024
+MAX_HTTP_BODY = 1024 * 1024
+
+
+class AsyncMessage(serverutils.Message):
+    """
+    A `serverutils.Message` whose connection is an asyncio transport
+    (kept in `sock`) rather than a socket watched by a selector. Data is
+    pushed in by `receive()` as the transport reads it, and queued
+    responses are handed to the transport by `flush()`.
+    """
+    def __init__(self, transport, addr):
+        super().__init__(None, transport, addr)
+
+    def _set_selector_events_mask(self, mode):
+        # the transport reads, and writes what it is given, by itself
+        pass
+
+    def receive(self, data):
+        """
+        Process data read from the connection.
+        """
+        idle = self.requests_served and self.is_idle()
+        self._recv_buffer.feed(data)
+        self._received(idle)
+
+    def flush(self):
+        """
+        Hand the queued responses to the transport, all in one call.
+        """
+        buffers = self._send_buffer.drain()
+        if buffers and self.sock is not None:
+            self.sock.writelines(buffers)
+            self._response_sent()
+
+    def close(self):
+        """
+        Close the connection once the transport has sent what it holds.
+        """
+        if self.sock is not None:
+            if server.DEBUG:
+                print(f"Closing connection to {self.addr}")
+            self.sock.close()
+            self.sock = None
+
+
+class DeviceProtocol(asyncio.Protocol):
+    """
+    The protocol of a connection from a device, passing the data it
+    receives to an `AsyncMessage` and the requests it completes to the
+    engine.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.message = None
+
+    def connection_made(self, transport):
+        if self.engine.connections >= server.MAX_CONNECTIONS:
+            # an asyncio server can't stop accepting for a while, so
+            # turn the connection away instead
+            transport.abort()
+            return
+        self.engine.connections += 1
+        self.message = AsyncMessage(
+            transport, transport.get_extra_info("peername")
+        )
+        self.engine.watch_deadline(self.message)
+
+    def data_received(self, data):
+        message = self.message
+        try:
+            message.receive(data)
+        except Exception:
+            print(
+                f"Main: Error: Exception for {message.addr}:\n"
+                f"{traceback.format_exc()}"
+            )
+            message.close()
+            return
+        if server.is_ready(message):
+            self.engine.answer(message)
+
+    def eof_received(self):
+        # a device that shuts down its side after sending a request is
+        # still answered, as by the selectors loop
+        if self.message is None or self.message.request is None:
+            return None
+        self.message.peer_closed = True
+        return True
+
+    def connection_lost(self, exc):
+        if self.message is not None:
+            self.engine.connections -= 1
+            self.message.sock = None
+
+
+class Engine:
+    """
+    Answers the requests of every device connection on the event loop.
+    Requests completed in one pass of the loop are answered together,
+    as in `server.auth_listen()`: their PINs go to the verifier as one
+    batch, and the responses are created as the results come back. The
+    tick actions run on a timer instead of after every pass.
+    """
+    def __init__(self, loop):
+        """
+        The Engine class initializer initializes the following
+        attributes:
+
+        - loop: The event loop.
+        - connections: The number of open device connections.
+        - _ready: Messages whose requests are waiting to be answered.
+        - _scheduled: Whether answering `_ready` has been scheduled.
+        """
+        self.loop = loop
+        self.connections = 0
+        self._ready = []
+        self._scheduled = False
+
+    def start(self):
+        """
+        Start watching the verifier for finished batches, and start the
+        tick timer.
+        """
+        self.loop.add_reader(server.verifier.fileno(), self._respond)
+        self.loop.call_later(server.TICK, self._tick)
+
+    def stop(self):
+        self.loop.remove_reader(server.verifier.fileno())
+
+    def answer(self, message):
+        """
+        Answer a message's request at the end of this pass of the loop.
+        """
+        self._ready.append(message)
+        if not self._scheduled:
+            self._scheduled = True
+            self.loop.call_soon(self._respond)
+
+    def _respond(self):
+        """
+        Answer the ready requests and those whose PINs the verifier has
+        finished checking, then send the responses. Answering a request
+        on a keep-alive connection moves on to the next pipelined one,
+        which is answered in the same pass.
+        """
+        self._scheduled = False
+        ready, self._ready = self._ready, []
+        answered = []
+        while True:
+            ready = [message for message in dict.fromkeys(ready)
+                     if server.is_ready(message)]
+            if ready:
+                server.respond_ready(ready)
+            done = server.finish_verified()
+            answered += ready + done
+            ready = ready + done
+            if not any(server.is_ready(message) for message in ready):
+                break
+        for message in dict.fromkeys(answered):
+            message.flush()
+            if server.is_ready(message):
+                # the next pipelined request was read in full when the
+                # previous response was sent
+                self.answer(message)
+
+    def watch_deadline(self, message):
+        """
+        Close a new connection once it is past its deadline, as
+        `server.reap_connections()` does, checked on a timer.
+        """
+        self.loop.call_later(
+            server.REQUEST_TIMEOUT, self._check_deadline, message
+        )
+
+    def _check_deadline(self, message):
+        if message.sock is None:
+            return
+        now = time.monotonic()
+        deadline = message.deadline(
+            server.REQUEST_TIMEOUT, server.KEEPALIVE_TIMEOUT
+        )
+        if deadline is None:
+            # waiting on the verifier, not the device
+            deadline = now + server.REQUEST_TIMEOUT
+        elif deadline <= now:
+            if server.DEBUG:
+                print(f"Closing timed out connection to {message.addr}")
+            message.close()
+            return
+        self.loop.call_later(deadline - now, self._check_deadline, message)
+
+    def _tick(self):
+        try:
+            server.tick()
+        except Exception:
+            print(f"Main: Error: Exception in tick:\n{traceback.format_exc()}")
+        self.loop.call_later(server.TICK, self._tick)
+
+
+def _http_response(status, html, keep_alive, content_type="text/html"):
+    """
+    Return an HTTP/1.1 response carrying the HTML page `html` (or other
+    text of the given content type).
+    """
+    body = html.encode('utf-8')
+    head = (
+        f"HTTP/1.1 {status}\r\n"
+        f"Content-Type: {content_type}; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        "\r\n"
+    )
+    return head.encode('latin-1') + body
+
+
+def http_page(method, target, body):
+    """
+    Return the status and HTML page for an HTTP request: the same pages
+    as the Flask app's /index and /checkname.
+    """
+    url = urlsplit(target)
+    if url.path == "/index":
+        return "200 OK", pages.INDEX_PAGE
+    if url.path == "/checkname":
+        if method == "POST":
+            params = parse_qs(body.decode('utf-8'))
+        else:
+            params = parse_qs(url.query)
+        target_name = params.get("username", [""])[0]
+        return "200 OK", server.checkname_text(target_name)
+    return "404 Not Found", "<html><body>Not found</body></html>"
+
+
+def bulk_reply(method, target, body):
+    """
+    Return the status and JSON text answering a bulk request (see
+    `server.BULK_REQUESTS`), as the Flask app does.
+    """
+    url = urlsplit(target)
+    if method != "POST" and url.path not in server.BULK_READS:
+        return "405 Method Not Allowed", json.dumps(
+            {"error": f"{url.path} only accepts POST."}
+        )
+    if method == "POST":
+        try:
+            users = server.bulk_users(json.loads(body))
+        except ValueError:
+            users = None
+    else:
+        users = parse_qs(url.query).get("username", [])
+    code, text = server.bulk_reply(url.path, users)
+    return f"{code} {HTTPStatus(code).phrase}", text
+
+
+async def stream_events(writer, user):
+    """
+    Send the server-sent events of `server.auth_stream()` about `user`
+    on an HTTP connection, until the stream ends. The events are pushed
+    by `server.auth_events` on the event loop, so no polling is needed.
+    """
+    writer.write(
+        b"HTTP/1.1 200 OK\r\n"
+        b"Content-Type: text/event-stream\r\n"
+        b"Cache-Control: no-cache\r\n"
+        b"Connection: close\r\n"
+        b"\r\n"
+    )
+    loop = asyncio.get_running_loop()
+    received = asyncio.Queue()
+
+    def put(event, data):
+        loop.call_soon_threadsafe(received.put_nowait, (event, data))
+
+    server.auth_events.subscribe(user, put)
+    try:
+        status = server.auth_status_request({"user": user})
+        writer.write(events.format_event(
+            "status", status, retry=server.STREAM_RETRY
+        ))
+        await writer.drain()
+        end = loop.time() + server.STREAM_TIMEOUT
+        while loop.time() < end:
+            timeout = min(server.STREAM_HEARTBEAT, end - loop.time())
+            try:
+                name, stamp = await asyncio.wait_for(received.get(), timeout)
+            except asyncio.TimeoutError:
+                writer.write(events.format_comment("keep-alive"))
+            else:
+                writer.write(events.format_event(
+                    name, server.auth_status(user, stamp)
+                ))
+            await writer.drain()
+    finally:
+        server.auth_events.unsubscribe(user, put)
+
+
+async def handle_http(reader, writer):
+    """
+    Serve the HTTP requests of one connection to the identifier page.
+    """
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                break
+            lines = head.decode('latin-1').split("\r\n")
+            try:
+                method, target, version = lines[0].split(" ", 2)
+            except ValueError:
+                writer.write(_http_response(
+                    "400 Bad Request", "<html><body>Bad request</body></html>",
+                    False,
+                ))
+                break
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                if name:
+                    headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0) or 0)
+            if length > MAX_HTTP_BODY:
+                writer.write(_http_response(
+                    "413 Payload Too Large",
+                    "<html><body>Request too large</body></html>", False,
+                ))
+                break
+            body = await reader.readexactly(length) if length else b""
+            connection = headers.get("connection", "").lower()
+            if version == "HTTP/1.1":
+                keep_alive = connection != "close"
+            else:
+                keep_alive = connection == "keep-alive"
+            url = urlsplit(target)
+            if url.path == "/events":
+                user = parse_qs(url.query).get("username", [""])[0]
+                if user in server.keys:
+                    await stream_events(writer, user)
+                    break
+            if url.path in server.BULK_REQUESTS:
+                status, text = bulk_reply(method, target, body)
+                writer.write(_http_response(
+                    status, text, keep_alive, "application/json"
+                ))
+            else:
+                status, html = http_page(method, target, body)
+                writer.write(_http_response(status, html, keep_alive))
+            if not keep_alive:
+                break
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+def new_event_loop():
+    """
+    Return a new event loop, from uvloop if it is installed.
+    """
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+async def start(host, port, http_host=None, http_port=None):
+    """
+    Start serving devices on `host` and `port` and the identifier page
+    on `http_host` and `http_port` (by default `server.HTTP_HOST` and
+    `server.HTTP_PORT`), using `server.verifier`. Return the engine and
+    the two servers.
+    """
+    if http_host is None:
+        http_host = server.HTTP_HOST
+    if http_port is None:
+        http_port = server.HTTP_PORT
+    loop = asyncio.get_running_loop()
+    engine = Engine(loop)
+    engine.start()
+    devices = await loop.create_server(
+        lambda: DeviceProtocol(engine), host, port, reuse_address=True,
+        backlog=server.LISTEN_BACKLOG,
+    )
+    http = await asyncio.start_server(
+        handle_http, http_host, http_port, limit=MAX_HTTP_HEAD
+    )
+    return engine, devices, http
+
+
+async def serve(host, port):
+    engine, devices, http = await start(host, port)
+    print(f"Listening on {(host, port)}")
+    print(f"Serving the identifier page on "
+          f"http://{server.HTTP_HOST}:{server.HTTP_PORT}/index")
+    try:
+        await asyncio.gather(devices.serve_forever(), http.serve_forever())
+    finally:
+        engine.stop()
+
+
+def run(host, port):
+    """
+    Run the server on an event loop until interrupted.
+    """
+    server.verifier = serverutils.Verifier(
+        server.VERIFIER, server.keys, server.VERIFY_WORKERS
+    )
+    loop = new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(serve(host, port))
+    except KeyboardInterrupt:
+        print("Caught keyboard interrupt, exiting")
+    finally:
+        loop.close()
+        server.verifier.close()
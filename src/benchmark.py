@@ -0,0 +1,679 @@
+"""This file contains simple benchmarks for the performance-sensitive
+parts of the server. Run it from the /src folder:
+
+    python3 benchmark.py [name ...]
+
+With no arguments every benchmark is run; otherwise only the named
+ones are.
+"""
+import os
+import sys
+import time
+import socket
+import selectors
+import tempfile
+import json
+import threading
+import tracemalloc
+import hashlib, hmac
+
+import struct
+import serverutils
+import deviceutils
+import protocol
+import expiry
+import statebackend
+import keystore
+
+
+# number of users to benchmark against
+USERS = 10_000
+
+
+def timed(fn, *args):
+    """
+    Call `fn(*args)` and return the elapsed wall-clock time in seconds.
+    """
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def report(name, seconds, count):
+    print(f"  {name:<36} {seconds * 1000:9.2f} ms  "
+          f"{seconds / count * 1e6:8.2f} us/op")
+
+
+def percentile(samples, p):
+    """
+    Return the `p`th percentile of a sorted list of samples.
+    """
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def make_users(n):
+    """
+    Build `n` users with keys, identifiers and a valid PIN for the
+    current time slice. Return `(keys, ident, requests)`, where
+    `requests` is a list of `(user, pin)` pairs.
+    """
+    keys = {}
+    ident = {}
+    requests = []
+    now = int(time.time())
+    time_slice = now // serverutils.TIME_SLICE
+    for i in range(n):
+        user = f"user{i}"
+        key = f"key{i}"
+        nid = serverutils.generate_identifier()
+        keys[user] = key
+        ident[user] = [nid, now]
+        pin = hmac.new(
+            key.encode('utf-8'),
+            str(time_slice ^ nid).encode('utf-8'),
+            hashlib.sha256
+        ).hexdigest()
+        requests.append((user, pin))
+    return keys, ident, requests
+
+
+def bench_check_pin():
+    """
+    Compare checking PINs by hashing (with the keyed HMAC cache) against
+    looking them up in a precomputed `PinTable`.
+    """
+    print(f"check_pin, {USERS} users:")
+    keys, ident, requests = make_users(USERS)
+
+    def check_all(pins):
+        for user, pin in requests:
+            assert serverutils.check_pin(user, pin, ident, keys, pins=pins)
+
+    serverutils.hmac_cache.clear()
+    report("hashing (cold HMAC cache)", timed(check_all, None), USERS)
+    report("hashing (warm HMAC cache)", timed(check_all, None), USERS)
+
+    table = serverutils.PinTable()
+
+    def fill():
+        for user in ident:
+            table.add(user, ident[user][0], keys[user])
+
+    report("precompute table (per issue)", timed(fill), USERS)
+    report("table lookup", timed(check_all, table), USERS)
+
+    # force a full roll forward to the next slice
+    next_slice = table.time_slice + 1
+    report("roll table one slice", timed(table.roll, ident, next_slice), USERS)
+
+
+def bench_expiry():
+    """
+    Compare the cost of one server tick of timing out authorizations by
+    scanning the whole "authorized" list against popping the expired
+    entries off a `TTLStore`'s heap, across list sizes. Entries are
+    spread evenly over the timeout, so about 1/timeout of them expire
+    per (one second) tick.
+    """
+    timeout = 120
+    print(f"expiry, one tick, entries spread over {timeout}s:")
+    now = int(time.time())
+    for n in (1_000, 10_000, 100_000, 1_000_000):
+        scan = {}
+        heap = expiry.TTLStore(timeout)
+        for i in range(n):
+            stamp = now - timeout + (i * timeout) // n
+            scan[f"user{i}"] = stamp
+            heap[f"user{i}"] = stamp
+
+        def scan_tick():
+            expire = now + 1 - timeout
+            for x in scan.copy():
+                if scan[x] < expire:
+                    scan.pop(x)
+
+        report(f"full scan, {n} entries", timed(scan_tick), 1)
+        report(f"heap, {n} entries", timed(heap.expire, now + 1), 1)
+        assert len(scan) == len(heap)
+
+
+def bench_backends():
+    """
+    Compare the state backends under concurrent load: several threads
+    each repeatedly get-or-issue an identifier, read it back, grant an
+    authorization and check it, as the Flask and auth_listen threads
+    do. Report throughput and per-operation latency percentiles.
+    """
+    threads = 8
+    rounds = 500
+    print(f"state backends, {threads} threads x {rounds} logins:")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in sorted(statebackend.BACKENDS):
+            backend = statebackend.make_backend(
+                name, {f"user{i}": f"key{i}" for i in range(USERS)}, 120, 120,
+                path=os.path.join(tmp, "state.db"),
+            )
+            samples = []
+
+            def login(t):
+                local = []
+                for i in range(rounds):
+                    user = f"user{(t * rounds + i) % USERS}"
+                    start = time.perf_counter()
+                    backend.ident.get_or_set(
+                        user, lambda entry: True,
+                        lambda: serverutils.Identifier(1, int(time.time())),
+                    )
+                    backend.ident.get(user)
+                    backend.keys.get(user)
+                    backend.auth[user] = int(time.time())
+                    user in backend.auth
+                    local.append(time.perf_counter() - start)
+                samples.extend(local)
+
+            workers = [
+                threading.Thread(target=login, args=(t,))
+                for t in range(threads)
+            ]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            samples.sort()
+            print(f"  {name:<8} {len(samples) / elapsed:9.0f} logins/s  "
+                  f"p50 {percentile(samples, 50) * 1e6:8.1f} us  "
+                  f"p99 {percentile(samples, 99) * 1e6:8.1f} us")
+
+
+def bench_keystore():
+    """
+    Compare loading the JSON key file into a dictionary against opening
+    a memory-mapped key store: startup time, memory allocated on the
+    heap, and lookup time.
+    """
+    n = 20 * USERS
+    print(f"keys, {n} users:")
+    keys = {f"user{i}": f"key-{i:032d}" for i in range(n)}
+    users = [f"user{i}" for i in range(0, n, n // USERS)]
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, "keys.txt")
+        path = os.path.join(tmp, "keys.keys")
+        with open(json_path, "w") as f:
+            json.dump(keys, f)
+        keystore.convert(json_path, path)
+        del keys
+
+        def load_json():
+            with open(json_path) as f:
+                return json.load(f)
+
+        for name, load in (
+            ("json dict", load_json),
+            ("mmap key store", lambda: keystore.KeyStore(path)),
+        ):
+            tracemalloc.start()
+            start = time.perf_counter()
+            loaded = load()
+            elapsed = time.perf_counter() - start
+            heap = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            report(f"{name}: load ({heap / 2**20:.1f} MiB heap)", elapsed, 1)
+
+            def lookup_all():
+                for user in users:
+                    assert loaded.get(user) is not None
+
+            report(f"{name}: lookup", timed(lookup_all), len(users))
+            del loaded
+
+
+def bench_framing():
+    """
+    Compare the JSON messages against binary frames (see `protocol`)
+    for one authentication: the bytes sent each way, and the cost of
+    encoding and parsing the request (device, then server) and the
+    response (server, then device).
+    """
+    n = USERS
+    print(f"framing, {n} authentications:")
+    keys, ident, pins = make_users(n)
+    requests = [deviceutils.create_request(user, pin) for user, pin in pins]
+    result = "Authorization granted."
+    # responses are only parsed while the connection is open
+    sock, peer = socket.socketpair()
+    for name, binary in (("json", False), ("binary", True)):
+        device = deviceutils.Message(None, None, None, None, binary)
+        server = serverutils.Message(None, None, None)
+        server.binary = binary
+        server.keep_alive = True
+
+        def encode_requests():
+            return [
+                device._pack_request(request, {"request-id": i})
+                for i, request in enumerate(requests)
+            ]
+
+        def parse_requests(data):
+            for message in data:
+                parsed = serverutils.Message(None, None, None)
+                for part in message:
+                    parsed._recv_buffer.feed(part)
+                parsed._process_buffer()
+                assert parsed.pin_request() is not None
+
+        def encode_responses():
+            replies = []
+            for i in range(n):
+                server.request_id = i
+                if binary:
+                    replies.append((server._create_frame(result),))
+                else:
+                    replies.append(server._create_message(
+                        content_bytes=server._json_encode(
+                            {"result": result}, "utf-8"
+                        ),
+                        content_type="text/json", content_encoding="utf-8",
+                        headers={"request-id": i, "keep-alive": True},
+                    ))
+            return replies
+
+        def parse_responses(data):
+            for message in data:
+                # two requests, so that it doesn't close after one response
+                parsed = deviceutils.KeepAliveMessage(
+                    None, sock, None, [None, None], binary
+                )
+                for part in message:
+                    parsed._recv_buffer.feed(part)
+                parsed._process_buffer()
+                assert len(parsed.responses) == 1
+
+        data = encode_requests()
+        replies = encode_responses()
+        print(f"  {name}: {sum(map(len, data[0]))} bytes request, "
+              f"{sum(map(len, replies[0]))} bytes response")
+        report(f"{name}: encode request", timed(encode_requests), n)
+        report(f"{name}: parse request", timed(parse_requests, data), n)
+        report(f"{name}: encode response", timed(encode_responses), n)
+        report(f"{name}: parse response", timed(parse_responses, replies), n)
+    sock.close()
+    peer.close()
+
+
+def bench_recv():
+    """
+    Compare receiving a burst of pipelined JSON requests (as on a
+    keep-alive connection), arriving in reads of up to
+    RECV_BUFFER_LIMIT bytes, into a bytes buffer that is appended to and
+    sliced (copying the rest of the buffer for every header and message)
+    against a `RecvBuffer`.
+    """
+    chunk = protocol.RECV_BUFFER_LIMIT
+    print(f"receive buffers, pipelined requests in {chunk // 1024} KiB reads:")
+    keys, ident, pins = make_users(1)
+    device = deviceutils.Message(None, None, None, None)
+    message = b"".join(device._pack_request(
+        deviceutils.create_request(*pins[0]), {"keep-alive": True}
+    ))
+    header_len = struct.unpack(">H", message[:2])[0]
+    content_len = len(message) - 2 - header_len
+    for n in (1_000, 10_000, 50_000):
+        stream = message * n
+        chunks = [stream[i:i + chunk] for i in range(0, len(stream), chunk)]
+
+        def bytes_buffer():
+            buffer = b""
+            count = 0
+            for data in chunks:
+                buffer += data
+                while len(buffer) >= 2 + header_len + content_len:
+                    hdrlen = struct.unpack(">H", buffer[:2])[0]
+                    buffer = buffer[2:]
+                    header = buffer[:hdrlen]
+                    buffer = buffer[hdrlen:]
+                    content = buffer[:content_len]
+                    buffer = buffer[content_len:]
+                    count += 1
+            assert count == n
+
+        def recv_buffer():
+            buffer = protocol.RecvBuffer(limit=2 * chunk)
+            count = 0
+            for data in chunks:
+                buffer.feed(data)
+                while len(buffer) >= 2 + header_len + content_len:
+                    hdrlen = buffer.unpack(protocol.PROTOHEADER)[0]
+                    header = buffer.take(hdrlen)
+                    content = buffer.take(content_len)
+                    count += 1
+            assert count == n
+
+        report(f"bytes buffer, {n} requests", timed(bytes_buffer), n)
+        report(f"RecvBuffer, {n} requests", timed(recv_buffer), n)
+
+
+def bench_send():
+    """
+    Compare sending the JSON responses to a connection's pipelined
+    requests one at a time, each joined into one bytes object (and
+    re-sliced after a partial send), against queuing their parts in a
+    `SendQueue`, which sends them together with `sendmsg()`.
+    """
+    pipelined = 100
+    rounds = 200
+    n = pipelined * rounds
+    print(f"send path, {rounds} x {pipelined} pipelined responses:")
+    server = serverutils.Message(None, None, None)
+    parts = server._create_message(
+        content_bytes=server._json_encode(
+            {"result": "Authorization granted."}, "utf-8"
+        ),
+        content_type="text/json", content_encoding="utf-8",
+        headers={"request-id": 1, "keep-alive": True},
+    )
+    sock, peer = socket.socketpair()
+
+    def drain():
+        while peer.recv(1 << 20):
+            pass
+
+    reader = threading.Thread(target=drain)
+    reader.start()
+
+    def joined():
+        for _ in range(rounds):
+            for _ in range(pipelined):
+                buffer = b"".join(parts)
+                while buffer:
+                    sent = sock.send(buffer)
+                    buffer = buffer[sent:]
+
+    def queued():
+        queue = protocol.SendQueue()
+        for _ in range(rounds):
+            for _ in range(pipelined):
+                queue.extend(parts)
+            while queue:
+                queue.send_to(sock)
+
+    report("joined, one send() each", timed(joined), n)
+    report("SendQueue, sendmsg()", timed(queued), n)
+    sock.close()
+    reader.join()
+    peer.close()
+
+
+def bench_accept():
+    """
+    Measure how long a burst of devices, each connecting and sending a
+    PIN straight away, waits for its response, with the server loop
+    accepting one connection per pass and reading it on the next (as it
+    used to), and with it accepting the backlog in batches and reading
+    new connections straight away. Reports the device-side times and
+    the server's `LoopStats`.
+    """
+    # these set up Flask apps and load the key files when imported
+    import server
+    import device
+    n = 1000
+    print(f"accept path, burst of {n} connections:")
+    device.key = server.keys["test_user"]
+    request = deviceutils.Message(None, None, None, None)._pack_request(
+        deviceutils.create_request(
+            "test_user", device.generate_pin(server.make_new_key("test_user"))
+        )
+    )
+    request = b"".join(request)
+    for accept_batch, read_on_accept in ((1, False), (64, True)):
+        server.ACCEPT_BATCH = accept_batch
+        server.READ_ON_ACCEPT = read_on_accept
+        server.sel = selectors.DefaultSelector()
+        server.deadlines = []
+        server.loop_stats.reset()
+        lsock = server.listen_socket("127.0.0.1", 0)
+        addr = lsock.getsockname()
+        server.start_listening(lsock)
+        stop = threading.Event()
+
+        def serve():
+            while not stop.is_set():
+                server.listen_pass(0.05)
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        csel = selectors.DefaultSelector()
+        started = {}
+        times = []
+        start = time.perf_counter()
+        for i in range(n):
+            sock = socket.socket()
+            started[sock] = time.perf_counter()
+            sock.connect(addr)
+            sock.sendall(request)
+            sock.setblocking(False)
+            csel.register(sock, selectors.EVENT_READ)
+        while len(times) < n:
+            for key, mask in csel.select(timeout=5):
+                # the server closes the connection after its response
+                if not key.fileobj.recv(4096):
+                    times.append(time.perf_counter() - started[key.fileobj])
+                    csel.unregister(key.fileobj)
+                    key.fileobj.close()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        thread.join()
+        csel.close()
+        server.sel.close()
+        server.verifier.close()
+        lsock.close()
+        times.sort()
+        stats = server.loop_stats.snapshot()
+        label = f"batch {accept_batch}, read on accept {read_on_accept}"
+        report(label, elapsed, n)
+        print(f"    device wait p50 {percentile(times, 50) * 1000:.2f} ms, "
+              f"p99 {percentile(times, 99) * 1000:.2f} ms; "
+              f"{stats['passes']} passes, "
+              f"{stats['accepted_per_pass']:.1f} accepted per pass, "
+              f"{stats['read_on_accept']} read on accept")
+
+
+def bench_http():
+    """
+    Load the server's identifier page (/checkname) from client threads,
+    each sending requests one after another for a fixed time, served by
+    Werkzeug's development server (as `app.run()`, a new thread per
+    connection) and by `webserve.PooledWSGIServer` (a pool of threads).
+    The development server is run twice: first as the baseline did, with
+    every request's messages and access log line written out by the
+    thread answering it, then with the access log off and anything else
+    logged through `webserve`'s queue. Reports the requests per second
+    and the p99 latency.
+    """
+    import http.client
+    import logging
+    from werkzeug.serving import make_server
+    import server
+    import webserve
+    clients = 16
+    duration = 3
+    print(f"identifier page, {clients} clients for {duration} s:")
+
+    def run(label, make):
+        httpd = make()
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        times = []
+        deadline = time.perf_counter() + duration
+
+        def client():
+            # reconnects for each request, Werkzeug closes the connection
+            conn = http.client.HTTPConnection("127.0.0.1", httpd.port)
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                conn.request("GET", "/checkname?username=test_user")
+                conn.getresponse().read()
+                times.append(time.perf_counter() - start)
+            conn.close()
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        httpd.shutdown()
+        thread.join()
+        httpd.server_close()
+        times.sort()
+        report(label, elapsed, len(times))
+        print(f"    {len(times) / elapsed:.0f} requests/s, "
+              f"p50 {percentile(times, 50) * 1000:.2f} ms, "
+              f"p99 {percentile(times, 99) * 1000:.2f} ms")
+
+    def development_server():
+        return make_server("127.0.0.1", 0, server.app, threaded=True)
+
+    root = logging.getLogger()
+    # the baseline printed "Checkname called" and the page, and Werkzeug
+    # logged the request, all in the request's thread; they go to a
+    # file here rather than the terminal
+    with tempfile.TemporaryFile("w") as logfile:
+        handler = logging.StreamHandler(logfile)
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+        logging.getLogger("werkzeug").setLevel(logging.NOTSET)
+        try:
+            run("baseline, logging every request", development_server)
+        finally:
+            root.removeHandler(handler)
+    # with the access log off, as by default; anything else that is
+    # logged goes through the queue, but nothing is written out
+    webserve.setup_logging(logging.INFO, access_log=False)
+    listener = webserve._listener
+    listener.handlers = (logging.NullHandler(),)
+    run("flask development server", development_server)
+    run("werkzeug, pooled threads",
+        lambda: webserve.PooledWSGIServer("127.0.0.1", 0, server.app))
+    listener.stop()
+    root.handlers.clear()
+
+
+def bench_bulk():
+    """
+    Compare answering a gateway's refresh of many users with one HTTP
+    request per user against one bulk request for all of them, with each
+    state backend. The requests go to the Flask app in this process, so
+    network round trips aren't counted.
+    """
+    import server
+    client = server.app.test_client()
+    n = 5000
+    users = [f"user{i}" for i in range(n)]
+    print(f"bulk requests, {n} users:")
+    old = server.keys, server.auth, server.ident
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in sorted(statebackend.BACKENDS):
+                backend = statebackend.make_backend(
+                    name, {user: "key" for user in users}, server.AUTH_TIMEOUT,
+                    server.IDENT_TIMEOUT, path=os.path.join(tmp, "state.db"),
+                )
+                server.keys, server.auth, server.ident = (
+                    backend.keys, backend.auth, backend.ident
+                )
+                with backend.auth.batch():
+                    backend.auth.update(
+                        {user: int(time.time()) for user in users[::2]}
+                    )
+
+                def one_by_one():
+                    for user in users:
+                        client.post("/issue_identifier", json=[user])
+                        client.get(f"/auth_status?username={user}")
+
+                def bulk():
+                    client.post("/issue_identifier", json=users)
+                    client.post("/auth_status", json=users)
+
+                # the first request issues the identifiers, the rest reuse them
+                bulk()
+                report(f"{name}, one user per request", timed(one_by_one), n)
+                report(f"{name}, one bulk request", timed(bulk), n)
+    finally:
+        server.keys, server.auth, server.ident = old
+
+
+def bench_pages():
+    """
+    Measure serving the device's host selection page as the number of
+    hosts grows: built by string concatenation, unescaped, on every
+    request (as it used to be), rendered and escaped by `pages` on every
+    request, and served from `pages.HostMenu`'s cache. Also the server's
+    'checkname' page.
+    """
+    import pages
+    calls = 2000
+    print(f"HTML pages, {calls} requests:")
+
+    def concatenated(keys):
+        resp = '<html><body><form action="enter_id" method="POST">'
+        resp += '<label>Select host name:</label>'
+        resp += '<select name="hostindex">'
+        for count, line in enumerate(keys):
+            name = line["hostname"] + " : " + line["user"]
+            resp += '<option value=' + str(count) + '> ' + name + '</option>'
+        resp += '</select>'
+        resp += '<input type="submit" value="submit" name="submit">'
+        resp += '</form></body></html>'
+        return resp
+
+    for hosts in (10, 1000):
+        keys = [{"hostname": f"host{i}", "user": f"user{i}"} for i in range(hosts)]
+        menu = pages.HostMenu()
+
+        def serve(render):
+            for _ in range(calls):
+                render(keys)
+
+        report(f"{hosts} hosts, concatenated", timed(serve, concatenated), calls)
+        report(f"{hosts} hosts, rendered", timed(serve, pages.menu_page), calls)
+        report(f"{hosts} hosts, cached", timed(serve, menu.render), calls)
+
+    def checkname():
+        for i in range(calls):
+            pages.checkname_page("test_user", True, i % 2 == 0, i)
+
+    report("checkname page, rendered", timed(checkname), calls)
+
+
+BENCHMARKS = {
+    "check_pin": bench_check_pin,
+    "expiry": bench_expiry,
+    "backends": bench_backends,
+    "keystore": bench_keystore,
+    "framing": bench_framing,
+    "recv": bench_recv,
+    "send": bench_send,
+    "accept": bench_accept,
+    "http": bench_http,
+    "bulk": bench_bulk,
+    "pages": bench_pages,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark {name!r}, choose from: "
+                  f"{', '.join(BENCHMARKS)}")
+            sys.exit(1)
+        BENCHMARKS[name]()
+        print("")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,13 +16,19 @@ created 2023-04-27 by Zane Globus-O'Harra
 import time
 import hashlib, hmac
 import json
+import logging
+import argparse
+from collections import namedtuple
 import flask
 from flask import Flask, redirect, url_for, request
 
 import deviceutils
+import webserve
+import pages
 
 
 app = Flask(__name__)
+log = logging.getLogger("device")
 
 
 # set True to show connection and message info, False to hide
@@ -34,12 +40,37 @@ SECRET_KEY_TABLE = {}
 
 TIME_SLICE = 30 # a time slice is 30s as defined in the 2d-2fa paper
 
+# set True to send PINs in compact binary frames (see protocol.py)
+# instead of JSON messages
+BINARY = False
+
+# address the browser interface is served on, and how: see webserve.py.
+# The device keeps nothing between requests (see `request_target()`), so
+# any number of threads and worker processes can serve it
+HTTP_HOST = "127.0.0.1"
+HTTP_PORT = 5000
+HTTP_SERVER = "auto"
+HTTP_WORKERS = 1
+HTTP_THREADS = webserve.THREADS
+
+# the host, user and key used by the command line version, and by
+# `generate_pin()` when it isn't given a key; the browser interface
+# doesn't use them, each of its requests carries the host it is for
 host = "127.0.0.1"
 port = 65432
-keys = []
 user = ""
 key = ""
 
+# the keylist: the hosts, and the user and key for each, see `load_keylist()`
+keys = []
+
+# a host selected from the keylist: where to send PINs, and the user and
+# key to send them with
+Target = namedtuple("Target", ["host", "port", "user", "key"])
+
+# the host/user selection page, see `selection_menu()`
+host_menu = pages.HostMenu()
+
 
 """
 ================
@@ -56,19 +87,9 @@ def index():
 @app.route('/enter_id', methods = ["POST"])
 def enter_id():
     index = request.form["hostindex"]
-    print("enter_id index: ", index)
-    ind = int(index)
-    id_process(int(ind))
-    resp = '<html><body><form action="do_auth" method="POST">'
-    resp += '<label>Input identifier: </label>'
-    resp += '<input type="text" name="ident">'
-    resp += '<input type="hidden" name="hostindex" value=' + index + '>'
-    resp += '<input type="submit" value="submit" name="submit"></form>'
-    #resp += '<br><form action="/index" method="GET"><input type="submit" value="return" name="return"'
-    #resp += '</form></body></html>'
-    resp += '<a href="index">Select different host/user</a>'
-    resp += '</body></html>'
-    return resp
+    log.debug("enter_id index: %s", index)
+    request_target()
+    return pages.enter_id_page(index)
 
 
 @app.route('/do_auth', methods = ["POST"])
@@ -76,16 +97,9 @@ def do_auth():
     #return "Success?"
     ident = int(request.form["ident"])
     index = request.form["hostindex"]
-    print("do_auth index: ", index)
-    auth_process(ident)
-    resp = '<html><body>PIN sent<br>Check login page'
-    resp += '<br><form action="enter_id" method="POST">'
-    resp += '<input type="hidden" name="hostindex" value=' + index + '>'
-    resp += '<input type="submit" value="enter new identifier" value="submit"></form>'
-    resp += '<br><a href="index">Select different host/user</a>'
-    # resp += '<br><a href="enter_id">Input different identifier</a>'
-    resp += '</body></html>'
-    return resp
+    log.debug("do_auth index: %s", index)
+    auth_process(ident, request_target())
+    return pages.do_auth_page(index)
 
 
 """
@@ -101,41 +115,59 @@ def load_keylist():
     each line is a single json for one entry
     format: hostname, address, port, user, key
     """
-    f = open('device_user_list.txt')
-    for line in f:
-        keys.append(json.loads(line))
+    global keys
+    entries = []
+    with open('device_user_list.txt') as f:
+        for line in f:
+            entries.append(json.loads(line))
+    # replaced whole, so that a request never sees it half loaded
+    keys = entries
+    host_menu.invalidate()
 
 
 def selection_menu():
-    resp = '<html><body><form action="enter_id" method="POST">'
-    resp += '<label>Select host name:</label>'
-    resp += '<select name="hostindex">'
-    count = 0
-    for line in keys:
-        name = line["hostname"] + " : " + line["user"]
-        resp += '<option value=' + str(count) + '> ' + name + '</option>'
-        count += 1
-    resp += '</select>'
-    resp += '<input type="submit" value="submit" name="submit">'
-    resp += '</form></body></html>'
-    return resp
+    """
+    the page for selecting a host and user, rendered again only when the
+    keylist changes
+    """
+    return host_menu.render(keys)
 
 
 def id_process(index):
+    """
+    Return the `Target` for the host at `index` in the keylist. Raise
+    IndexError if there is none.
+    """
+    if not 0 <= index < len(keys):
+        raise IndexError(f"No host {index} in the keylist.")
     target = keys[index]
-    global host
-    global port
-    global user
-    global key
-    host = target["address"]
-    port = target["port"]
-    user = target["user"]
-    key = target["key"]
-
-
-def auth_process(ident):
-    pin = generate_pin(ident)
-    deviceutils.send_message(host, port, user, pin)
+    return Target(
+        target["address"], target["port"], target["user"], target["key"]
+    )
+
+
+def request_target():
+    """
+    Return the `Target` selected in this request's form (its 'hostindex'),
+    kept in the request's context rather than in globals, so that
+    concurrent sessions each send their PINs to their own host with
+    their own key. Abort the request if the index isn't valid.
+    """
+    if "target" not in flask.g:
+        try:
+            flask.g.target = id_process(int(request.form["hostindex"]))
+        except (KeyError, ValueError, IndexError):
+            flask.abort(400)
+    return flask.g.target
+
+
+def auth_process(ident, target):
+    """
+    Generate the PIN for the identifier `ident` with the target's key,
+    and send it to the target's host.
+    """
+    pin = generate_pin(ident, target.key)
+    deviceutils.send_message(target.host, target.port, target.user, pin, BINARY)
     
 
 
@@ -200,12 +232,15 @@ def set_port():
     return int(entered)
 
 
-def generate_pin(identifier):
+def generate_pin(identifier, secret=None):
     """
     Generate a pin using the entered identifier, the time, and the
-    user's secret key. This is done using the SHA256 hash algorithm.
-    This generated pin is sent to the server to be verified.
+    user's secret key (`secret`, by default `key`). This is done using
+    the SHA256 hash algorithm. This generated pin is sent to the server
+    to be verified.
     """
+    if secret is None:
+        secret = key
     time_s = int(time.time()) # get the time since epoch in seconds
     time_slice = time_s // TIME_SLICE # get the time, divide to get current slice
     
@@ -216,7 +251,7 @@ def generate_pin(identifier):
     #key = current_key
 
     h = hmac.new(
-        key.encode('utf-8'), 
+        secret.encode('utf-8'), 
         msg.encode('utf-8'), 
         hashlib.sha256
     )
@@ -225,14 +260,52 @@ def generate_pin(identifier):
 
 
 def main():
+    global HTTP_HOST, HTTP_PORT, HTTP_SERVER, HTTP_WORKERS, HTTP_THREADS
+    parser = argparse.ArgumentParser(description="2D2FA device")
+    parser.add_argument(
+        "--http-host", default=HTTP_HOST,
+        help=f"address to serve the browser interface on (default {HTTP_HOST})",
+    )
+    parser.add_argument(
+        "--http-port", type=int, default=HTTP_PORT,
+        help=f"port to serve the browser interface on (default {HTTP_PORT})",
+    )
+    parser.add_argument(
+        "--http-server", choices=webserve.SERVERS, default=HTTP_SERVER,
+        help="WSGI server for the browser interface (default auto; flask "
+             "is Flask's development server, with debugging on)",
+    )
+    parser.add_argument(
+        "--http-workers", type=int, default=HTTP_WORKERS,
+        help=f"worker processes handling requests (default {HTTP_WORKERS})",
+    )
+    parser.add_argument(
+        "--http-threads", type=int, default=HTTP_THREADS,
+        help=f"threads in each worker (default {HTTP_THREADS})",
+    )
+    parser.add_argument(
+        "--access-log", action="store_true",
+        help="log every request to the browser interface",
+    )
+    args = parser.parse_args()
+    HTTP_HOST, HTTP_PORT = args.http_host, args.http_port
+    HTTP_SERVER, HTTP_THREADS = args.http_server, args.http_threads
+    HTTP_WORKERS = args.http_workers
+    webserve.setup_logging(
+        logging.DEBUG if DEBUG else logging.INFO, access_log=args.access_log
+    )
+
     load_keylist()
     
     if DEBUG:
         print("Keylist: ", keys)
         print("First user: ", keys[0]["user"])
     
-    app.debug = True
-    app.run()
+    if HTTP_SERVER == "flask":
+        app.debug = True
+    webserve.serve(
+        app, HTTP_HOST, HTTP_PORT, HTTP_WORKERS, HTTP_THREADS, HTTP_SERVER
+    )
     """
     # set the host and port
     host = set_host()
@@ -245,7 +318,7 @@ def main():
     # generate the pin
     pin = generate_pin(id)
     # send the pin to the server
-    deviceutils.send_message(host, port, user, pin)
+    deviceutils.send_message(host, port, user, pin, BINARY)
     """
 
 
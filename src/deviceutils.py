@@ -18,14 +18,21 @@ import selectors
 import traceback
 import json
 import io
-import struct
+import protocol
 
 
+# the selector connections are registered with by default; `send_message()`
+# and `send_messages()` use a selector of their own instead, so that
+# several threads can send at once
 sel = selectors.DefaultSelector()
 
 # set to True to show connection and message info, False to hide
 DEBUG = False
 
+# maximum number of requests `send_messages()` sends over one keep-alive
+# connection; matches the server's `serverutils.KEEPALIVE_MAX_REQUESTS`
+KEEPALIVE_MAX_REQUESTS = 100
+
 
 def create_request(user, pin):
     """
@@ -50,13 +57,32 @@ def create_request(user, pin):
     )
 
 
-def start_connection(host, port, request):
+def create_action_request(action, user):
+    """
+    Create a request for one of the server's actions other than checking
+    a PIN, in the same format as `create_request()`: "issue_identifier"
+    to get the user's identifier, or "auth_status" to find out whether
+    they are authorized.
+    """
+    return dict(
+        type="text/json",
+        encoding="utf-8",
+        content=dict(action=action, user=user),
+    )
+
+
+def start_connection(host, port, request, message_class=None, binary=False,
+                     selector=None):
     """
     Connect to the server to send a message. Get the correct address
     from the host and port from the user, and connect to a remote socket
     at the address. Create a Message object to send over the connection
-    and register it.
+    and register it with `selector` (by default `sel`). Return the
+    Message object. If `binary` is true, PINs are sent in binary frames
+    (see `protocol`) instead of JSON.
     """
+    if selector is None:
+        selector = sel
     addr = (host, port) # get the address
 
     if DEBUG:
@@ -66,47 +92,97 @@ def start_connection(host, port, request):
     sock.setblocking(False)
     sock.connect_ex(addr) # connect to the remote socket at the address
     events = selectors.EVENT_READ | selectors.EVENT_WRITE
-    message = Message(sel, sock, addr, request) # create the message
+    if message_class is None:
+        message_class = Message
+    # create the message
+    message = message_class(selector, sock, addr, request, binary=binary)
+
+    selector.register(sock, events, data=message)
+    return message
+
 
-    sel.register(sock, events, data=message)
+def run_connections(selector=None):
+    """
+    Run the selector loop until every connection registered with
+    `selector` (by default `sel`) has sent its requests, received its
+    responses and been closed.
+    """
+    if selector is None:
+        selector = sel
+    while True:
+        events = selector.select(timeout=1)
+        if DEBUG:
+            print("Events: ", events)
+        # for each message, attempt to send it over the network
+        for key, mask in events:
+            message = key.data
+            try:
+                # send the message over the network
+                message.process_events(mask)
 
+            except Exception:
+                print(
+                    f"Main: Error: Exception for {message.addr}:\n"
+                    f"{traceback.format_exc()}"
+                )
+                message.close()
+        # Check for a socket being monitored to continue.
+        if not selector.get_map():
+            break
 
-def send_message(host, port, user, pin):
+
+def send_message(host, port, user, pin, binary=False):
     """
     Create a request that will be sent over the connection, start the
     connection, and send the message over the connection. Close the
-    scoket and unregister the message when complete.
+    scoket and unregister the message when complete. If `binary` is
+    true, the PIN is sent in a compact binary frame instead of JSON.
     """
     request = create_request(user, pin)
-    start_connection(host, port, request)
+    selector = selectors.DefaultSelector()
+    start_connection(host, port, request, binary=binary, selector=selector)
     
     if DEBUG:
         print("Connection established, sending request.")
 
     try:
-        while True:
-            events = sel.select(timeout=1)
-            if DEBUG:
-                print("Events: ", events)
-            # for each message, attempt to send it over the network
-            for key, mask in events:
-                message = key.data
-                try:
-                    # send the message over the network
-                    message.process_events(mask)
-
-                except Exception:
-                    print(
-                        f"Main: Error: Exception for {message.addr}:\n"
-                        f"{traceback.format_exc()}"
-                    )
-                    message.close()
-            # Check for a socket being monitored to continue.
-            if not sel.get_map():
-                break
+        run_connections(selector)
     
     except KeyboardInterrupt:
         print("Caught keyboard interrupt, exiting")
+    finally:
+        selector.close()
+
+
+def send_messages(host, port, pins, binary=False):
+    """
+    Send many PINs, a list of `(user, pin)` pairs, over keep-alive
+    connections, up to KEEPALIVE_MAX_REQUESTS on each, instead of one
+    connection per PIN. Return the list of the server's results (e.g.
+    "Authorized"), in the order of `pins`, with None for any request
+    that got no response. If `binary` is true, the PINs are sent in
+    binary frames instead of JSON.
+    """
+    connections = []
+    selector = selectors.DefaultSelector()
+    for start in range(0, len(pins), KEEPALIVE_MAX_REQUESTS):
+        requests = [
+            create_request(user, pin)
+            for user, pin in pins[start:start + KEEPALIVE_MAX_REQUESTS]
+        ]
+        connections.append(start_connection(
+            host, port, requests, KeepAliveMessage, binary, selector
+        ))
+    try:
+        run_connections(selector)
+    finally:
+        selector.close()
+    results = []
+    for message in connections:
+        for i in range(len(message.request)):
+            response = message.responses.get(i)
+            results.append(None if response is None else response.get("result"))
+    return results
 
 
 class Message:
@@ -115,7 +191,7 @@ class Message:
     sending the message over the network to a server, and closing the
     socket over which the message was sent. 
     """
-    def __init__(self, selector, sock, addr, request):
+    def __init__(self, selector, sock, addr, request, binary=False):
         """
         The Message class initializer initializes the following
         attributes:
@@ -128,26 +204,32 @@ class Message:
           connected.
         - request: The 'request' data structure created by
           `create_request()`.
-        - _recv_buffer: Buffer into which data is read from the socket
-          connection. 
-        - _send_buffer: Buffer into which data is written before it is
+        - _recv_buffer: The `protocol.RecvBuffer` into which data is
+          read from the socket connection. 
+        - _send_buffer: The `protocol.SendQueue` of buffers waiting to be
           sent over the connection.
         - _request_queued: Boolean indicating whether a request has been
           queued for sending over the network.
         - _jsonheader_len: The length of a `jsonheader`.
         - jsonheader: The header of a message that is to be sent over
           the network.
+        - binary: Whether PIN requests are sent in binary frames (see
+          `protocol`) instead of JSON.
+        - _frame: The kind, keep-alive flag, request ID and body length
+          of the binary frame being received, or None.
         - response: The response from the server.
         """
         self.selector = selector
         self.sock = sock
         self.addr = addr
         self.request = request
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self._recv_buffer = protocol.RecvBuffer()
+        self._send_buffer = protocol.SendQueue()
         self._request_queued = False
         self._jsonheader_len = None
         self.jsonheader = None
+        self.binary = binary
+        self._frame = None
         self.response = None
 
     def _set_selector_events_mask(self, mode):
@@ -171,14 +253,12 @@ class Message:
         """
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            received = self._recv_buffer.recv_from(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not received:
                 raise RuntimeError("Peer closed.")
 
     def _write(self):
@@ -188,15 +268,13 @@ class Message:
         """
         if self._send_buffer:
             if DEBUG:
-                print(f"Sending {self._send_buffer!r} to {self.addr}")
+                print(f"Sending {len(self._send_buffer)} bytes to {self.addr}")
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                self._send_buffer.send_to(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
-            else:
-                self._send_buffer = self._send_buffer[sent:]
 
     def _json_encode(self, obj, encoding):
         """
@@ -218,12 +296,13 @@ class Message:
         return obj
 
     def _create_message(
-        self, *, content_bytes, content_type, content_encoding
+        self, *, content_bytes, content_type, content_encoding, headers=None
     ):
         """
         Create a message to send over the network by packing the message
-        header and the message into a struct. Return the created
-        message. 
+        header and the message into a struct. Any extra `headers` are
+        added to the JSON header. Return the parts of the created
+        message, to be queued for sending without joining them.
         """
         jsonheader = {
             "byteorder": sys.byteorder,
@@ -231,10 +310,11 @@ class Message:
             "content-encoding": content_encoding,
             "content-length": len(content_bytes),
         }
+        if headers:
+            jsonheader.update(headers)
         jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
-        message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        message = message_hdr + jsonheader_bytes + content_bytes
-        return message
+        message_hdr = protocol.PROTOHEADER.pack(len(jsonheader_bytes))
+        return (message_hdr, jsonheader_bytes, content_bytes)
 
     def _process_response_json_content(self):
         """
@@ -267,9 +347,22 @@ class Message:
         received from the server and process the response. 
         """
         self._read()
+        self._process_buffer()
 
-        if self._jsonheader_len is None:
-            self.process_protoheader()
+    def _process_buffer(self):
+        """
+        Process as much of the response as has been received.
+        """
+        if self._jsonheader_len is None and self._frame is None:
+            if protocol.is_frame(self._recv_buffer):
+                self.process_frameheader()
+            else:
+                self.process_protoheader()
+
+        if self._frame is not None:
+            if self.response is None:
+                self.process_frame()
+            return
 
         if self._jsonheader_len is not None:
             if self.jsonheader is None:
@@ -324,9 +417,24 @@ class Message:
         Then, pack the message into the `_send_buffer` and set the
         `_request_queued` indicator.
         """
-        content = self.request["content"]
-        content_type = self.request["type"]
-        content_encoding = self.request["encoding"]
+        self._send_buffer.extend(self._pack_request(self.request))
+        self._request_queued = True
+
+    def _pack_request(self, request, headers=None):
+        """
+        Return the parts of the message carrying a request created by
+        `create_request()`, with any extra JSON `headers`.
+        """
+        content = request["content"]
+        content_type = request["type"]
+        content_encoding = request["encoding"]
+        if self.binary and content_type == "text/json" and "pin" in content:
+            headers = headers or {}
+            return (protocol.pack_frame(
+                protocol.KIND_PIN,
+                protocol.pack_pin(content["user"], content["pin"]),
+                headers.get("request-id"), headers.get("keep-alive", False),
+            ),)
         if content_type == "text/json":
             req = {
                 "content_bytes": self._json_encode(content, content_encoding),
@@ -339,17 +447,44 @@ class Message:
                 "content_type": content_type,
                 "content_encoding": content_encoding,
             }
-        message = self._create_message(**req)
-        self._send_buffer += message
-        self._request_queued = True
+        return self._create_message(**req, headers=headers)
 
     def process_protoheader(self):
         hdrlen = 2
         if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:hdrlen]
-            )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            self._jsonheader_len = self._recv_buffer.unpack(protocol.PROTOHEADER)[0]
+            if self._jsonheader_len > protocol.MAX_JSONHEADER_SIZE:
+                raise ValueError(
+                    f"JSON header of {self._jsonheader_len} bytes is too large."
+                )
+
+    def process_frameheader(self):
+        """
+        Process the header of a binary frame, and crop it from the
+        `_recv_buffer`.
+        """
+        if len(self._recv_buffer) >= protocol.FRAME.size:
+            with self._recv_buffer.view(protocol.FRAME.size) as header:
+                self._frame = protocol.unpack_frame(header)
+            self._recv_buffer.consume(protocol.FRAME.size)
+
+    def process_frame(self):
+        """
+        Process a response received in a binary frame, as a JSON
+        response with the same result. Once the response has been
+        processed, close the socket connection.
+        """
+        length = self._frame[3]
+        if not len(self._recv_buffer) >= length:
+            return
+        with self._recv_buffer.view(length) as body:
+            self.response = {"result": protocol.unpack_result(body)}
+        self._recv_buffer.consume(length)
+        if DEBUG:
+            print(f"Received response {self.response!r} from {self.addr}")
+        self._process_response_json_content()
+        # Close when response has been processed
+        self.close()
 
     def process_jsonheader(self):
         """
@@ -360,9 +495,8 @@ class Message:
         hdrlen = self._jsonheader_len
         if len(self._recv_buffer) >= hdrlen:
             self.jsonheader = self._json_decode(
-                self._recv_buffer[:hdrlen], "utf-8"
+                self._recv_buffer.take(hdrlen), "utf-8"
             )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
             for reqhdr in (
                 "byteorder",
                 "content-length",
@@ -371,6 +505,11 @@ class Message:
             ):
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f"Missing required header '{reqhdr}'.")
+            if self.jsonheader["content-length"] > protocol.MAX_CONTENT_SIZE:
+                raise ValueError(
+                    f"Content of {self.jsonheader['content-length']} bytes "
+                    f"is too large."
+                )
 
     def process_response(self):
         """
@@ -381,8 +520,7 @@ class Message:
         content_len = self.jsonheader["content-length"]
         if not len(self._recv_buffer) >= content_len:
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
+        data = self._recv_buffer.take(content_len)
         if self.jsonheader["content-type"] == "text/json":
             encoding = self.jsonheader["content-encoding"]
             self.response = self._json_decode(data, encoding)
@@ -400,3 +538,92 @@ class Message:
             self._process_response_binary_content()
         # Close when response has been processed
         self.close()
+
+
+class KeepAliveMessage(Message):
+    """
+    A connection carrying several requests, sent one after another
+    without waiting for the responses (pipelined). Each request is
+    tagged with a "request-id" header, its index in the list of
+    requests, and asks the server to keep the connection open; the
+    responses are matched back to the requests by that ID. The
+    connection is closed once every response has arrived, or when the
+    server says it won't keep the connection open any longer.
+    """
+    def __init__(self, selector, sock, addr, request, binary=False):
+        """
+        As for `Message`, except that `request` is a list of requests
+        created by `create_request()`, and:
+
+        - responses: Maps the ID (index) of each request answered so
+          far to the server's response.
+        """
+        super().__init__(selector, sock, addr, request, binary)
+        self.responses = {}
+
+    def queue_request(self):
+        """
+        Queue every request for sending, tagged with its ID.
+        """
+        for request_id, request in enumerate(self.request):
+            self._send_buffer.extend(self._pack_request(
+                request, {"request-id": request_id, "keep-alive": True}
+            ))
+        self._request_queued = True
+
+    def _process_buffer(self):
+        """
+        Process every response that has been received in full.
+        """
+        while self.sock is not None:
+            answered = len(self.responses)
+            super()._process_buffer()
+            if len(self.responses) == answered:
+                # wait for the rest of the next response
+                break
+
+    def process_response(self):
+        """
+        Process a response received in a JSON message.
+        """
+        content_len = self.jsonheader["content-length"]
+        if not len(self._recv_buffer) >= content_len:
+            return
+        data = self._recv_buffer.take(content_len)
+        if self.jsonheader["content-type"] == "text/json":
+            encoding = self.jsonheader["content-encoding"]
+            response = self._json_decode(data, encoding)
+        else:
+            # Binary or unknown content-type
+            response = data
+        self._response_received(
+            response, self.jsonheader.get("request-id"),
+            self.jsonheader.get("keep-alive", False)
+        )
+
+    def process_frame(self):
+        """
+        Process a response received in a binary frame.
+        """
+        kind, keep_alive, request_id, length = self._frame
+        if not len(self._recv_buffer) >= length:
+            return
+        with self._recv_buffer.view(length) as body:
+            response = {"result": protocol.unpack_result(body)}
+        self._recv_buffer.consume(length)
+        self._response_received(response, request_id, keep_alive)
+
+    def _response_received(self, response, request_id, keep_alive):
+        """
+        Store a response by its request ID, and get ready for the next
+        one. Close the connection when every request has been answered
+        or the server closes it after this response.
+        """
+        if DEBUG:
+            print(f"Received response {response!r} from {self.addr}")
+        self.responses[request_id] = response
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self._frame = None
+        if len(self.responses) >= len(self.request) or not keep_alive:
+            self.close()
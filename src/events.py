@@ -0,0 +1,145 @@
+"""
+2D2FA Events
+
+A small publish/subscribe hub passing events about users (e.g. that a
+user has been authorized) from the thread that causes them, such as the
+server's selector loop, to the threads or event loops waiting on them,
+such as the HTTP streams of `server.auth_stream()`. Publishing an event
+about a user nobody is subscribed to is a dictionary lookup.
+
+Events are sent to browsers as server-sent events (SSE), formatted by
+`format_event()`.
+"""
+
+import json
+import queue
+import threading
+
+
+class Broker:
+    """
+    Keeps the subscribers to each user's events, and passes each event
+    published about a user to their subscribers. A subscriber is a
+    callback, called with the name of the event and its data on the
+    publishing thread, so it should only hand the event on (e.g. put it
+    in a queue, see `Subscription`).
+    """
+    def __init__(self):
+        """
+        The Broker class initializer initializes the following
+        attributes:
+
+        - published: Number of events published to at least one
+          subscriber.
+        - _subscribers: Maps each user to the list of their subscribers.
+        - _lock: Lock guarding `_subscribers`, as subscribers come and go
+          on other threads than the one publishing.
+        """
+        self.published = 0
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(callbacks) for callbacks in self._subscribers.values())
+
+    def subscribe(self, user, callback):
+        """
+        Call `callback(event, data)` for each event published about
+        `user` from now on.
+        """
+        with self._lock:
+            # copied on write, so that `publish()` can iterate without
+            # holding the lock
+            callbacks = self._subscribers.get(user, [])
+            self._subscribers[user] = callbacks + [callback]
+
+    def unsubscribe(self, user, callback):
+        """
+        Stop calling `callback` for events about `user`.
+        """
+        with self._lock:
+            # compared by equality, as a bound method is a new object
+            # each time it is looked up
+            callbacks = [c for c in self._subscribers.get(user, [])
+                         if c != callback]
+            if callbacks:
+                self._subscribers[user] = callbacks
+            else:
+                self._subscribers.pop(user, None)
+
+    def publish(self, user, event, data=None):
+        """
+        Pass the event called `event`, with `data`, to the subscribers to
+        `user`'s events.
+        """
+        callbacks = self._subscribers.get(user)
+        if not callbacks:
+            return
+        self.published += 1
+        for callback in callbacks:
+            callback(event, data)
+
+
+class Subscription:
+    """
+    A subscription to a user's events, queued for a thread to wait on
+    with `get()`. Use it as a context manager, or `close()` it, to
+    unsubscribe.
+    """
+    def __init__(self, broker, user):
+        """
+        The Subscription class initializer initializes the following
+        attributes:
+
+        - broker: The `Broker` subscribed to.
+        - user: The user whose events are received.
+        - _queue: The events received but not yet taken by `get()`.
+        """
+        self.broker = broker
+        self.user = user
+        self._queue = queue.SimpleQueue()
+        broker.subscribe(user, self._put)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _put(self, event, data):
+        self._queue.put((event, data))
+
+    def get(self, timeout=None):
+        """
+        Wait up to `timeout` seconds for the next event. Return its name
+        and data, or None if there was none.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self.user, self._put)
+
+
+def format_event(event, data, retry=None):
+    """
+    Return the server-sent event called `event`, carrying `data` as
+    JSON. If `retry` is given, it also tells the browser to wait that
+    many milliseconds before reconnecting if the stream is closed.
+    """
+    text = ""
+    if retry is not None:
+        text += f"retry: {int(retry)}\n"
+    text += f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return text.encode('utf-8')
+
+
+def format_comment(text=""):
+    """
+    Return a server-sent event comment, ignored by the browser; sent to
+    keep an idle stream open and to notice clients that have gone away.
+    """
+    return f": {text}\n\n".encode('utf-8')
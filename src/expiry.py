@@ -0,0 +1,399 @@
+"""
+2D2FA Expiry
+
+A bounded store of entries that expire, used by the server for the
+"authorized" and "identifier" lists. Expiry times are kept in a
+min-heap, so timing out entries only touches the entries that have
+actually expired, instead of scanning the whole list on every server
+tick. `ShardedTTLStore` splits a store into independently locked shards
+so that it can be shared between threads.
+"""
+
+import heapq
+import time
+import threading
+from contextlib import nullcontext
+
+
+class TTLStore:
+    """
+    A dictionary-like store whose entries expire a fixed `timeout` after
+    the time stamp stored in their value. Getting and setting an entry
+    are O(1) (plus a heap push when setting). Entries are expired in two
+    ways:
+
+    - lazily: an entry that has expired is treated as missing (and
+      removed) when it is read, even if no sweep has removed it yet. Its
+      key is still reported by the next sweep.
+    - by sweeps: `expire()` pops the heap of expiry times up to the
+      current time, removing the entries that have expired. A sweep can
+      be limited to a number of entries so that its cost is spread over
+      several server ticks.
+
+    When the store holds `capacity` entries, adding a new one evicts the
+    entry closest to expiring. Counts of expired and evicted entries are
+    kept, see `stats()`.
+
+    Entries that are overwritten or removed leave their old expiry time
+    in the heap. Such stale heap entries are discarded when they reach
+    the top of the heap, and the heap is rebuilt if they come to
+    outnumber the live entries.
+    """
+    def __init__(self, timeout, stamp=None, capacity=None):
+        """
+        The TTLStore class initializer initializes the following
+        attributes:
+
+        - timeout: How long, in seconds, an entry is good for.
+        - stamp: Function returning the time stamp (seconds since epoch)
+          stored in a value. By default the value itself is the time
+          stamp, as in the server's "authorized" list.
+        - capacity: The maximum number of entries, or None for no limit.
+        - expired: Number of entries removed because they expired.
+        - evicted: Number of entries removed to stay within `capacity`.
+        - _data: Maps each key to an `(expiry time, value)` pair.
+        - _heap: Min-heap of `(expiry time, key)` pairs.
+        - _lapsed: The keys removed by `get()` because they had expired,
+          to be reported by the next `expire()` (a dict, used as an
+          ordered set).
+        """
+        self.timeout = timeout
+        self.stamp = stamp if stamp is not None else (lambda value: value)
+        self.capacity = capacity
+        self.expired = 0
+        self.evicted = 0
+        self._data = {}
+        self._heap = []
+        self._lapsed = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        deadline = self.stamp(value) + self.timeout
+        if (key not in self._data and self.capacity is not None
+                and len(self._data) >= self.capacity):
+            self._evict()
+        self._data[key] = (deadline, value)
+        heapq.heappush(self._heap, (deadline, key))
+        if len(self._heap) > 2 * len(self._data) + 64:
+            self._compact()
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def get(self, key, default=None):
+        """
+        Return the value for `key`, or `default` if there is none or it
+        has expired.
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if entry[0] < int(time.time()):
+            # expired, but not swept yet
+            if self._data.get(key) is entry:
+                del self._data[key]
+                self._lapsed[key] = None
+                self.expired += 1
+            return default
+        return entry[1]
+
+    def pop(self, key, *default):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return entry[1]
+
+    def keys(self):
+        return list(self._data)
+
+    def items(self):
+        return [(key, entry[1]) for key, entry in list(self._data.items())]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self._data.clear()
+        self._heap.clear()
+        self._lapsed.clear()
+
+    def expires(self, key):
+        """
+        Return the expiry time of the entry for `key`, or None.
+        """
+        entry = self._data.get(key)
+        return None if entry is None else entry[0]
+
+    def batch(self):
+        """
+        Context manager grouping writes, as `SQLiteTTLStore.batch()`
+        does. Writes to memory take effect immediately, so there is
+        nothing to group.
+        """
+        return nullcontext()
+
+    def _pop_live(self):
+        """
+        Pop the heap until an entry that is still current is found and
+        return its key (still in `_data`), or None if the heap is empty.
+        """
+        heap = self._heap
+        while heap:
+            deadline, key = heapq.heappop(heap)
+            entry = self._data.get(key)
+            # skip heap entries for keys that were removed or set again
+            if entry is not None and entry[0] == deadline:
+                return key
+        return None
+
+    def _evict(self):
+        key = self._pop_live()
+        if key is not None:
+            del self._data[key]
+            self.evicted += 1
+
+    def _compact(self):
+        self._heap = [(entry[0], key) for key, entry in self._data.items()]
+        heapq.heapify(self._heap)
+
+    def expire(self, now, limit=None):
+        """
+        Remove the entries whose expiry time is before `now`, at most
+        `limit` of them if given (the rest are left for the next sweep,
+        and are still treated as missing when read). Return the list of
+        removed keys, along with the keys `get()` found expired and
+        removed since the last sweep, unless they have been set again.
+        """
+        heap = self._heap
+        expired = []
+        while heap and heap[0][0] < now:
+            if limit is not None and len(expired) >= limit:
+                break
+            deadline, key = heapq.heappop(heap)
+            entry = self._data.get(key)
+            # skip heap entries for keys that were removed or set again
+            if entry is not None and entry[0] == deadline:
+                del self._data[key]
+                expired.append(key)
+        self.expired += len(expired)
+        if self._lapsed:
+            lapsed = [key for key in self._lapsed if key not in self._data]
+            self._lapsed = {}
+            expired = lapsed + expired
+        return expired
+
+    def stats(self):
+        """
+        Return a dict of the store's size and expiry/eviction counters.
+        """
+        return {
+            "size": len(self._data),
+            "capacity": self.capacity,
+            "heap": len(self._heap),
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+class ShardedTTLStore:
+    """
+    A thread-safe `TTLStore`, split into shards that each have their own
+    lock. Keys are assigned to shards by hash, so threads working on
+    different users rarely wait on each other. Besides the dictionary
+    operations, `get_or_set()` gives an atomic "get or create" for one
+    key, and `get_many()` and `get_or_set_many()` handle many keys
+    taking each shard's lock once.
+    """
+    def __init__(self, timeout, stamp=None, capacity=None, shards=16):
+        """
+        The ShardedTTLStore class initializer initializes the following
+        attributes:
+
+        - timeout, stamp: As for `TTLStore`.
+        - capacity: The maximum number of entries, or None for no limit.
+          Each shard holds an equal part of it.
+        - _shards: The `TTLStore` for each shard.
+        - _locks: The lock for each shard.
+        """
+        self.timeout = timeout
+        self.capacity = capacity
+        per_shard = None if capacity is None else -(-capacity // shards)
+        self._shards = [TTLStore(timeout, stamp, per_shard) for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    def _shard(self, key):
+        i = hash(key) % len(self._shards)
+        return self._shards[i], self._locks[i]
+
+    def _group(self, keys):
+        """
+        Sort `keys` by shard. Return a list of (shard, lock, keys) for the
+        shards holding any of them.
+        """
+        groups = {}
+        for key in keys:
+            groups.setdefault(hash(key) % len(self._shards), []).append(key)
+        return [(self._shards[i], self._locks[i], group)
+                for i, group in groups.items()]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        shard, lock = self._shard(key)
+        with lock:
+            shard[key] = value
+
+    def __delitem__(self, key):
+        shard, lock = self._shard(key)
+        with lock:
+            del shard[key]
+
+    def get(self, key, default=None):
+        shard, lock = self._shard(key)
+        with lock:
+            return shard.get(key, default)
+
+    def pop(self, key, *default):
+        shard, lock = self._shard(key)
+        with lock:
+            return shard.pop(key, *default)
+
+    def keys(self):
+        keys = []
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                keys += shard.keys()
+        return keys
+
+    def items(self):
+        items = []
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                items += shard.items()
+        return items
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                shard.clear()
+
+    def expires(self, key):
+        shard, lock = self._shard(key)
+        with lock:
+            return shard.expires(key)
+
+    def batch(self):
+        """
+        Context manager grouping writes, as `SQLiteTTLStore.batch()`
+        does. Writes to memory take effect immediately, so there is
+        nothing to group.
+        """
+        return nullcontext()
+
+    def get_or_set(self, key, fresh, factory):
+        """
+        Atomically get the value for `key`, or set it to `factory()` if
+        there is none or `fresh(value)` is false. Return the value and
+        whether it was newly set.
+        """
+        shard, lock = self._shard(key)
+        with lock:
+            value = shard.get(key)
+            if value is not None and fresh(value):
+                return value, False
+            value = factory()
+            shard[key] = value
+            return value, True
+
+    def get_many(self, keys):
+        """
+        Return a dict of the values of those of `keys` that have one,
+        taking the lock of each shard once rather than once per key.
+        """
+        values = {}
+        for shard, lock, group in self._group(keys):
+            with lock:
+                for key in group:
+                    value = shard.get(key)
+                    if value is not None:
+                        values[key] = value
+        return values
+
+    def get_or_set_many(self, keys, fresh, factory):
+        """
+        As `get_or_set()` for each of `keys`, taking the lock of each
+        shard once. Return a dict mapping each key to its value and
+        whether it was newly set.
+        """
+        results = {}
+        for shard, lock, group in self._group(dict.fromkeys(keys)):
+            with lock:
+                for key in group:
+                    value = shard.get(key)
+                    if value is not None and fresh(value):
+                        results[key] = (value, False)
+                    else:
+                        value = factory()
+                        shard[key] = value
+                        results[key] = (value, True)
+        return results
+
+    def expire(self, now, limit=None):
+        """
+        Sweep every shard as `TTLStore.expire()` does, spreading `limit`
+        over the shards. Return the list of removed keys.
+        """
+        per_shard = None if limit is None else -(-limit // len(self._shards))
+        expired = []
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                expired += shard.expire(now, per_shard)
+        return expired
+
+    def stats(self):
+        """
+        Return a dict of the store's size and expiry/eviction counters,
+        summed over the shards.
+        """
+        total = {"size": 0, "capacity": self.capacity, "heap": 0,
+                 "expired": 0, "evicted": 0}
+        for shard, lock in zip(self._shards, self._locks):
+            with lock:
+                stats = shard.stats()
+            for name in ("size", "heap", "expired", "evicted"):
+                total[name] += stats[name]
+        return total
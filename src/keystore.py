@@ -0,0 +1,204 @@
+"""
+2D2FA Key Store
+
+A compact, read-only on-disk format for the server's "keys" list (users
+and their secret keys), opened with mmap so that looking up a key reads
+only the few pages it needs instead of parsing and holding every key in
+memory.
+
+To convert the JSON key file read by `serverutils.get_keys()`, run:
+
+    python3 keystore.py server_user_list.txt server_user_list.keys
+
+File layout (all integers little-endian):
+
+- header: magic `b"2D2FAKS1"`, the number of users (uint32) and the
+  number of slots in the hash index (uint32, a power of two).
+- hash index: one uint64 per slot, the file offset of a record or 0 for
+  an empty slot. A user's first slot is the CRC-32 of their name modulo
+  the number of slots; collisions go to the next slot (linear probing).
+- records: for each user, the length of their name and of their key
+  (uint16 each) followed by the UTF-8 encoded name and key.
+"""
+
+import os
+import sys
+import json
+import mmap
+import zlib
+import struct
+
+
+MAGIC = b"2D2FAKS1"
+HEADER = struct.Struct("<8sII")
+SLOT = struct.Struct("<Q")
+RECORD = struct.Struct("<HH")
+
+
+def is_keystore(path):
+    """
+    Return True if the file at `path` is a key store (rather than a JSON
+    key file).
+    """
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _slot_count(count):
+    """
+    Return the number of index slots for `count` users: a power of two
+    at least twice the count, so that probe sequences stay short.
+    """
+    slots = 1
+    while slots < 2 * count:
+        slots *= 2
+    return slots
+
+
+def write_keystore(path, keys):
+    """
+    Write a key store holding the `keys` dictionary (user to key) to
+    `path`. The file is written next to `path` and then renamed over it,
+    so that a server reading the old file never sees a partial one.
+    """
+    count = len(keys)
+    slots = _slot_count(count)
+    index = [0] * slots
+    records = []
+    offset = HEADER.size + slots * SLOT.size
+    for user, key in keys.items():
+        user_b = user.encode('utf-8')
+        key_b = key.encode('utf-8')
+        i = zlib.crc32(user_b) & (slots - 1)
+        while index[i]:
+            i = (i + 1) & (slots - 1)
+        index[i] = offset
+        record = RECORD.pack(len(user_b), len(key_b)) + user_b + key_b
+        records.append(record)
+        offset += len(record)
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, count, slots))
+        f.write(struct.pack(f"<{slots}Q", *index))
+        for record in records:
+            f.write(record)
+    os.replace(tmp, path)
+
+
+def convert(json_path, path):
+    """
+    Convert the JSON key file read by `serverutils.get_keys()` (one JSON
+    object mapping users to keys) into a key store at `path`.
+    """
+    with open(json_path) as f:
+        keys = json.load(f)
+    write_keystore(path, keys)
+    return len(keys)
+
+
+class KeyStore:
+    """
+    A read-only, memory-mapped key store, read like the dictionary
+    returned by `serverutils.get_keys()`. `get()` hashes the user's name
+    and probes the index, an O(1) lookup touching a couple of pages.
+    """
+    def __init__(self, path):
+        """
+        The KeyStore class initializer initializes the following
+        attributes:
+
+        - path: The path of the key store file.
+        - count: The number of users in the store.
+        - slots: The number of slots in the hash index.
+        - _file, _map: The open file and its read-only memory map.
+        """
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.slots = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a key store.")
+
+    def __getstate__(self):
+        # memory maps can't be pickled (e.g. to send the keys to a
+        # process-pool worker); the new copy maps the file itself
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _record(self, offset):
+        """
+        Return the encoded user name and key of the record at `offset`.
+        """
+        user_len, key_len = RECORD.unpack_from(self._map, offset)
+        start = offset + RECORD.size
+        return (self._map[start:start + user_len],
+                self._map[start + user_len:start + user_len + key_len])
+
+    def get(self, user, default=None):
+        """
+        Return the key of `user`, or `default` if they aren't in the
+        store (as no user that isn't a string is).
+        """
+        if not isinstance(user, str):
+            return default
+        user_b = user.encode('utf-8')
+        mask = self.slots - 1
+        i = zlib.crc32(user_b) & mask
+        while True:
+            offset = SLOT.unpack_from(self._map, HEADER.size + i * SLOT.size)[0]
+            if not offset:
+                return default
+            name, key = self._record(offset)
+            if name == user_b:
+                return key.decode('utf-8')
+            i = (i + 1) & mask
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, user):
+        return self.get(user) is not None
+
+    def __getitem__(self, user):
+        key = self.get(user)
+        if key is None:
+            raise KeyError(user)
+        return key
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        """
+        Return every `(user, key)` pair, reading the records in order.
+        """
+        items = []
+        offset = HEADER.size + self.slots * SLOT.size
+        for _ in range(self.count):
+            name, key = self._record(offset)
+            items.append((name.decode('utf-8'), key.decode('utf-8')))
+            offset += RECORD.size + len(name) + len(key)
+        return items
+
+    def keys(self):
+        return [user for user, key in self.items()]
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(f"Usage: {sys.argv[0]} <json key file> <key store>")
+        sys.exit(1)
+    count = convert(sys.argv[1], sys.argv[2])
+    print(f"Wrote {count} keys to {sys.argv[2]}")
+
+
+if __name__ == "__main__":
+    main()
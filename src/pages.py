@@ -0,0 +1,184 @@
+"""
+2D2FA Pages
+
+The HTML pages of the server's and the device's browser interfaces. Each
+page is a template put together once, when this module is imported: its
+static HTML, joined into one format string with a slot for each value
+that changes between requests. Rendering a page fills the slots with the
+values, escaped with `html.escape()`, in one `str.format()` call instead
+of building the page up piece by piece. Pages that don't change at all
+are kept whole, such as the server's index and the device's host/user
+dropdown, which is rendered again only when the keylist changes (see
+`HostMenu`).
+"""
+
+from html import escape
+
+
+"""
+================
+Server pages
+================
+"""
+
+# the form where the user enters who they are logging in as, at the top
+# of every server page
+NAME_FORM = (
+    '<form action="checkname" mothod="POST">'
+    '<label>Input user name: </label>'
+    '<input type="text" name="username">'
+    '<input type="submit" value="submit" name="submit"></form>'
+)
+
+INDEX_PAGE = '<html><body>' + NAME_FORM + '</body></html>'
+
+# keeps the first paragraph, the user's status, up to date from the
+# server-sent events of 'events' (see `server.auth_stream()`)
+STATUS_SCRIPT = (
+    '<script>'
+    'var line = document.getElementsByTagName("p")[0];'
+    'var source = new EventSource("events?username=" + encodeURIComponent(line.dataset.user));'
+    'function show(e) {'
+    'var authorized = JSON.parse(e.data).authorized;'
+    'line.style.color = authorized ? "#00FF00" : "#FF0000";'
+    'line.textContent = "User " + line.dataset.user + " is " + (authorized ? "" : "not ") + "authorized";'
+    '}'
+    'source.addEventListener("status", show);'
+    'source.addEventListener("authorized", show);'
+    'source.addEventListener("expired", show);'
+    '</script>'
+)
+
+# the replies to the 'checkname' form; static text containing braces
+# must be doubled, as in any format string
+_NOT_FOUND = (
+    '<html><body>' + NAME_FORM
+    + '<p style="color: #FF0000">User {user} not found</p></body></html>'
+)
+_STATUS = (
+    '<html><body>' + NAME_FORM
+    + '<p style="color: {color}" data-user="{user}">User {user} is {status}</p>'
+    '<p style="font-size:24px; ">{identifier}</p>'
+    + STATUS_SCRIPT.replace('{', '{{').replace('}', '}}')
+    + '</body></html>'
+)
+
+
+def checkname_page(user, found, authorized=False, identifier=0):
+    """
+    Return the server's reply to the 'checkname' form for `user`: not
+    found, or whether they are authorized and their identifier.
+    """
+    user = escape(user)
+    if not found:
+        return _NOT_FOUND.format(user=user)
+    return _STATUS.format(
+        user=user,
+        color="#00FF00" if authorized else "#FF0000",
+        status="authorized" if authorized else "not authorized",
+        identifier=str(identifier).zfill(6),
+    )
+
+
+"""
+================
+Device pages
+================
+"""
+
+_MENU_HEAD = (
+    '<html><body><form action="enter_id" method="POST">'
+    '<label>Select host name:</label>'
+    '<select name="hostindex">'
+)
+_MENU_TAIL = (
+    '</select>'
+    '<input type="submit" value="submit" name="submit">'
+    '</form></body></html>'
+)
+
+_ENTER_ID = (
+    '<html><body><form action="do_auth" method="POST">'
+    '<label>Input identifier: </label>'
+    '<input type="text" name="ident">'
+    '<input type="hidden" name="hostindex" value="{index}">'
+    '<input type="submit" value="submit" name="submit"></form>'
+    '<a href="index">Select different host/user</a>'
+    '</body></html>'
+)
+
+_DO_AUTH = (
+    '<html><body>PIN sent<br>Check login page'
+    '<br><form action="enter_id" method="POST">'
+    '<input type="hidden" name="hostindex" value="{index}">'
+    '<input type="submit" value="enter new identifier" value="submit"></form>'
+    '<br><a href="index">Select different host/user</a>'
+    '</body></html>'
+)
+
+
+def menu_page(keys):
+    """
+    Return the device's page for selecting a host and user from the
+    keylist `keys`, a list of dicts with the "hostname" and "user" of
+    each host.
+    """
+    options = [
+        f'<option value="{index}"> {escape(line["hostname"])} : '
+        f'{escape(line["user"])}</option>'
+        for index, line in enumerate(keys)
+    ]
+    return _MENU_HEAD + ''.join(options) + _MENU_TAIL
+
+
+class HostMenu:
+    """
+    The page of `menu_page()`, rendered once and then served from the
+    cache, so that serving it takes the same time however many hosts
+    the device holds. It is rendered again after `invalidate()` is
+    called (when the keylist is loaded), or if the keylist is replaced
+    or grows or shrinks.
+    """
+    def __init__(self):
+        """
+        The HostMenu class initializer initializes the following
+        attributes:
+
+        - renders: Number of times the page has been rendered.
+        - _page: The rendered page, or None.
+        - _source: The identity and length of the keylist it was
+          rendered from.
+        """
+        self.renders = 0
+        self._page = None
+        self._source = None
+
+    def render(self, keys):
+        """
+        Return the page for the keylist `keys`.
+        """
+        source = (id(keys), len(keys))
+        if self._page is None or self._source != source:
+            self._page = menu_page(keys)
+            self._source = source
+            self.renders += 1
+        return self._page
+
+    def invalidate(self):
+        self._page = None
+
+
+def enter_id_page(index):
+    """
+    Return the device's page for entering the identifier shown by the
+    server, for the host at `index` in the keylist.
+    """
+    return _ENTER_ID.format(index=escape(index))
+
+
+def do_auth_page(index):
+    """
+    Return the device's page saying that the PIN was sent to the host
+    at `index` in the keylist.
+    """
+    return _DO_AUTH.format(index=escape(index))
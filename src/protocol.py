@@ -0,0 +1,367 @@
+"""
+2D2FA Binary Protocol
+
+A compact framing for PIN submissions and their results, used instead
+of the JSON messages when a device asks for it (see `send_message()` in
+`deviceutils`). The server answers each request in the framing it was
+sent in, so devices using either framing can share a server and even a
+connection.
+
+A JSON message starts with the length of its JSON header, a big-endian
+uint16. A binary frame starts with the two bytes `MAGIC` instead, which
+read as a length would be 45818 bytes, far longer than the
+MAX_JSONHEADER_SIZE bytes a JSON header may take up. The frame header
+is followed by the body (all integers big-endian):
+
+- frame header: `MAGIC`, the kind of frame (uint8), flags (uint8), the
+  request ID (uint32) and the length of the body (uint16).
+- PIN body (`KIND_PIN`): the length of the user's name (uint8), the
+  UTF-8 encoded name and the 32 byte SHA-256 digest that makes up the
+  PIN (rather than its 64 hex digits).
+- result body (`KIND_RESULT`): one byte, the index of the result in
+  `RESULTS`.
+
+Both sides read messages of either kind into a `RecvBuffer`, and queue
+the messages they send in a `SendQueue`.
+"""
+
+import os
+import socket
+import struct
+from collections import deque
+
+
+MAGIC = b"\xb2\xfa"
+FRAME = struct.Struct(">2sBBIH")
+
+# the length of the JSON header at the start of a JSON message
+PROTOHEADER = struct.Struct(">H")
+
+# kinds of frame
+KIND_PIN = 1
+KIND_RESULT = 2
+
+# flags
+FLAG_KEEP_ALIVE = 0x01  # keep the connection open for further requests
+FLAG_REQUEST_ID = 0x02  # the request ID was set by the device
+
+DIGEST_SIZE = 32
+
+# results, as in the "result" of a JSON response, by their code
+RESULTS = (
+    "Authorization granted.",
+    "Authentication failed.",
+    "Error: invalid request.",
+)
+RESULT_CODES = {result: code for code, result in enumerate(RESULTS)}
+RESULT_ERROR = 2
+
+# largest JSON header and message content (or frame body) accepted, in
+# bytes; a peer sending a larger one is disconnected
+MAX_JSONHEADER_SIZE = 4096
+MAX_CONTENT_SIZE = 64 * 1024
+
+# a `RecvBuffer` reads at least this many bytes at a time, and holds at
+# most RECV_BUFFER_LIMIT bytes that haven't been processed yet (e.g.
+# requests pipelined on a keep-alive connection)
+RECV_CHUNK = 4096
+RECV_BUFFER_LIMIT = 256 * 1024
+
+# most buffers a `SendQueue` hands to one `sendmsg()` call
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+# `socket.sendmsg()` isn't available on every platform (e.g. Windows), a
+# `SendQueue` falls back to sending one buffer at a time with `send()`
+HAVE_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+
+def is_frame(data):
+    """
+    Return True if `data` (bytes or a `RecvBuffer`), the start of a
+    message, is a binary frame rather than a JSON message. At least two
+    bytes are needed to tell.
+    """
+    return data.startswith(MAGIC)
+
+
+def pack_frame(kind, body, request_id=None, keep_alive=False):
+    """
+    Return a frame of the given kind carrying `body`, tagged with
+    `request_id` (an integer) if it isn't None.
+    """
+    flags = 0
+    if keep_alive:
+        flags |= FLAG_KEEP_ALIVE
+    if request_id is not None:
+        flags |= FLAG_REQUEST_ID
+    else:
+        request_id = 0
+    return FRAME.pack(MAGIC, kind, flags, request_id, len(body)) + body
+
+
+def unpack_frame(data):
+    """
+    Unpack the frame header at the start of `data`. Return the kind of
+    frame, whether the connection is kept alive, the request ID (or
+    None) and the length of the body.
+    """
+    magic, kind, flags, request_id, length = FRAME.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a binary frame.")
+    if length > MAX_CONTENT_SIZE:
+        raise ValueError(f"Frame body of {length} bytes is too large.")
+    if not flags & FLAG_REQUEST_ID:
+        request_id = None
+    return kind, bool(flags & FLAG_KEEP_ALIVE), request_id, length
+
+
+def pack_pin(user, pin):
+    """
+    Return the body of a PIN frame for `user` and `pin`, the hex digest
+    made by `device.generate_pin()`.
+    """
+    user_b = user.encode('utf-8')
+    if len(user_b) > 255:
+        raise ValueError("User name too long for a binary frame.")
+    digest = bytes.fromhex(pin)
+    if len(digest) != DIGEST_SIZE:
+        raise ValueError("Invalid PIN for a binary frame.")
+    return bytes((len(user_b),)) + user_b + digest
+
+
+def unpack_pin(body):
+    """
+    Return the user and the PIN (as a hex digest, as checked by
+    `serverutils.check_pin()`) carried by the body of a PIN frame.
+    """
+    user_len = body[0]
+    if len(body) != 1 + user_len + DIGEST_SIZE:
+        raise ValueError("Invalid PIN frame.")
+    user = bytes(body[1:1 + user_len]).decode('utf-8')
+    return user, body[1 + user_len:].hex()
+
+
+def pack_result(result):
+    """
+    Return the body of a result frame for `result`, one of `RESULTS`.
+    """
+    return bytes((RESULT_CODES.get(result, RESULT_ERROR),))
+
+
+def unpack_result(body):
+    """
+    Return the result carried by the body of a result frame.
+    """
+    if len(body) != 1 or body[0] >= len(RESULTS):
+        raise ValueError("Invalid result frame.")
+    return RESULTS[body[0]]
+
+
+class RecvBuffer:
+    """
+    A buffer that data is received into, and messages parsed out of,
+    without copying the data already received each time more arrives.
+    Data is read with `socket.recv_into()` straight into the free space
+    at the end of a reusable `bytearray`, and consuming a message just
+    moves the start of the unprocessed data forward. The unprocessed
+    data is only moved back to the front of the buffer (compacted) when
+    the free space runs low, and the buffer only grows if a message
+    doesn't fit, up to `limit` bytes.
+    """
+    def __init__(self, size=RECV_CHUNK, limit=RECV_BUFFER_LIMIT):
+        """
+        The RecvBuffer class initializer initializes the following
+        attributes:
+
+        - limit: The most unprocessed data the buffer holds, in bytes.
+        - _buf: The bytearray data is received into.
+        - _start, _end: The start and end of the unprocessed data.
+        """
+        self.limit = limit
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def startswith(self, prefix):
+        return self._buf.startswith(prefix, self._start, self._end)
+
+    def _reserve(self, size):
+        """
+        Make room for at least `size` more bytes after the unprocessed
+        data, compacting or growing the buffer if needed.
+        """
+        if len(self._buf) - self._end >= size:
+            return
+        length = self._end - self._start
+        if length + size > self.limit:
+            raise ValueError(
+                f"More than {self.limit} bytes received but not processed."
+            )
+        if self._start:
+            self._buf[:length] = self._buf[self._start:self._end]
+            self._start = 0
+            self._end = length
+        if len(self._buf) - self._end < size:
+            grow = max(length + size, 2 * len(self._buf))
+            self._buf.extend(bytes(min(grow, self.limit) - len(self._buf)))
+
+    def recv_from(self, sock):
+        """
+        Receive data from `sock` into the free space at the end of the
+        buffer. Return the number of bytes received (0 if the peer
+        closed the connection).
+        """
+        room = self.limit - len(self)
+        if not room:
+            raise ValueError(
+                f"More than {self.limit} bytes received but not processed."
+            )
+        self._reserve(min(RECV_CHUNK, room))
+        with memoryview(self._buf) as buf, buf[self._end:] as view:
+            received = sock.recv_into(view)
+        self._end += received
+        return received
+
+    def release(self):
+        """
+        Drop the buffer's memory and any unprocessed data, once its
+        connection is closed. It grows again if more data is received.
+        """
+        self._buf = bytearray()
+        self._start = 0
+        self._end = 0
+
+    def feed(self, data):
+        """
+        Add `data` to the end of the buffer, as if it had been received.
+        """
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def unpack(self, fmt):
+        """
+        Unpack the `struct.Struct` `fmt` from the start of the
+        unprocessed data, and consume it. Return the unpacked values.
+        """
+        values = fmt.unpack_from(self._buf, self._start)
+        self.consume(fmt.size)
+        return values
+
+    def view(self, size):
+        """
+        Return a memoryview of the next `size` bytes of unprocessed data,
+        without consuming them. The view must be released (e.g. with a
+        `with` statement) before more data is received.
+        """
+        with memoryview(self._buf) as buf:
+            return buf[self._start:self._start + size]
+
+    def take(self, size):
+        """
+        Consume the next `size` bytes of unprocessed data and return
+        them as bytes.
+        """
+        data = bytes(self._buf[self._start:self._start + size])
+        self.consume(size)
+        return data
+
+    def consume(self, size):
+        """
+        Mark the next `size` bytes as processed.
+        """
+        self._start += size
+        if self._start >= self._end:
+            # nothing left, start again from the front of the buffer
+            self._start = self._end = 0
+
+
+class SendQueue:
+    """
+    A queue of buffers (e.g. the parts of several messages) waiting to
+    be sent. The queued buffers are sent together with `socket.sendmsg()`
+    (gather I/O, like writev), so that the parts of a message, or the
+    responses to several pipelined requests, go out in one system call
+    without first being joined into a new bytes object. A partial send
+    only moves an offset into the first buffer, rather than copying the
+    rest.
+    """
+    def __init__(self):
+        """
+        The SendQueue class initializer initializes the following
+        attributes:
+
+        - _buffers: The queued buffers, oldest first.
+        - _offset: How much of the first buffer has been sent.
+        - _size: The number of bytes still to send.
+        """
+        self._buffers = deque()
+        self._offset = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, buffer):
+        """
+        Queue a bytes-like `buffer` for sending.
+        """
+        if buffer:
+            self._buffers.append(buffer)
+            self._size += len(buffer)
+
+    def extend(self, buffers):
+        """
+        Queue each of `buffers` for sending.
+        """
+        for buffer in buffers:
+            self.append(buffer)
+
+    def send_to(self, sock):
+        """
+        Send as much of the queued data to `sock` as it will take in one
+        call. Return the number of bytes sent.
+        """
+        if not self._buffers:
+            return 0
+        with memoryview(self._buffers[0]) as first, \
+                first[self._offset:] as head:
+            if HAVE_SENDMSG and len(self._buffers) > 1:
+                buffers = [head]
+                for i in range(1, min(len(self._buffers), IOV_MAX)):
+                    buffers.append(self._buffers[i])
+                sent = sock.sendmsg(buffers)
+            else:
+                sent = sock.send(head)
+        self._advance(sent)
+        return sent
+
+    def drain(self):
+        """
+        Remove every queued buffer (less what has been sent of the
+        first) and return them, e.g. to hand them to an asyncio
+        transport, which queues data itself.
+        """
+        buffers = list(self._buffers)
+        if buffers and self._offset:
+            buffers[0] = memoryview(buffers[0])[self._offset:]
+        self._buffers.clear()
+        self._offset = 0
+        self._size = 0
+        return buffers
+
+    def _advance(self, sent):
+        """
+        Drop the `sent` bytes from the front of the queue.
+        """
+        self._size -= sent
+        sent += self._offset
+        while self._buffers and sent >= len(self._buffers[0]):
+            sent -= len(self._buffers.popleft())
+        self._offset = sent
@@ -14,13 +14,25 @@ https://realpython.com/python-sockets/
 
 
 import sys
+import argparse
+import multiprocessing
+import signal
 import socket
 import selectors
 import traceback
 import time
+import heapq
+import itertools
+import json
+from collections import deque
+import logging
 import threading
-from threading import Thread, RLock
+from threading import Thread
 import serverutils
+import statebackend
+import events
+import webserve
+import pages
 import flask
 from flask import Flask, redirect, url_for, request
 
@@ -28,8 +40,7 @@ from flask import Flask, redirect, url_for, request
 # the Flask app instance
 app = Flask(__name__)
 
-# lock used by the auth_listen thread
-lock = RLock()
+log = logging.getLogger("server")
 
 # set to True to show connection and message info, False to hide
 DEBUG = False
@@ -49,21 +60,166 @@ MIN_TIME = 30
 # time between server ticks in seconds
 TICK = 1
 
+# maximum number of entries in the "authorized" and "identifier" lists;
+# when a list is full, the entry closest to expiring is evicted
+AUTH_CAPACITY = 1_000_000
+IDENT_CAPACITY = 1_000_000
+
+# maximum number of expired entries removed from each list per server
+# tick; any others are removed on later ticks (and are already treated
+# as missing when read)
+SWEEP_LIMIT = 10_000
+
+# most users in one bulk request (see `BULK_REQUESTS`)
+MAX_BULK_USERS = 10_000
+
+# number of independently locked shards the "authorized" and "identifier"
+# lists are split into, so that the Flask and auth_listen threads only
+# wait on each other when working on users in the same shard
+STATE_SHARDS = 16
+
+# SQLite file holding the server's lists with --backend sqlite, through
+# which the worker processes share them when running with --workers
+STATE_FILE = "server_state.db"
+
+# set to True to precompute each user's expected PINs when their
+# identifier is issued (see `serverutils.PinTable`), so that checking a
+# PIN is a lookup instead of hashing on the request path
+PRECOMPUTE_PINS = False
+
+# most PIN table entries rolled forward to a new time slice per server
+# tick (see `serverutils.PinTable.roll()`); the rest are rolled on later
+# ticks, and their PINs are hashed when checked until then
+ROLL_LIMIT = 1_000
+
+# where PINs are verified (see `serverutils.Verifier`): "inline" on the
+# auth_listen thread, or on a "thread" or "process" pool so that hashing
+# doesn't hold up the socket I/O
+VERIFIER = "inline"
+
+# number of verifier pool workers (None lets the pool choose)
+VERIFY_WORKERS = None
+
+# how long, in seconds, a keep-alive connection may sit idle between
+# requests before the server closes it
+KEEPALIVE_TIMEOUT = 30
+
+# how long, in seconds, a device has to send a request in full and read
+# its response, from when the request started arriving (or it
+# connected), before the server closes the connection
+REQUEST_TIMEOUT = 10
+
+# most device connections open at once (in each worker process with
+# --workers); at the limit, the server stops accepting connections until
+# some close, and new ones wait in the listen backlog
+MAX_CONNECTIONS = 10_000
+
+# most connections waiting in the listening socket's queue to be
+# accepted; once it's full, the kernel turns new ones away
+LISTEN_BACKLOG = 1024
+
+# most connections accepted each time the listening socket is ready; any
+# others waiting are accepted on the next pass of the loop, after the
+# connections already open have been served
+ACCEPT_BATCH = 64
+
+# set to True to read from a connection as soon as it is accepted, as a
+# device sends its request right after connecting, instead of waiting
+# for the next pass of the loop to find it readable
+READ_ON_ACCEPT = True
+
+# number of recent accept-to-response times kept by `LoopStats`
+LATENCY_SAMPLES = 1000
+
+# address the identifier page (the Flask app) is served on, and how: the
+# WSGI server (see `webserve.SERVERS`), and its worker processes and
+# threads; several workers need a backend they can share, like --workers
+HTTP_HOST = "127.0.0.1"
+HTTP_PORT = 5001
+HTTP_SERVER = "auto"
+HTTP_WORKERS = 1
+HTTP_THREADS = webserve.THREADS
+
+# server-sent event streams of a user's authorization (see `auth_stream()`):
+# how often (in seconds) a stream checks the "authorized" list for changes
+# made by other processes, as well as waiting for the events pushed by
+# this one (set to WORKERS_STREAM_POLL when there are several processes),
+# how often an idle stream sends a comment to keep it open, and how long
+# a stream lasts before the browser is told to reconnect after STREAM_RETRY
+# milliseconds
+STREAM_POLL = 15
+WORKERS_STREAM_POLL = 1
+STREAM_HEARTBEAT = 15
+STREAM_TIMEOUT = 300
+STREAM_RETRY = 1000
+
 sel = selectors.DefaultSelector()
 
+# the `serverutils.Verifier` that auth_listen hands PIN checks to, set up
+# in `main()`
+verifier = None
+
+# open connections to time out, a min-heap of (deadline, sequence
+# number, message), see `reap_connections()`
+deadlines = []
+deadline_numbers = itertools.count()
+
+# the socket listening for devices, and whether it is registered with
+# the selector (see `throttle_accept()`)
+listener = None
+accepting = False
+
+# the backend holding the three lists below (see `statebackend`); the
+# lists start in memory, `use_backend()` moves them to another backend
+backend = statebackend.make_backend(
+    "memory", serverutils.get_keys(), AUTH_TIMEOUT, IDENT_TIMEOUT,
+    auth_capacity=AUTH_CAPACITY, ident_capacity=IDENT_CAPACITY,
+    shards=STATE_SHARDS,
+)
+
 # "keys" list: maps users to secret keys
 # for testing purposes, is populated here
 # for production, likely would need to populate this by reading from file on startup
 # keys = {}
 # keys.update({"test_user": "test_key"})
-keys = serverutils.get_keys()
+keys = backend.keys
+
+# watches the file the keys were read from, so that changes to it are
+# applied without a restart: read and diffed on the reloader's thread,
+# and applied by `reload_keys()`
+key_watcher = serverutils.KeyWatcher(serverutils.keys_path())
+key_reloader = serverutils.KeyReloader(key_watcher, keys)
+
+# whether this process writes the changes to the key file into a key
+# table shared with other processes; with --workers only the first
+# worker does, the others only drop what they cached of the changed keys
+# (an HMAC context built from a key about to change is rebuilt once the
+# key in the table differs from it)
+write_keys = True
+
+# key stores replaced by a reload, as `(when, store)`, closed by
+# `reload_keys()` once a PIN check or page still reading one is done
+retired_keys = deque()
 
 # "authorized" list: maps username to time of authorization
-auth = {}
+# entries expire AUTH_TIMEOUT seconds after authorization, see `timeout_auth()`
+auth = backend.auth
+
+# "identifier" list: maps username to a `serverutils.Identifier`, the
+# identifier and the time it was issued
+# { username : (identifier, issued) }
+# entries expire IDENT_TIMEOUT seconds after being issued, see `timeout_id()`
+ident = backend.ident
 
-# "identifier" list: maps username to an array containing an identifier and timeout
-# { username : [identifier, timeout]
-ident = {}
+# publishes an "authorized" event when a PIN authorizes a user (see
+# `serverutils.auth_events`) and an "expired" event when the
+# authorization expires, to the streams of `auth_stream()`
+auth_events = events.Broker()
+serverutils.auth_events = auth_events
+
+# each open stream holds a thread of the WSGI server, so at most half of
+# them may be streams, leaving the rest for the pages (set in `main()`)
+stream_slots = threading.BoundedSemaphore(max(1, HTTP_THREADS // 2))
 
 
 """
@@ -78,11 +234,8 @@ def index():
     generate HTML for the index, call the code to get the drop down menu
     for user selection
     """
-    print("Index called")
-    r = name_request_text()
-    r += '</body></html>'
-    print("Index response: ", r)
-    return r
+    log.debug("Index called")
+    return pages.INDEX_PAGE
 
 
 @app.route('/checkname', methods = ["POST", "GET"])
@@ -91,45 +244,76 @@ def checkname():
     generate the html code for the 'checkname' form in the client-side
     web form. 
     """
-    print("Checkname called")
+    log.debug("Checkname called")
     if request.method == "POST":
         target_name = request.form["username"]
     else:
         target_name = request.args.get("username")
-    r = name_request_text()
-    if target_name not in keys.keys():
-        r += '<p style="color: #FF0000">User ' + target_name + ' not found</p>'
-    else:
-        # user exists, state if they are authenticated
-        if target_name in auth.keys():
-            r+= '<p style="color: #00FF00">User ' + target_name + ' is authorized</p>'
-        else:
-            r+= '<p style="color: #FF0000">User ' + target_name + ' is not authorized</p>'
-        # get an identifier
-        expire = int(time.time()) - IDENT_TIMEOUT + MIN_TIME
-        with lock:
-            r_id = 0
-            # first check if identifier exists
-            if target_name in ident.keys():
-                # check it hasn't expired, generate new
-                if ident[target_name][1] > expire:
-                    r_id = ident[target_name][0]
-                else:
-                    r_id = make_new_key(target_name)
-            else:
-                r_id = make_new_key(target_name)
-        r += '<p style="font-size:24px; ">' + str(r_id).zfill(6) + '</p>'
-    r += '</body></html>'
-    print("Checkname response: ", r)
+    r = checkname_text(target_name)
+    log.debug("Checkname response: %s", r)
     return r
 
 
+@app.route('/events')
+def auth_events_stream():
+    """
+    stream server-sent events telling a relying page when the user is
+    authorized, and when the authorization expires, instead of the page
+    re-submitting 'checkname' until it is.
+    """
+    target_name = request.args.get("username")
+    if target_name not in keys:
+        # plain text, so that the name isn't rendered as HTML
+        return flask.Response(
+            f"User {target_name} not found", 404, mimetype="text/plain"
+        )
+    if not stream_slots.acquire(blocking=False):
+        return 'Too many streams, try again later', 503
+    response = flask.Response(
+        auth_stream(target_name), mimetype="text/event-stream"
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.call_on_close(stream_slots.release)
+    return response
+
+
+@app.route('/auth_status', methods = ["POST", "GET"])
+@app.route('/issue_identifier', methods = ["POST"])
+def bulk():
+    """
+    answer a relying application's request about many users at once
+    with compact JSON (see `BULK_REQUESTS`). The users are POSTed as a
+    JSON list (or {"users": [...]}), or, to the requests in `BULK_READS`,
+    given as 'username' parameters of a GET.
+    """
+    if request.method == "POST":
+        users = bulk_users(request.get_json(force=True, silent=True))
+    else:
+        users = request.args.getlist("username")
+    status, text = bulk_reply(request.path, users)
+    return app.response_class(text, status, mimetype="application/json")
+
+
 """
 ================
 Code
 ================
 """
 
+def checkname_text(target_name):
+    """
+    generate the HTML reply to the 'checkname' form: whether the user is
+    authorized, and their identifier, issuing a new one if needed.
+    """
+    if target_name is None or target_name not in keys:
+        return pages.checkname_page(target_name or "", False)
+    # user exists, state if they are authenticated, and get an identifier
+    authorized = target_name in auth
+    return pages.checkname_page(
+        target_name, True, authorized, issue_identifier(target_name)
+    )
+
+
 def make_new_key(uname):
     """
     add the identifier and the time that identifier was generated to the 
@@ -137,20 +321,224 @@ def make_new_key(uname):
     """
     nid = serverutils.generate_identifier()
     newtime = int(time.time())
-    ident.update({uname: [nid, newtime]})
+    ident.update({uname: serverutils.Identifier(nid, newtime)})
+    precompute_pins(uname, nid)
     return nid
 
 
-def name_request_text():
+def issue_identifier(uname):
+    """
+    Get the user's identifier, generating a new one if they have none
+    or if it expires in less than MIN_TIME seconds. The check and the
+    update are done atomically, holding only the lock of the user's
+    shard of the identifier list.
+    """
+    return issue_identifier_entry(uname).identifier
+
+
+def issue_identifier_entry(uname):
     """
-    function generates the opening text common to all HTML replies: a
-    drop down form where the user selects who they are logging in as.
+    As `issue_identifier()`, but return the user's entry in the
+    identifier list, with the time it was issued.
     """
-    resp = '<html><body><form action="checkname" mothod="POST">'
-    resp += '<label>Input user name: </label>'
-    resp += '<input type="text" name="username">'
-    resp += '<input type="submit" value="submit" name="submit"></form>'
-    return resp
+    expire = int(time.time()) - IDENT_TIMEOUT + MIN_TIME
+    entry, issued = ident.get_or_set(
+        uname,
+        lambda current: current.issued > expire,
+        lambda: serverutils.Identifier(
+            serverutils.generate_identifier(), int(time.time())
+        ),
+    )
+    if issued:
+        precompute_pins(uname, entry.identifier)
+    return entry
+
+
+def issue_identifier_request(request):
+    """
+    Answer an "issue_identifier" request, sent over the TCP protocol by
+    a relying application instead of going through the HTML form: the
+    user's identifier, issued as by `issue_identifier()`, and when (in
+    seconds since epoch) it expires.
+    """
+    user = request.get("user")
+    if not isinstance(user, str) or user not in keys:
+        return {"result": f"Error: user {user!r} not found."}
+    entry = issue_identifier_entry(user)
+    return {
+        "result": "Identifier issued.",
+        "user": user,
+        "identifier": entry.identifier,
+        "expires": entry.issued + IDENT_TIMEOUT,
+    }
+
+
+def auth_status_request(request):
+    """
+    Answer an "auth_status" request: whether the user is authorized,
+    and until when (in seconds since epoch).
+    """
+    user = request.get("user")
+    if not isinstance(user, str) or user not in keys:
+        return {"result": f"Error: user {user!r} not found."}
+    return auth_status(user, auth.get(user))
+
+
+def auth_status(user, authorized):
+    """
+    Return the status of a user authorized at the time `authorized` (or
+    not, if None), as sent in answer to an "auth_status" request and in
+    the events of `auth_stream()`.
+    """
+    return {
+        "result": "Authorized." if authorized is not None else "Not authorized.",
+        "user": user,
+        "authorized": authorized is not None,
+        "expires": None if authorized is None else authorized + AUTH_TIMEOUT,
+    }
+
+
+def bulk_auth_status(users):
+    """
+    Return the authorization status of each of `users` (a list of user
+    names), read from the "authorized" list in one pass: whether they
+    are authorized and, if they are, when that expires and how many
+    seconds are left ("ttl"). Unknown users map to None.
+    """
+    now = int(time.time())
+    results = dict.fromkeys(users)
+    known = [user for user in results if user in keys]
+    authorized = auth.get_many(known)
+    for user in known:
+        stamp = authorized.get(user)
+        if stamp is None:
+            results[user] = {"authorized": False}
+        else:
+            expires = stamp + AUTH_TIMEOUT
+            results[user] = {
+                "authorized": True, "expires": expires,
+                "ttl": max(0, expires - now),
+            }
+    return {"now": now, "users": results}
+
+
+def bulk_issue_identifiers(users):
+    """
+    Return the identifier of each of `users` (a list of user names), as
+    `issue_identifier()` gives it, issued or reused in one pass over the
+    identifier list: the identifier, when it expires, how many seconds
+    are left ("ttl") and whether it was newly issued ("new"). Unknown
+    users map to None.
+    """
+    now = int(time.time())
+    results = dict.fromkeys(users)
+    expire = now - IDENT_TIMEOUT + MIN_TIME
+    entries = ident.get_or_set_many(
+        [user for user in results if user in keys],
+        lambda current: current.issued > expire,
+        lambda: serverutils.Identifier(serverutils.generate_identifier(), now),
+    )
+    for user, (entry, issued) in entries.items():
+        if issued:
+            precompute_pins(user, entry.identifier)
+        expires = entry.issued + IDENT_TIMEOUT
+        results[user] = {
+            "identifier": entry.identifier, "expires": expires,
+            "ttl": max(0, expires - now), "new": issued,
+        }
+    return {"now": now, "users": results}
+
+
+# the bulk requests relying applications can make over HTTP, by path:
+# each takes a list of user names and returns a dict, sent as JSON
+BULK_REQUESTS = {
+    "/auth_status": bulk_auth_status,
+    "/issue_identifier": bulk_issue_identifiers,
+}
+
+# those that only read the lists, which can also be made with a GET;
+# issuing identifiers changes them, so it has to be POSTed
+BULK_READS = {"/auth_status"}
+
+
+def bulk_users(content):
+    """
+    Return the list of user names in the decoded JSON body of a bulk
+    request: either the list itself or {"users": [...]}.
+    """
+    if isinstance(content, dict):
+        return content.get("users")
+    return content
+
+
+def bulk_reply(path, users):
+    """
+    Answer the bulk request at `path` (see `BULK_REQUESTS`) for `users`.
+    Return the HTTP status code and the compact JSON text of the reply.
+    """
+    if not isinstance(users, list) or not all(isinstance(u, str) for u in users):
+        status, content = 400, {"error": "Expected a list of user names."}
+    elif len(users) > MAX_BULK_USERS:
+        status, content = 413, {
+            "error": f"At most {MAX_BULK_USERS} users per request."
+        }
+    else:
+        status, content = 200, BULK_REQUESTS[path](users)
+    return status, json.dumps(content, separators=(",", ":"))
+
+
+def auth_stream(user):
+    """
+    Yield the server-sent events of a stream telling a relying page about
+    the user's authorization: a "status" event with their status (as in
+    an "auth_status" request), then an "authorized" event whenever a PIN
+    authorizes them and an "expired" event when that expires. Events are
+    pushed by `auth_events`; the "authorized" list is also checked every
+    STREAM_POLL seconds, for changes made by other processes. The stream
+    ends after STREAM_TIMEOUT seconds, and the browser reconnects.
+    """
+    with events.Subscription(auth_events, user) as subscription:
+        status = auth_status_request({"user": user})
+        authorized = status["authorized"]
+        yield events.format_event("status", status, retry=STREAM_RETRY)
+        now = written = time.monotonic()
+        end = now + STREAM_TIMEOUT
+        while now < end:
+            event = subscription.get(timeout=min(STREAM_POLL, end - now))
+            now = time.monotonic()
+            if event is not None:
+                name, stamp = event
+                status = auth_status(user, stamp)
+            else:
+                status = auth_status_request({"user": user})
+                name = "authorized" if status["authorized"] else "expired"
+                if status["authorized"] == authorized:
+                    name = None
+            if name is not None:
+                authorized = status["authorized"]
+                yield events.format_event(name, status)
+                written = now
+            elif now - written >= STREAM_HEARTBEAT:
+                yield events.format_comment("keep-alive")
+                written = now
+
+
+# answer these requests over the TCP protocol (see `serverutils.ACTIONS`)
+serverutils.ACTIONS.update({
+    "issue_identifier": issue_identifier_request,
+    "auth_status": auth_status_request,
+})
+
+
+def precompute_pins(uname, nid):
+    """
+    Add a newly issued identifier to the PIN table, if PINs are being
+    precomputed (see PRECOMPUTE_PINS).
+    """
+    if serverutils.pin_table is not None:
+        key = serverutils.get_key(uname, keys)
+        if key is not None:
+            serverutils.pin_table.add(uname, nid, key)
 
 
 def timeout_auth():
@@ -160,14 +548,11 @@ def timeout_auth():
     times (e.g., we could allow identifiers to be valid for 30 seconds,
     and allow authorizing the user's logins for the next 5 minutes,
     etc.)
+    Only the authorizations that have expired are touched, so this is
+    cheap to run on every server tick.
     """
-    expire = int(time.time()) - AUTH_TIMEOUT
-    with lock:
-        for x in auth.copy():
-            # print("Checking ", x, " ", auth[x], " against time ", expire)
-            if auth[x] < expire:
-                # print(x, " has expired!")
-                auth.pop(x)
+    for user in auth.expire(int(time.time()), SWEEP_LIMIT):
+        auth_events.publish(user, "expired")
 
 
 def timeout_id():
@@ -176,50 +561,382 @@ def timeout_id():
     each identifier an expiration time, and renders them useless once 
     the timer expires, requiring the user to request a new identifier.
     """
-    expire = int(time.time()) - IDENT_TIMEOUT
-    with lock:
-        for y in ident.copy():
-            if ident[y][1] < expire:
-                ident.pop(y)
+    ident.expire(int(time.time()), SWEEP_LIMIT)
+
+
+def reload_keys():
+    """
+    Apply the changes to the key file found by `key_reloader` to the
+    "keys" list, without restarting. The file is read and diffed on the
+    reloader's thread; here, only the users whose keys were added,
+    changed or removed are updated (see `serverutils.apply_key_changes()`),
+    and only their cached HMAC contexts and precomputed PINs are dropped.
+    A key store replaced as a whole is closed REQUEST_TIMEOUT seconds
+    later, by when nothing should be reading it any more.
+    """
+    global keys
+    updates = key_reloader.updates()
+    now = time.monotonic()
+    for update in updates:
+        old = keys
+        keys = backend.keys = serverutils.apply_key_changes(
+            keys, update, write=write_keys
+        )
+        if keys is not old and hasattr(old, "close"):
+            retired_keys.append((now, old))
+        print(f"Reloaded keys: {len(update.changed)} added or changed, "
+              f"{len(update.removed)} removed")
+    if updates:
+        verifier.set_keys(keys)
+    while retired_keys and retired_keys[0][0] <= now - REQUEST_TIMEOUT:
+        retired_keys.popleft()[1].close()
+
+
+class LoopStats:
+    """
+    Counters of the work done by the `auth_listen()` loop, to measure
+    how it copes with load: how many events and new connections each
+    pass handles, how many requests are read in full as soon as their
+    connection is accepted, and how long connections wait from being
+    accepted to having their first response created.
+    """
+    def __init__(self, samples=LATENCY_SAMPLES):
+        """
+        The LoopStats class initializer initializes the following
+        attributes:
+
+        - passes: Passes of the loop.
+        - events: Selector events handled.
+        - accepted: Connections accepted.
+        - accept_passes: Passes that accepted at least one connection.
+        - max_accepted: Most connections accepted in one pass.
+        - read_on_accept: Requests read in full as soon as their
+          connection was accepted.
+        - latencies: The most recent accept-to-first-response times, in
+          seconds.
+        """
+        self.passes = 0
+        self.events = 0
+        self.accepted = 0
+        self.accept_passes = 0
+        self.max_accepted = 0
+        self.read_on_accept = 0
+        self.latencies = deque(maxlen=samples)
+
+    def reset(self):
+        self.__init__(self.latencies.maxlen)
+
+    def record_pass(self, events, accepted):
+        self.passes += 1
+        self.events += events
+        if accepted:
+            self.accepted += accepted
+            self.accept_passes += 1
+            self.max_accepted = max(self.max_accepted, accepted)
+
+    def record_response(self, message):
+        """
+        Record the time a connection waited for its first response.
+        """
+        if message.requests_served == 1:
+            self.latencies.append(time.monotonic() - message.connected)
+
+    def snapshot(self):
+        """
+        Return a dict of the counters, with the mean events per pass,
+        the mean connections accepted per accepting pass and the
+        median, 99th percentile and largest recent accept-to-response
+        times in milliseconds.
+        """
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            i = min(len(latencies) - 1, int(len(latencies) * p / 100))
+            return latencies[i] * 1000
+
+        return {
+            "passes": self.passes,
+            "events": self.events,
+            "events_per_pass": self.events / self.passes if self.passes else 0,
+            "accepted": self.accepted,
+            "accepted_per_pass": (self.accepted / self.accept_passes
+                                  if self.accept_passes else 0),
+            "max_accepted": self.max_accepted,
+            "read_on_accept": self.read_on_accept,
+            "latency_p50_ms": percentile(50),
+            "latency_p99_ms": percentile(99),
+            "latency_max_ms": percentile(100),
+        }
+
+
+# the statistics of this process's `auth_listen()` loop
+loop_stats = LoopStats()
 
 
 def accept_wrapper(sock):
     """
-    Accept the socket connection from the device, get the message, and
-    register it with the selector
+    Accept the connections from devices waiting on the listening socket,
+    up to ACCEPT_BATCH of them (or until MAX_CONNECTIONS are open), and
+    register them with the selector. Return their messages.
     """
-    conn, addr = sock.accept()  # Should be ready to read
-    if DEBUG:
-        print(f"Accepted connection from {addr}")
-    conn.setblocking(False)
-    message = serverutils.Message(sel, conn, addr)
-    sel.register(conn, selectors.EVENT_READ, data=message)
+    messages = []
+    while accepting and len(messages) < ACCEPT_BATCH:
+        try:
+            conn, addr = sock.accept()
+        except (BlockingIOError, ConnectionAbortedError):
+            # the backlog is empty (or the connection was reset first)
+            break
+        except OSError as e:
+            # e.g. out of file descriptors; try again on the next pass
+            print(f"Main: Error: accept() failed: {e!r}")
+            break
+        if DEBUG:
+            print(f"Accepted connection from {addr}")
+        conn.setblocking(False)
+        message = serverutils.Message(sel, conn, addr)
+        sel.register(conn, selectors.EVENT_READ, data=message)
+        watch_deadline(message)
+        messages.append(message)
+        throttle_accept()
+    return messages
+
+
+def connection_count():
+    """
+    Return the number of open device connections: everything registered
+    with the selector but the verifier and the listening socket.
+    """
+    return len(sel.get_map()) - 1 - (1 if accepting else 0)
+
+
+def throttle_accept():
+    """
+    Stop accepting connections once MAX_CONNECTIONS are open, by taking
+    the listening socket out of the selector, and start again once some
+    have closed. In the meantime new connections wait in the listen
+    backlog, and once that is full the kernel turns them away, so a
+    flood of connections can't slow down the ones being served.
+    """
+    global accepting
+    count = connection_count()
+    if accepting and count >= MAX_CONNECTIONS:
+        sel.unregister(listener)
+        accepting = False
+        if DEBUG:
+            print(f"{count} connections open, pausing accept")
+    elif not accepting and count < MAX_CONNECTIONS:
+        sel.register(listener, selectors.EVENT_READ, data=None)
+        accepting = True
+
+
+def watch_deadline(message):
+    """
+    Start timing out a new connection, so that `reap_connections()`
+    closes it once it is past its deadline. Entries of connections that
+    have closed are dropped from the heap once they outnumber the open
+    connections, rather than kept until their deadline.
+    """
+    global deadlines
+    if len(deadlines) > 2 * connection_count() + 64:
+        deadlines = [entry for entry in deadlines if entry[2].sock is not None]
+        heapq.heapify(deadlines)
+    deadline = message.deadline(REQUEST_TIMEOUT, KEEPALIVE_TIMEOUT)
+    heapq.heappush(deadlines, (deadline, next(deadline_numbers), message))
+
+
+def reap_connections():
+    """
+    Close the connections past their deadline (see
+    `serverutils.Message.deadline()`): keep-alive connections idle for
+    KEEPALIVE_TIMEOUT seconds, and devices that took more than
+    REQUEST_TIMEOUT seconds to send a request or read its response.
+    Every open connection has one entry in the `deadlines` heap;
+    connections that got further since their entry was pushed are
+    pushed back with their new deadline.
+    """
+    now = time.monotonic()
+    while deadlines and deadlines[0][0] <= now:
+        deadline, key, message = heapq.heappop(deadlines)
+        if message.sock is None:
+            continue
+        deadline = message.deadline(REQUEST_TIMEOUT, KEEPALIVE_TIMEOUT)
+        if deadline is None:
+            # waiting on the verifier, not the device
+            deadline = now + REQUEST_TIMEOUT
+        elif deadline <= now:
+            if DEBUG:
+                print(f"Closing timed out connection to {message.addr}")
+            message.close()
+            continue
+        heapq.heappush(deadlines, (deadline, key, message))
+
+
+def respond_ready(messages):
+    """
+    Create the responses for every message whose request became ready
+    in one pass of the selector loop. The PINs of all of them are
+    handed to the verifier as one batch; their responses are created by
+    `finish_verified()` once the results are back.
+    """
+    pending = []
+    for message in messages:
+        try:
+            req = message.pin_request()
+        except Exception:
+            print(
+                f"Main: Error: Exception for {message.addr}:\n"
+                f"{traceback.format_exc()}"
+            )
+            message.close()
+            continue
+        if req is None:
+            finish_response(message, None)
+        else:
+            message.verifying = True
+            pending.append((message, req))
+    if pending:
+        verifier.submit(
+            [req for message, req in pending], ident, keys,
+            [message for message, req in pending]
+        )
+
+
+def finish_verified():
+    """
+    Create the responses for the batches of PINs the verifier has
+    finished checking. The authorizations granted by a batch are written
+    to the "authorized" list together (see `batch()` on the stores).
+    Return the messages that were answered.
+    """
+    answered = []
+    for messages, future in verifier.completed():
+        try:
+            results = future.result()
+        except Exception:
+            print(f"Main: Error: Exception verifying PINs:\n"
+                  f"{traceback.format_exc()}")
+            results = [False] * len(messages)
+        with auth.batch():
+            for message, verified in zip(messages, results):
+                message.verifying = False
+                # the connection may have been closed while the PIN was checked
+                if message.sock is not None:
+                    finish_response(message, verified)
+                    answered.append(message)
+    return answered
+
+
+def is_ready(message):
+    """
+    Return True if a message's request has been received in full and
+    is waiting for its response to be created.
+    """
+    return (message.sock is not None and message.request is not None
+            and not message.response_created and not message.verifying)
+
+
+def finish_response(message, verified):
+    """
+    Create the response for a message, closing it if that fails.
+    """
+    try:
+        message.create_response(auth, ident, keys, verified)
+    except Exception:
+        print(
+            f"Main: Error: Exception for {message.addr}:\n"
+            f"{traceback.format_exc()}"
+        )
+        message.close()
+        return
+    loop_stats.record_response(message)
+
+
+def process_events(message, mask):
+    """
+    Process a message's selector events, closing it if that fails.
+    Return True if its request is then ready to be answered.
+    """
+    try:
+        message.process_events(mask, auth, ident, keys)
+    except Exception:
+        print(
+            f"Main: Error: Exception for {message.addr}:\n"
+            f"{traceback.format_exc()}"
+        )
+        message.close()
+        return False
+    return is_ready(message)
 
 
 def auth_listen():
     """
     thread that listens for user authentication, and calls to process a
-    message's events.
+    message's events, one `listen_pass()` after another.
     """
     while True:
-        events = sel.select(timeout=TICK)
-        for key, mask in events:
-            if key.data is None:
-                accept_wrapper(key.fileobj)
-            else:
-                message = key.data
-                try:
-                    message.process_events(mask, auth, ident, keys)
-                except Exception:
-                    print(
-                        f"Main: Error: Exception for {message.addr}:\n"
-                        f"{traceback.format_exc()}"
-                    )
-                    message.close()
-        # server "tick" actions go here
-        # set timeout to some small value above
-        # print("Tick!")
-        timeout_auth()
+        listen_pass()
+
+
+def listen_pass(timeout=TICK):
+    """
+    One pass of the `auth_listen()` loop: wait up to `timeout` seconds
+    for events and process them. Requests that are completely read in
+    one pass are answered together by `respond_ready()`, and the
+    responses are completed here as the verifier finishes checking
+    their PINs.
+    """
+    events = sel.select(timeout=timeout)
+    ready = []
+    accepted = 0
+    for key, mask in events:
+        if key.data is None:
+            messages = accept_wrapper(key.fileobj)
+            accepted += len(messages)
+            for message in messages:
+                # the request usually arrives with the connection, so
+                # it can often be read (and answered) in this pass
+                if READ_ON_ACCEPT and process_events(message, selectors.EVENT_READ):
+                    loop_stats.read_on_accept += 1
+                    ready.append(message)
+        elif key.data is verifier:
+            # woken up by a finished batch, handled below
+            continue
+        elif process_events(key.data, mask):
+            ready.append(key.data)
+    loop_stats.record_pass(len(events), accepted)
+    while True:
+        if ready:
+            respond_ready(ready)
+        answered = finish_verified()
+        # answering a request on a keep-alive connection moves on to
+        # the next pipelined request, if it was already received;
+        # answer those too, so that their responses are sent together
+        ready = [message for message in dict.fromkeys(ready + answered)
+                 if is_ready(message)]
+        if not ready:
+            break
+    # server "tick" actions go here
+    # set timeout to some small value above
+    # print("Tick!")
+    reap_connections()
+    throttle_accept()
+    tick()
+
+
+def tick():
+    """
+    The server "tick" actions: time out authorizations and identifiers,
+    apply changes to the key file, and roll the PIN table forward. Run
+    by `auth_listen()` after every pass of its loop, and on a timer by
+    the asyncio engine (see `aioserver`).
+    """
+    timeout_auth()
+    timeout_id()
+    reload_keys()
+    if serverutils.pin_table is not None:
+        serverutils.pin_table.roll(ident, limit=ROLL_LIMIT)
 
 """
 def user_ident_thread():
@@ -255,47 +972,232 @@ def user_ident_thread():
     which generates an identifier, and sends that identifier to the user
     """
     app.debug = False
-    app.run(port = 5001)
-
+    webserve.serve(app, HTTP_HOST, HTTP_PORT, HTTP_WORKERS, HTTP_THREADS,
+                   HTTP_SERVER)
 
-def main():
-    if len(sys.argv) != 3:
-        print(f"Usage: {sys.argv[0]} <host> <port>")
-        sys.exit(1)
 
-    if DEBUG:
-        print("Got keys: ", keys)
-        print("test_user's key: ", keys["test_user"])
-    host, port = sys.argv[1], int(sys.argv[2])
+def listen_socket(host, port, reuse_port=False):
+    """
+    Create the non-blocking socket listening for devices on the given
+    host and port. With `reuse_port`, several processes can listen on
+    the same port (SO_REUSEPORT), and the kernel spreads the incoming
+    connections between them.
+    """
     lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # Avoid bind() exception: OSError: [Errno 48] Address already in use
     lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     try:
         lsock.bind((host, port))
         # sock.bind(("", port))
     except socket.error as msg:
         print("Socket binding error: " + str(msg) + "\n")
         sys.exit("Exiting")
-    lsock.listen()
+    lsock.listen(LISTEN_BACKLOG)
     print(f"Listening on {(host, port)}")
     lsock.setblocking(False)
-    sel.register(lsock, selectors.EVENT_READ, data=None)
+    return lsock
+
+
+def start_listening(lsock):
+    """
+    Set up the verifier and register it and the listening socket with
+    the selector, ready to run `auth_listen()`.
+    """
+    global verifier, listener, accepting
+    verifier = serverutils.Verifier(VERIFIER, keys, VERIFY_WORKERS)
+    sel.register(verifier, selectors.EVENT_READ, data=verifier)
+    listener = lsock
+    accepting = False
+    throttle_accept()
+
+
+def use_backend(name, path=STATE_FILE):
+    """
+    Move the "keys", "authorized" and "identifier" lists to the named
+    backend (see `statebackend.BACKENDS`), carrying the keys over. With
+    the "sqlite" backend, the lists are kept in the file at `path`.
+    """
+    global backend, keys, auth, ident
+    backend = statebackend.make_backend(
+        name, dict(keys.items()), AUTH_TIMEOUT, IDENT_TIMEOUT,
+        auth_capacity=AUTH_CAPACITY, ident_capacity=IDENT_CAPACITY,
+        shards=STATE_SHARDS, path=path,
+    )
+    keys, auth, ident = backend.keys, backend.auth, backend.ident
+
+
+def worker_main(host, port, number):
+    """
+    Entry point of a worker process in multi-process mode: listen on
+    the shared port with a selector of its own and run `auth_listen()`.
+    Only worker `number` 0 writes changes to the key file into the
+    shared key table.
+    """
+    global sel, write_keys
+    sel = selectors.DefaultSelector()
+    write_keys = number == 0
+    lsock = listen_socket(host, port, reuse_port=True)
+    start_listening(lsock)
+    key_reloader.start()
+    try:
+        auth_listen()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sel.close()
+        verifier.close()
+
+
+def run_workers(host, port, count):
+    """
+    Run the server as `count` worker processes, each listening on the
+    port and verifying PINs. The lists must be in a backend the workers
+    can share (see `use_backend()`). This process runs the Flask app.
+    """
+    # fork, so the workers inherit the keys and the backend set up here
+    ctx = multiprocessing.get_context("fork")
+    workers = [
+        ctx.Process(target=worker_main, args=(host, port, number))
+        for number in range(count)
+    ]
+    for worker in workers:
+        worker.start()
+    # make SIGTERM unwind through `finally`, so the workers are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        user_ident_thread()
+    except KeyboardInterrupt:
+        print("Caught keyboard interrupt, exiting")
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+def main():
+    global MAX_CONNECTIONS, LISTEN_BACKLOG
+    global HTTP_HOST, HTTP_PORT, HTTP_SERVER, HTTP_WORKERS, HTTP_THREADS
+    global STREAM_POLL, stream_slots
+    parser = argparse.ArgumentParser(description="Run the 2D2FA server.")
+    parser.add_argument("host", help="address to listen on for devices")
+    parser.add_argument("port", type=int, help="port to listen on for devices")
+    parser.add_argument(
+        "--workers", type=int, default=0,
+        help="number of worker processes sharing the port (SO_REUSEPORT); "
+             "0 (the default) listens on a thread of this process",
+    )
+    parser.add_argument(
+        "--backend", choices=sorted(statebackend.BACKENDS),
+        help="where to keep the keys, authorized and identifier lists "
+             "(default memory, or sqlite with --workers)",
+    )
+    parser.add_argument(
+        "--state-file", default=STATE_FILE,
+        help=f"SQLite file for the sqlite backend (default {STATE_FILE})",
+    )
+    parser.add_argument(
+        "--engine", choices=["selectors", "asyncio"], default="selectors",
+        help="serve devices with the selectors loop and the Flask app on "
+             "threads (the default), or with an asyncio event loop that "
+             "also serves the identifier page (see aioserver.py)",
+    )
+    parser.add_argument(
+        "--max-connections", type=int, default=MAX_CONNECTIONS,
+        help="most device connections open at once, in each worker "
+             f"(default {MAX_CONNECTIONS})",
+    )
+    parser.add_argument(
+        "--backlog", type=int, default=LISTEN_BACKLOG,
+        help="length of the queue of connections waiting to be accepted "
+             f"(default {LISTEN_BACKLOG})",
+    )
+    parser.add_argument(
+        "--http-host", default=HTTP_HOST,
+        help=f"address to serve the identifier page on (default {HTTP_HOST})",
+    )
+    parser.add_argument(
+        "--http-port", type=int, default=HTTP_PORT,
+        help=f"port to serve the identifier page on (default {HTTP_PORT})",
+    )
+    parser.add_argument(
+        "--http-server", choices=webserve.SERVERS, default=HTTP_SERVER,
+        help="WSGI server for the identifier page (default auto: "
+             "gunicorn or waitress if installed, else werkzeug; flask is "
+             "Flask's development server)",
+    )
+    parser.add_argument(
+        "--http-workers", type=int, default=HTTP_WORKERS,
+        help=f"worker processes serving the identifier page (default {HTTP_WORKERS})",
+    )
+    parser.add_argument(
+        "--http-threads", type=int, default=HTTP_THREADS,
+        help=f"threads in each HTTP worker (default {HTTP_THREADS})",
+    )
+    parser.add_argument(
+        "--access-log", action="store_true",
+        help="log every request for the identifier page",
+    )
+    args = parser.parse_args()
+    MAX_CONNECTIONS = args.max_connections
+    LISTEN_BACKLOG = args.backlog
+    HTTP_HOST, HTTP_PORT = args.http_host, args.http_port
+    HTTP_SERVER = args.http_server
+    HTTP_WORKERS, HTTP_THREADS = args.http_workers, args.http_threads
+    webserve.setup_logging(
+        logging.DEBUG if DEBUG else logging.INFO, access_log=args.access_log
+    )
+    shared = args.workers > 0 or args.http_workers > 1
+    backend_name = args.backend or ("sqlite" if shared else "memory")
+    if args.workers > 0 and backend_name == "memory":
+        parser.error("--workers needs a backend the workers can share")
+    if args.http_workers > 1 and backend_name == "memory":
+        parser.error("--http-workers needs a backend the workers can share")
+    if shared:
+        # PINs are checked, or pages served, in other processes than
+        # the one whose streams `auth_events` pushes to
+        STREAM_POLL = WORKERS_STREAM_POLL
+    stream_slots = threading.BoundedSemaphore(max(1, HTTP_THREADS // 2))
+    if (args.workers > 0 or args.http_workers > 1) and args.engine == "asyncio":
+        parser.error("--engine asyncio runs in a single process")
+    if backend_name != "memory":
+        use_backend(backend_name, args.state_file)
+
+    if DEBUG:
+        print("Got keys: ", keys)
+        print("test_user's key: ", keys["test_user"])
+    host, port = args.host, args.port
+    if args.workers > 0:
+        run_workers(host, port, args.workers)
+        return
+
+    if PRECOMPUTE_PINS:
+        serverutils.pin_table = serverutils.PinTable()
+    key_reloader.start()
+    if args.engine == "asyncio":
+        import aioserver
+        aioserver.run(host, port)
+        return
+    lsock = listen_socket(host, port)
+    start_listening(lsock)
 
     try:
-        # auth_listen()
-        t1 = threading.Thread(target=auth_listen)
-        t2 = threading.Thread(target=user_ident_thread)
+        # auth_listen() runs on a thread, and the Flask app on the main
+        # thread, where the WSGI server can handle signals
+        t1 = threading.Thread(target=auth_listen, daemon=True)
         t1.start()
-        t2.start()
-        # pp.debug = True
-        # pp.run()
-        t1.join()
-       # 2.join()
+        user_ident_thread()
     except KeyboardInterrupt:
         print("Caught keyboard interrupt, exiting")
     finally:
         sel.close()
+        verifier.close()
 
 
 if __name__ == "__main__":
+    # let `import server` (in aioserver) find this module instead of
+    # loading a second copy with its own lists
+    sys.modules["server"] = sys.modules[__name__]
     main()
@@ -12,32 +12,254 @@ TCP connection and messaging code modified from:
 https://realpython.com/python-sockets/
 """
 
+import os
 import sys
+import socket
 import selectors
 import json
 import io
-import struct
 import time
 import hashlib, hmac
+import threading
+import traceback
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 import secrets # secure random generator
 from secrets import SystemRandom    # secure random generator
+import keystore
+import protocol
 
 # set True to show connection and message info, False to hide
 DEBUG = False
 
 TIME_SLICE = 30 # a time slice is 30 seconds as defined in the 2d-2fa paper
 
+# the JSON file mapping users to keys, and the memory-mapped key store
+# built from it by keystore.py, which is used instead when it exists
+KEYS_FILE = 'server_user_list.txt'
+KEYSTORE_FILE = 'server_user_list.keys'
 
-def get_keys():
+# how often, in seconds, a `KeyWatcher` checks the key file for changes
+KEY_RELOAD_INTERVAL = 5
+
+# maximum number of requests answered on one keep-alive connection; the
+# connection is closed after the last one
+KEEPALIVE_MAX_REQUESTS = 100
+
+# maximum number of pre-keyed HMAC contexts held by `hmac_cache`; each
+# context is a few hundred bytes, so this bounds the cache's memory use
+HMAC_CACHE_SIZE = 100_000
+
+
+def keys_path():
+    """
+    Return the path of the file the keys are read from: the key store if
+    one has been built (see `keystore.py`), otherwise the JSON file.
+    """
+    if os.path.exists(KEYSTORE_FILE):
+        return KEYSTORE_FILE
+    return KEYS_FILE
+
+
+def get_keys(path=None):
     """
-    Read a file containing a json mapping users to keys
+    Read a file containing a json mapping users to keys. If the file is
+    a key store (see `keystore.py`), open that instead: keys are then
+    looked up in the memory-mapped file rather than all loaded into a
+    dictionary. By default the file is chosen by `keys_path()`.
     """
-    f = open('server_user_list.txt')
+    if path is None:
+        path = keys_path()
+    if keystore.is_keystore(path):
+        return keystore.KeyStore(path)
+    f = open(path)
     for line in f:
         dat = json.loads(line)
         return dat
 
 
+def diff_keys(old, new):
+    """
+    Compare two sets of keys. Return a dict of the users whose key was
+    added or changed in `new`, mapped to their new key, and a list of
+    the users that are in `old` but not in `new`.
+    """
+    changed = {}
+    for user, key in new.items():
+        if old.get(user) != key:
+            changed[user] = key
+    removed = [user for user in old.keys() if user not in new]
+    return changed, removed
+
+
+# a change to the key file found by a `KeyReloader`: the keys now in the
+# file, and what `diff_keys()` found changed and removed
+KeyUpdate = namedtuple("KeyUpdate", ["keys", "changed", "removed"])
+
+
+def apply_key_changes(keys, update, cache=None, pins=None, write=True):
+    """
+    Apply a `KeyUpdate` to the server's keys, and return the keys to use
+    from now on. A key table shared with other processes (one with a
+    `batch()`, see `sqlitestore`) has the changed and removed users
+    written in one transaction, unless `write` is False because another
+    of the processes writes them, and is returned. Any other keys (a
+    dictionary or a key store) are replaced as a whole by the update's
+    keys, so that no reader sees them half updated. Either way only the
+    cached HMAC contexts (from `cache`, the module's `hmac_cache` by
+    default) and precomputed PINs (from `pins`, the module's `pin_table`
+    by default) of the users that changed are dropped.
+    """
+    if hasattr(keys, "batch"):
+        if write:
+            with keys.batch():
+                keys.update(update.changed)
+                for user in update.removed:
+                    keys.pop(user, None)
+    else:
+        keys = update.keys
+    invalidate_users(list(update.changed) + update.removed, cache, pins)
+    return keys
+
+
+def invalidate_users(users, cache=None, pins=None):
+    """
+    Drop the cached HMAC contexts and precomputed PINs of the given
+    users, e.g. because their keys changed.
+    """
+    if cache is None:
+        cache = hmac_cache
+    if pins is None:
+        pins = pin_table
+    for user in users:
+        cache.invalidate(user)
+        if pins is not None:
+            pins.discard(user)
+
+
+class KeyWatcher:
+    """
+    Watches a key file for changes by polling its modification time,
+    size and inode (so that a file replaced by renaming another over it
+    is noticed too).
+    """
+    def __init__(self, path, interval=KEY_RELOAD_INTERVAL):
+        """
+        The KeyWatcher class initializer initializes the following
+        attributes:
+
+        - path: The key file being watched.
+        - interval: The minimum time, in seconds, between two checks.
+        - _stat: What the file's status was when last checked.
+        - _checked: When the file was last checked (monotonic clock).
+        """
+        self.path = path
+        self.interval = interval
+        self._stat = self._file_stat()
+        self._checked = time.monotonic()
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def changed(self):
+        """
+        Return True if the file has changed since it was last checked.
+        Checks at most once every `interval` seconds; returns False in
+        between.
+        """
+        now = time.monotonic()
+        if now - self._checked < self.interval:
+            return False
+        self._checked = now
+        stat = self._file_stat()
+        if stat is None or stat == self._stat:
+            return False
+        self._stat = stat
+        return True
+
+
+class KeyReloader:
+    """
+    Reloads a key file on a background thread whenever its `KeyWatcher`
+    notices a change. Reading the file and diffing it against the keys
+    read last time (see `diff_keys()`) takes time proportional to the
+    number of users, so it is done there, off the server loop; the loop
+    only takes the resulting `KeyUpdate`s with `updates()` and applies
+    them (see `apply_key_changes()`), in time proportional to the change.
+    """
+    def __init__(self, watcher, keys):
+        """
+        The KeyReloader class initializer initializes the following
+        attributes:
+
+        - watcher: The `KeyWatcher` of the key file.
+        - keys: The keys last read from the file (at first, the keys the
+          server started with).
+        - _updates: Queue of the `KeyUpdate`s not yet taken by
+          `updates()`.
+        - _stop: Event set to stop the thread.
+        - _thread: The thread checking the file, started by `start()`.
+        """
+        self.watcher = watcher
+        self.keys = keys
+        self._updates = deque()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start checking the file on a daemon thread, every `interval` of
+        the watcher.
+        """
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.watcher.interval):
+            self.check()
+
+    def check(self):
+        """
+        If the file has changed, read it and queue the `KeyUpdate` of what
+        changed in it. Return the update, or None if there was none.
+        """
+        if not self.watcher.changed():
+            return None
+        try:
+            new = get_keys(self.watcher.path)
+        except (OSError, ValueError):
+            print(f"Main: Error: Could not reload keys:\n{traceback.format_exc()}")
+            return None
+        changed, removed = diff_keys(self.keys, new)
+        self.keys = new
+        if not changed and not removed:
+            return None
+        update = KeyUpdate(new, changed, removed)
+        self._updates.append(update)
+        return update
+
+    def updates(self):
+        """
+        Return the updates queued since the last call, oldest first.
+        """
+        done = []
+        while self._updates:
+            done.append(self._updates.popleft())
+        return done
+
+
 def get_key(user, keys):
     """
     Look up and return the key for a user. "Production" version should
@@ -48,6 +270,223 @@ def get_key(user, keys):
     return k
 
 
+class HMACCache:
+    """
+    A least-recently-used cache of pre-keyed HMAC-SHA256 contexts, one
+    per user. Keying an HMAC context hashes the (padded) key, so doing
+    it once per user and `.copy()`ing the keyed context for each time
+    slice avoids re-keying five times on every PIN check.
+    """
+    def __init__(self, maxsize=HMAC_CACHE_SIZE):
+        """
+        The HMACCache class initializer initializes the following
+        attributes:
+
+        - maxsize: The maximum number of contexts to keep. When the
+          cache is full, the least recently used context is evicted.
+        - _contexts: Ordered mapping of user to a `(key, context)`
+          pair, oldest first. The key is kept so that a changed key is
+          detected and the context rebuilt.
+        - _lock: Lock guarding `_contexts`, so the cache can be shared
+          between threads.
+        """
+        self.maxsize = maxsize
+        self._contexts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def get(self, user, key):
+        """
+        Return the pre-keyed HMAC context for a user, creating it if it
+        is not cached or if the user's key has changed. The returned
+        context must not be updated directly; `.copy()` it first.
+        """
+        with self._lock:
+            entry = self._contexts.get(user)
+            if entry is not None and entry[0] == key:
+                self._contexts.move_to_end(user)
+                return entry[1]
+            ctx = hmac.new(key.encode('utf-8'), digestmod=hashlib.sha256)
+            self._contexts[user] = (key, ctx)
+            self._contexts.move_to_end(user)
+            if len(self._contexts) > self.maxsize:
+                self._contexts.popitem(last=False)
+            return ctx
+
+    def invalidate(self, user):
+        """
+        Drop the cached context for a user, e.g. after their key changes.
+        """
+        with self._lock:
+            self._contexts.pop(user, None)
+
+    def clear(self):
+        """
+        Drop every cached context.
+        """
+        with self._lock:
+            self._contexts.clear()
+
+
+# shared cache used by `check_pin()` when no other cache is given
+hmac_cache = HMACCache()
+
+
+class PinTable:
+    """
+    A table of the PINs each user is expected to submit in the current
+    window of time slices (the current slice +/- 2). The PINs for a user
+    are hashed once when their identifier is issued, and `roll()` adds
+    the newly valid slice (and drops the expired one) at each time slice
+    boundary, so that checking a PIN is a dictionary lookup instead of
+    up to five HMAC computations.
+    """
+    def __init__(self, cache=None):
+        """
+        The PinTable class initializer initializes the following
+        attributes:
+
+        - cache: The `HMACCache` used to get each user's keyed context
+          (the module's `hmac_cache` by default).
+        - time_slice: The time slice the table was last rolled to.
+        - _entries: Maps a user to an `[identifier, key, pins, slice]`
+          entry, where `pins` maps each expected PIN to its time slice
+          and `slice` is the time slice the window was hashed around.
+        - _pending: The entries still to be rolled forward to
+          `time_slice`, as `(user, entry)` pairs (see `roll()`).
+        - _lock: Lock guarding `_entries`, `_pending` and `time_slice`,
+          as the table is filled from the identifier thread and rolled
+          from the listening thread.
+        """
+        self.cache = hmac_cache if cache is None else cache
+        self.time_slice = int(time.time()) // TIME_SLICE
+        self._entries = {}
+        self._pending = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _hash(self, user, key, identifier, time_i):
+        h = self.cache.get(user, key).copy()
+        h.update(str(time_i ^ identifier).encode('utf-8'))
+        return h.hexdigest()
+
+    def add(self, user, identifier, key):
+        """
+        Precompute the expected PINs for a newly issued identifier,
+        replacing any entry the user already had.
+        """
+        while True:
+            time_slice = max(int(time.time()) // TIME_SLICE, self.time_slice)
+            pins = {}
+            for time_i in range(time_slice-2, time_slice+3):
+                pins[self._hash(user, key, identifier, time_i)] = time_i
+            with self._lock:
+                # if `roll()` moved the table on while the PINs were
+                # hashed, it didn't see this entry; hash it again for
+                # the new window rather than leave it behind
+                if time_slice >= self.time_slice:
+                    self._entries[user] = [identifier, key, pins, time_slice]
+                    return
+
+    def discard(self, user):
+        """
+        Remove a user's entry, e.g. when their identifier expires.
+        """
+        with self._lock:
+            self._entries.pop(user, None)
+
+    def roll(self, ident=None, time_slice=None, limit=None):
+        """
+        Move the table forward to `time_slice` (by default the current
+        time slice): hash the PIN for each newly valid slice and drop
+        PINs for slices that have left the window. If `ident` is given,
+        entries whose identifier is no longer the user's current
+        identifier are dropped as well. At most `limit` entries are
+        rolled per call, if given, so that the work of a slice boundary
+        can be spread over several server ticks; until an entry is
+        rolled, `lookup()` leaves its PINs to be hashed by the caller.
+        Does nothing once every entry has been rolled to the slice, so
+        it is cheap to call on every tick. Return the number of entries
+        rolled forward.
+        """
+        if time_slice is None:
+            time_slice = int(time.time()) // TIME_SLICE
+        with self._lock:
+            if time_slice != self.time_slice:
+                self._pending = deque(self._entries.items())
+                self.time_slice = time_slice
+            if not self._pending:
+                return 0
+            count = len(self._pending) if limit is None else limit
+            entries = []
+            while self._pending and len(entries) < count:
+                entries.append(self._pending.popleft())
+        rolled_entries = 0
+        for user, entry in entries:
+            identifier, key, pins, entry_slice = entry
+            if entry_slice >= time_slice:
+                continue
+            if ident is not None and get_identifier(user, ident) != identifier:
+                rolled = None
+            else:
+                rolled = {p: t for p, t in pins.items() if t >= time_slice - 2}
+                first = max(entry_slice + 3, time_slice - 2)
+                for time_i in range(first, time_slice+3):
+                    rolled[self._hash(user, key, identifier, time_i)] = time_i
+            with self._lock:
+                # the entry is replaced whole, and only if `add()` hasn't
+                # replaced it meanwhile, so a lookup never sees a window
+                # that doesn't match its slice
+                if self._entries.get(user) is not entry:
+                    continue
+                if rolled is None:
+                    del self._entries[user]
+                else:
+                    self._entries[user] = [identifier, key, rolled, time_slice]
+                    rolled_entries += 1
+        return rolled_entries
+
+    def lookup(self, user, identifier, key, pin):
+        """
+        Check a PIN against the table. Return True or False if the table
+        can answer, or None if it has no current entry for the user's
+        identifier and key (or has not been rolled to the current slice),
+        in which case the caller should hash the PIN itself.
+        """
+        time_slice = int(time.time()) // TIME_SLICE
+        entry = self._entries.get(user)
+        if entry is None or entry[0] != identifier or entry[1] != key:
+            return None
+        if entry[3] != time_slice:
+            return None
+        return pin in entry[2]
+
+
+# set to a `PinTable` to have `check_pin()` look PINs up in it instead of
+# hashing them on every check (see `server.PRECOMPUTE_PINS`)
+pin_table = None
+
+# the JSON requests other than PIN submissions that `Message` answers:
+# maps the request's "action" to a function taking the request (a dict)
+# and returning the content of the response (a dict with a "result"),
+# registered by the server (e.g. "issue_identifier", see `server.py`)
+ACTIONS = {}
+
+# set to an `events.Broker` to publish an "authorized" event, with the
+# time of the authorization, about each user a `Message` authorizes (see
+# `server.auth_stream()`)
+auth_events = None
+
+
+# an entry in the server's "identifier" list: the identifier issued to a
+# user and the time (seconds since epoch) it was issued
+Identifier = namedtuple("Identifier", ["identifier", "issued"])
+
+
 def generate_identifier():
     """
     Generate a random 6-digit identifier that the user will input on the
@@ -68,12 +507,16 @@ def get_identifier(user, ident):
     return id[0]
 
 
-def check_pin(user, pin, ident, keys):
+def check_pin(user, pin, ident, keys, cache=None, pins=None):
     """
     Check the pin for +/- 2 time slices from current time (+/- 60s,
     because each time slice is 30s). If the we generate a pin that
     matches the pin generated by the device, then return True, else
-    return False.
+    return False. The user's keyed HMAC context is taken from `cache`
+    (the module's `hmac_cache` by default) instead of being rebuilt for
+    every time slice. If a `PinTable` is given in `pins` (or set in the
+    module's `pin_table`) and holds the user's identifier, the PIN is
+    looked up there instead of being hashed.
     """
     time_now_s = int(time.time()) # get the time since epoch in seconds
     time_slice = time_now_s // TIME_SLICE # get the time, divide into slices
@@ -95,27 +538,224 @@ def check_pin(user, pin, ident, keys):
     if key is None:
         return False
 
+    return _verify_pin(user, pin, identifier, key, time_slice, cache, pins)
+
+
+def check_pins(requests, ident, keys, cache=None, pins=None):
+    """
+    Check a batch of PINs at once. `requests` is a sequence of
+    `(user, pin)` pairs; return a list with True or False for each pair,
+    in the same order, as `check_pin()` would. The current time slice is
+    computed once for the whole batch, and each user's identifier and
+    key are looked up once even if they submitted several PINs.
+    """
+    time_slice = int(time.time()) // TIME_SLICE
+    if DEBUG:
+        print(f"Checking {len(requests)} PINs; Time slice: {time_slice}")
+    lookups = {}
+    results = []
+    for user, pin in requests:
+        found = lookups.get(user)
+        if found is None:
+            found = (get_identifier(user, ident), get_key(user, keys))
+            lookups[user] = found
+        identifier, key = found
+        if identifier is None or key is None:
+            results.append(False)
+        else:
+            results.append(
+                _verify_pin(user, pin, identifier, key, time_slice, cache, pins)
+            )
+    return results
+
+
+def _verify_pin(user, pin, identifier, key, time_slice, cache, pins):
+    """
+    Helper function for `check_pin()` and `check_pins()`: check a pin
+    against a user's identifier and key for +/- 2 time slices around
+    `time_slice`.
+    """
+    if pins is None:
+        pins = pin_table
+    if pins is not None:
+        found = pins.lookup(user, identifier, key, pin)
+        if found is not None:
+            return found
+
+    if cache is None:
+        cache = hmac_cache
+    keyed = cache.get(user, key)
+
     for time_i in range(time_slice-2, time_slice+3): # current time slice +/- two slices (add three to upper end bc of range's indexing)
         msg = str(time_i ^ identifier) # create the message (time + identifier)
 
         # hash the message using the user's secret key
-        h = hmac.new(
-            key.encode('utf-8'),
-            msg.encode('utf-8'),
-            hashlib.sha256
-        )
+        h = keyed.copy()
+        h.update(msg.encode('utf-8'))
+        digest = h.hexdigest()
 
         # if the hash is equal to the pin for any time in the window,
         # return true
         if DEBUG:
-            print("Checking timeslice ", time_i, " PIN: ", h.hexdigest())
-        if h.hexdigest() == pin:
+            print("Checking timeslice ", time_i, " PIN: ", digest)
+        if digest == pin:
             return True
     
     # the time limit has expired, return false
     return False
 
 
+# keys held by each worker of a process-pool `Verifier`, sent once when
+# the worker starts
+_worker_keys = None
+
+
+def _init_verify_worker(keys):
+    """
+    Initializer for the worker processes of a process-pool `Verifier`:
+    keep the keys so they are not sent along with every batch.
+    """
+    global _worker_keys
+    _worker_keys = keys
+
+
+def _check_pins_in_worker(requests, ident):
+    """
+    Run `check_pins()` in a worker process, using the keys it was
+    started with.
+    """
+    return check_pins(requests, ident, _worker_keys)
+
+
+class Verifier:
+    """
+    A class to run batches of PIN checks for the server loop, so that
+    hashing can be moved off the thread doing the socket I/O. The mode
+    selects the backend:
+
+    - "inline": check the PINs immediately, on the calling thread.
+    - "thread": check them on a pool of threads.
+    - "process": check them on a pool of processes, which receive the
+      keys once when they start instead of with every batch.
+
+    Finished batches are collected with `completed()`. The verifier has
+    a socket (see `fileno()`) that becomes readable whenever a batch
+    finishes, so that it can be registered with the server's selector
+    to wake the loop up.
+    """
+    def __init__(self, mode="inline", keys=None, workers=None):
+        """
+        The Verifier class initializer initializes the following
+        attributes:
+
+        - mode: The backend, "inline", "thread" or "process".
+        - workers: The number of pool workers (None lets the pool
+          choose).
+        - _pool: The executor running the checks, or None when inline.
+        - _done: Queue of finished `(token, future)` pairs.
+        - _rsock, _wsock: Connected socket pair; a byte is written to
+          `_wsock` when a batch finishes, waking up a selector on
+          `_rsock`.
+        """
+        self.mode = mode
+        self.workers = workers
+        if mode == "inline":
+            self._pool = None
+        elif mode == "thread":
+            self._pool = ThreadPoolExecutor(max_workers=workers)
+        elif mode == "process":
+            self._pool = self._process_pool(keys)
+        else:
+            raise ValueError(f"Invalid verifier mode {mode!r}.")
+        self._done = deque()
+        self._rsock, self._wsock = socket.socketpair()
+        self._rsock.setblocking(False)
+        self._wsock.setblocking(False)
+
+    def _process_pool(self, keys):
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_verify_worker,
+            initargs=(keys,),
+        )
+
+    def fileno(self):
+        return self._rsock.fileno()
+
+    def set_keys(self, keys):
+        """
+        Give the verifier a new set of keys. Thread pools share the
+        caller's keys already; a process pool is replaced by one started
+        with the new keys, letting the old one finish its batches.
+        """
+        if self.mode == "process":
+            old = self._pool
+            self._pool = self._process_pool(keys)
+            old.shutdown(wait=False)
+
+    def submit(self, requests, ident, keys, token):
+        """
+        Check a batch of `(user, pin)` requests. `token` is returned
+        with the results by `completed()`, to tell batches apart. A batch
+        that fails, here or in the pool, is returned with its exception
+        rather than raising it into the caller's loop.
+        """
+        try:
+            if self._pool is None:
+                future = Future()
+                future.set_result(check_pins(requests, ident, keys))
+            elif self.mode == "process":
+                # only send the identifiers this batch needs
+                ident = {user: ident.get(user) for user, pin in requests}
+                future = self._pool.submit(_check_pins_in_worker, requests, ident)
+            else:
+                future = self._pool.submit(check_pins, requests, ident, keys)
+        except Exception as exc:
+            future = Future()
+            future.set_exception(exc)
+        if future.done():
+            self._done.append((token, future))
+        else:
+            future.add_done_callback(lambda f: self._finish(token, f))
+
+    def _finish(self, token, future):
+        """
+        Callback run (on a pool thread) when a batch finishes: queue it
+        and wake up the selector.
+        """
+        self._done.append((token, future))
+        try:
+            self._wsock.send(b"\0")
+        except (BlockingIOError, OSError):
+            # the selector is already due to wake up
+            pass
+
+    def completed(self):
+        """
+        Return the batches that have finished since the last call, as a
+        list of `(token, future)` pairs; `future.result()` is the list of
+        results, or raises the exception the batch failed with.
+        """
+        try:
+            while self._rsock.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        done = []
+        while self._done:
+            done.append(self._done.popleft())
+        return done
+
+    def close(self):
+        """
+        Shut down the pool and close the wake-up sockets.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        self._rsock.close()
+        self._wsock.close()
+
+
 class Message:
     """
     A class to represent a message and network connection, capable of
@@ -133,27 +773,56 @@ class Message:
         - sock: The socket that provides the connection to the server.
         - addr: The address of the server to which the socket is
           connected.
-        - _recv_buffer: Buffer into which data is read from the socket
-          connection. 
-        - _send_buffer: Buffer into which data is written before it is
+        - _recv_buffer: The `protocol.RecvBuffer` into which data is
+          read from the socket connection. 
+        - _send_buffer: The `protocol.SendQueue` of buffers waiting to be
           sent over the connection.
         - _jsonheader_len: The length of a `jsonheader`.
         - jsonheader: The header of a message that is to be sent over
           the network.
+        - binary: Whether the request came in a binary frame (see
+          `protocol`), to be answered in one.
+        - _frame: The kind and body length of the binary frame being
+          received, or None.
         - request: The 'request' data structure created by
           `create_request()`.
         - response_created: Indicator variable to show whether the
           response has been created or not.
+        - verifying: Indicator variable to show whether the request's
+          PIN has been handed to a `Verifier` and its result is pending.
+        - keep_alive: Whether the client asked (in the request's JSON
+          header) to keep the connection open for further requests.
+        - peer_closed: Whether the client has shut down its side of the
+          connection after sending a request, which is still answered.
+        - request_id: The ID the client tagged the request with, sent
+          back in the response's header, or None.
+        - requests_served: Number of responses created on the connection.
+        - last_active: When (monotonic clock) data was last received or
+          a response last sent, for timing out idle connections.
+        - connected: When (monotonic clock) the connection was accepted.
+        - request_started: When the current request started arriving
+          (or the connection was accepted), for timing out devices too
+          slow to send a request or read its response.
         """
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self._recv_buffer = protocol.RecvBuffer()
+        self._send_buffer = protocol.SendQueue()
         self._jsonheader_len = None
         self.jsonheader = None
+        self.binary = False
+        self._frame = None
         self.request = None
         self.response_created = False
+        self.verifying = False
+        self.keep_alive = False
+        self.peer_closed = False
+        self.request_id = None
+        self.requests_served = 0
+        self.last_active = time.monotonic()
+        self.connected = self.last_active
+        self.request_started = self.last_active
 
     def _set_selector_events_mask(self, mode):
         """
@@ -167,7 +836,17 @@ class Message:
             events = selectors.EVENT_READ | selectors.EVENT_WRITE
         else:
             raise ValueError(f"Invalid events mask mode {mode!r}.")
-        self.selector.modify(self.sock, events, data=self)
+        if self.peer_closed:
+            # there is nothing more to read, only the response to send
+            events &= ~selectors.EVENT_READ
+        registered = self.sock in self.selector.get_map()
+        if not events:
+            if registered:
+                self.selector.unregister(self.sock)
+        elif registered:
+            self.selector.modify(self.sock, events, data=self)
+        else:
+            self.selector.register(self.sock, events, data=self)
 
     def _read(self):
         """
@@ -176,14 +855,12 @@ class Message:
         """
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            received = self._recv_buffer.recv_from(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not received:
                 raise RuntimeError("Peer closed.")
 
     def _write(self):
@@ -193,18 +870,77 @@ class Message:
         """
         if self._send_buffer:
             if DEBUG:
-                print(f"Sending {self._send_buffer!r} to {self.addr}")
+                print(f"Sending {len(self._send_buffer)} bytes to {self.addr}")
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                sent = self._send_buffer.send_to(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
-                # Close when the buffer is drained. The response has been sent.
+                # The responses have been sent when the buffer is drained.
                 if sent and not self._send_buffer:
-                    self.close()
+                    self._response_sent()
+
+    def _response_sent(self):
+        """
+        Called when the queued responses have been sent: close the
+        connection (also once a client that shut down its side has been
+        answered), or, on a keep-alive connection, get ready for the
+        next request (which may already be buffered if the client
+        pipelined its requests).
+        """
+        self.last_active = time.monotonic()
+        if not self.response_created:
+            # already working on the next pipelined request
+            self._set_selector_events_mask("r")
+            return
+        if not self.keep_alive or (self.peer_closed and not self._recv_buffer):
+            self.close()
+            return
+        self._set_selector_events_mask("r")
+        self._next_request()
+
+    def _next_request(self):
+        """
+        Forget the request that has been answered, and process the next
+        one if it has already been received.
+        """
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self.binary = False
+        self._frame = None
+        self.request = None
+        self.response_created = False
+        self.request_id = None
+        self.request_started = time.monotonic()
+        if self._recv_buffer:
+            self._process_buffer()
+
+    def is_idle(self):
+        """
+        Return True if the connection is open but waiting for the start
+        of a new request.
+        """
+        return (self.sock is not None and self._jsonheader_len is None
+                and self._frame is None and not self._recv_buffer
+                and not self._send_buffer)
+
+    def deadline(self, request_timeout, keepalive_timeout):
+        """
+        Return when (monotonic clock) the connection should be closed if
+        it gets no further: `keepalive_timeout` seconds after the last
+        response if it is idle between requests, otherwise
+        `request_timeout` seconds after the current request started
+        arriving (or the connection was accepted), by when the request
+        should have been received and its response sent. Return None
+        while the request's PIN is being verified.
+        """
+        if self.verifying:
+            return None
+        if self.requests_served and self.is_idle():
+            return self.last_active + keepalive_timeout
+        return self.request_started + request_timeout
 
     def _json_encode(self, obj, encoding):
         """
@@ -226,12 +962,13 @@ class Message:
         return obj
 
     def _create_message(
-        self, *, content_bytes, content_type, content_encoding
+        self, *, content_bytes, content_type, content_encoding, headers=None
     ):
         """
         Create a message to send over the network by packing the message
-        header and the message into a struct. Return the created
-        message. 
+        header and the message into a struct. Any extra `headers` are
+        added to the JSON header. Return the parts of the created
+        message, to be queued for sending without joining them.
         """
         jsonheader = {
             "byteorder": sys.byteorder,
@@ -239,31 +976,54 @@ class Message:
             "content-encoding": content_encoding,
             "content-length": len(content_bytes),
         }
+        if headers:
+            jsonheader.update(headers)
         jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
-        message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        message = message_hdr + jsonheader_bytes + content_bytes
-        return message
+        message_hdr = protocol.PROTOHEADER.pack(len(jsonheader_bytes))
+        return (message_hdr, jsonheader_bytes, content_bytes)
 
-    def _create_response_json_content(self, auth, ident, keys):
+    def _check_request(self, auth, ident, keys, verified=None):
+        """
+        Check the PIN in the request, authorizing the user if it is
+        good, and return the result to send back.
+        """
         # rewrite, "user" insted of "action"
         # check first that "user" and "pin" exist, abort if not
+        if not isinstance(self.request, dict):
+            return "Error: invalid request."
         action = self.request.get("action")
         if (( "user" in self.request.keys() ) and ( "pin" in self.request.keys() )):
-            # check pin/key
+            if self.pin_request() is None:
+                return "Error: invalid request."
+            # check pin/key, unless it was already checked in a batch
             user = self.request.get("user")
             if DEBUG:
                 print("In create_response, user = ", user)
             pin = self.request.get("pin")
-            content = {}
-            if (check_pin(user, pin, ident, keys)):
+            if verified is None:
+                verified = check_pin(user, pin, ident, keys)
+            if verified:
                 # PIN is good!
                 time_s = int(time.time())
                 auth.update({user: time_s})
-                content = {"result": "Authorization granted."}
+                if auth_events is not None:
+                    auth_events.publish(user, "authorized", time_s)
+                return "Authorization granted."
             else:
-                content = {"result": "Authentication failed."}
+                return "Authentication failed."
         else:
-            content = {"result": f"Error: invalid action '{action}'."}
+            return f"Error: invalid action '{action}'."
+
+    def _create_response_json_content(self, auth, ident, keys, verified=None):
+        handler = None
+        if isinstance(self.request, dict) and "pin" not in self.request:
+            action = self.request.get("action")
+            if isinstance(action, str):
+                handler = ACTIONS.get(action)
+        if handler is not None:
+            content = handler(self.request)
+        else:
+            content = {"result": self._check_request(auth, ident, keys, verified)}
         content_encoding = "utf-8"
         response = {
             "content_bytes": self._json_encode(content, content_encoding),
@@ -272,6 +1032,16 @@ class Message:
         }
         return response
 
+    def _create_frame(self, result):
+        """
+        Create a binary frame carrying `result`, the answer to a request
+        received in a binary frame. Return the created frame.
+        """
+        return protocol.pack_frame(
+            protocol.KIND_RESULT, protocol.pack_result(result),
+            self.request_id, self.keep_alive
+        )
+
     def _create_response_binary_content(self):
         """
         Create a response using binary encoding
@@ -299,10 +1069,49 @@ class Message:
         Call the `_read()` helper function, then process the header
         received from the server and process the response. 
         """
-        self._read()
+        idle = self.requests_served and self.is_idle()
+        try:
+            self._read()
+        except RuntimeError:
+            # A keep-alive client closing the connection between requests
+            # is the normal end of the connection.
+            if idle:
+                self.close()
+                return
+            if self.request is None:
+                raise
+            # The client shut down its side of the connection after
+            # sending its request (its PIN may be with the verifier):
+            # stop reading, and close once the response has been sent.
+            self.peer_closed = True
+            self._set_selector_events_mask("w" if self.response_created else "r")
+            return
+        self._received(idle)
+
+    def _received(self, idle):
+        """
+        Note that data has been received, the start of a new request if
+        the connection was `idle` between requests, and process it.
+        """
+        self.last_active = time.monotonic()
+        if idle:
+            self.request_started = self.last_active
+        self._process_buffer()
 
-        if self._jsonheader_len is None:
-            self.process_protoheader()
+    def _process_buffer(self):
+        """
+        Process as much of the next request as has been received.
+        """
+        if self._jsonheader_len is None and self._frame is None:
+            if protocol.is_frame(self._recv_buffer):
+                self.process_frameheader()
+            else:
+                self.process_protoheader()
+
+        if self._frame is not None:
+            if self.request is None:
+                self.process_frame()
+            return
 
         if self._jsonheader_len is not None:
             if self.jsonheader is None:
@@ -318,7 +1127,9 @@ class Message:
         function to send the message over the socket connection.
         """
         if self.request:
-            if not self.response_created:
+            # the PIN of a pipelined request may be with the verifier
+            # while the previous response is sent
+            if not self.response_created and not self.verifying:
                 self.create_response(auth, ident, keys)
 
         self._write()
@@ -330,7 +1141,8 @@ class Message:
         if DEBUG:
             print(f"Closing connection to {self.addr}")
         try:
-            self.selector.unregister(self.sock)
+            if self.sock in self.selector.get_map():
+                self.selector.unregister(self.sock)
         except Exception as e:
             print(
                 f"Error: selector.unregister() exception for "
@@ -344,14 +1156,52 @@ class Message:
         finally:
             # Delete reference to socket object for garbage collection
             self.sock = None
+            # and the buffers' memory, as the closed message may still be
+            # referenced for a while (e.g. by the server's deadline heap)
+            self._recv_buffer.release()
+            self._send_buffer.drain()
 
     def process_protoheader(self):
         hdrlen = 2
         if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:hdrlen]
-            )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            self._jsonheader_len = self._recv_buffer.unpack(protocol.PROTOHEADER)[0]
+            if self._jsonheader_len > protocol.MAX_JSONHEADER_SIZE:
+                raise ValueError(
+                    f"JSON header of {self._jsonheader_len} bytes is too large."
+                )
+
+    def process_frameheader(self):
+        """
+        Process the header of a binary frame, and crop it from the
+        `_recv_buffer`.
+        """
+        if len(self._recv_buffer) >= protocol.FRAME.size:
+            with self._recv_buffer.view(protocol.FRAME.size) as header:
+                kind, self.keep_alive, self.request_id, length = (
+                    protocol.unpack_frame(header)
+                )
+            self._recv_buffer.consume(protocol.FRAME.size)
+            self._frame = (kind, length)
+            self.binary = True
+
+    def process_frame(self):
+        """
+        When the body of a binary frame is received, decode it and set
+        `self.request` to the same data structure as a JSON request.
+        """
+        kind, length = self._frame
+        if not len(self._recv_buffer) >= length:
+            return
+        if kind == protocol.KIND_PIN:
+            with self._recv_buffer.view(length) as body:
+                user, pin = protocol.unpack_pin(body)
+            self._recv_buffer.consume(length)
+            self.request = {"user": user, "pin": pin}
+        else:
+            self._recv_buffer.consume(length)
+            self.request = {"action": f"frame kind {kind}"}
+        if DEBUG:
+            print(f"Received request {self.request!r} from {self.addr}")
 
     def process_jsonheader(self):
         """
@@ -362,9 +1212,8 @@ class Message:
         hdrlen = self._jsonheader_len
         if len(self._recv_buffer) >= hdrlen:
             self.jsonheader = self._json_decode(
-                self._recv_buffer[:hdrlen], "utf-8"
+                self._recv_buffer.take(hdrlen), "utf-8"
             )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
             for reqhdr in (
                 "byteorder",
                 "content-length",
@@ -373,6 +1222,15 @@ class Message:
             ):
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f"Missing required header '{reqhdr}'.")
+            if self.jsonheader["content-length"] > protocol.MAX_CONTENT_SIZE:
+                raise ValueError(
+                    f"Content of {self.jsonheader['content-length']} bytes "
+                    f"is too large."
+                )
+            # Optional headers of a client that sends several requests
+            # over one connection.
+            self.keep_alive = bool(self.jsonheader.get("keep-alive", False))
+            self.request_id = self.jsonheader.get("request-id")
 
     def process_request(self):
         """
@@ -382,8 +1240,7 @@ class Message:
         content_len = self.jsonheader["content-length"]
         if not len(self._recv_buffer) >= content_len:
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
+        data = self._recv_buffer.take(content_len)
         if self.jsonheader["content-type"] == "text/json":
             encoding = self.jsonheader["content-encoding"]
             self.request = self._json_decode(data, encoding)
@@ -396,20 +1253,69 @@ class Message:
                 print(
                     f"Received invalid message from {self.addr}"
                 )
-        # Set selector to listen for write events, we're done reading.
-        self._set_selector_events_mask("w")
+        # The selector is set to listen for write events once the server
+        # loop has created the response with `create_response()`.
+
+    def pin_request(self):
+        """
+        Return the `(user, pin)` pair to verify if the request is a PIN
+        submission, or None for any other request, including a malformed
+        one (not a JSON object, or whose user or PIN is not a string).
+        """
+        if not self.binary and self.jsonheader["content-type"] != "text/json":
+            return None
+        if not isinstance(self.request, dict):
+            return None
+        if ( "user" in self.request.keys() ) and ( "pin" in self.request.keys() ):
+            user, pin = self.request.get("user"), self.request.get("pin")
+            if isinstance(user, str) and isinstance(pin, str):
+                return (user, pin)
+        return None
+
+    def _response_headers(self):
+        """
+        Return the extra JSON headers of the response: the request's ID
+        and whether the connection stays open, if the client sent them.
+        """
+        headers = {}
+        if self.request_id is not None:
+            headers["request-id"] = self.request_id
+        if "keep-alive" in self.jsonheader:
+            headers["keep-alive"] = self.keep_alive
+        return headers
 
-    def create_response(self, auth, ident, keys):
+    def create_response(self, auth, ident, keys, verified=None):
         """
         Create a response using the user's authentication, the
         identifier, and the user's keys. Encode this as binary, and
-        enqueue it for sending.
+        enqueue it for sending. If the PIN was already checked (e.g. by
+        `check_pins()` for a batch of messages), pass the result in
+        `verified` to skip checking it again. A request received in a
+        binary frame is answered with one.
         """
-        if self.jsonheader["content-type"] == "text/json":
-            response = self._create_response_json_content(auth, ident, keys)
+        self.requests_served += 1
+        if self.requests_served >= KEEPALIVE_MAX_REQUESTS:
+            self.keep_alive = False
+        if self.binary:
+            self._send_buffer.append(self._create_frame(
+                self._check_request(auth, ident, keys, verified)
+            ))
         else:
-            # Binary or unknown content-type
-            response = self._create_response_binary_content()
-        message = self._create_message(**response)
+            if self.jsonheader["content-type"] == "text/json":
+                response = self._create_response_json_content(
+                    auth, ident, keys, verified
+                )
+            else:
+                # Binary or unknown content-type
+                response = self._create_response_binary_content()
+            self._send_buffer.extend(self._create_message(
+                **response, headers=self._response_headers()
+            ))
         self.response_created = True
-        self._send_buffer += message
+        # Set selector to listen for write events, the response is ready.
+        self._set_selector_events_mask("w")
+        if self.keep_alive and self._recv_buffer:
+            # Start on the next pipelined request while this response
+            # waits to be sent, so that their responses can be sent
+            # together.
+            self._next_request()
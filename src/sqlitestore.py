@@ -0,0 +1,429 @@
+"""
+2D2FA SQLite Store
+
+A store of entries that expire, with the same interface as
+`expiry.TTLStore`, and a table of user keys, kept in an SQLite database
+file. Every process (and thread) that opens the same file sees the same
+entries, so the server's lists can be shared between the worker
+processes of a multi-process server (see `server.py --workers`) and
+survive a restart. Requires SQLite 3.35 or later, for `DELETE ...
+RETURNING`.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# how long to wait for another process's write lock, in seconds
+BUSY_TIMEOUT = 30
+
+# number of prepared statements each connection keeps
+CACHED_STATEMENTS = 64
+
+# most keys looked up by one statement in `get_many()` (older SQLite
+# versions allow 999 parameters in a statement)
+MAX_VARIABLES = 500
+
+# how often, in seconds, `SQLiteTTLStore.expire()` counts the entries
+# to enforce the store's capacity; counting is a scan of the table, too
+# slow to do on every server tick
+CAPACITY_CHECK_INTERVAL = 5
+
+# oldest SQLite library the stores work with: `pop()` and `expire()`
+# delete and return entries in one `DELETE ... RETURNING` statement
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+
+class _SQLiteTable:
+    """
+    Base class for a table in an SQLite database shared by several
+    threads and processes: each thread of each process opens its own
+    connection, in WAL mode so that readers don't block the writer.
+    """
+    def __init__(self, path, table):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name {table!r}.")
+        if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+            raise RuntimeError(
+                f"SQLite {sqlite3.sqlite_version} is too old, the SQLite "
+                f"store needs {'.'.join(map(str, MIN_SQLITE_VERSION))} or later."
+            )
+        self.path = path
+        self.table = table
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # connections can't be pickled (e.g. to send the keys to a
+        # process-pool worker); the new copy opens its own
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _db(self):
+        """
+        Return this thread's connection to the database, opening it if
+        needed (including after a fork, as connections must not be
+        shared between processes).
+        """
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            db = sqlite3.connect(
+                self.path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                check_same_thread=False, cached_statements=CACHED_STATEMENTS,
+            )
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            local.db = db
+            local.pid = os.getpid()
+        return local.db
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager grouping the writes this thread makes inside it
+        into one transaction, committed when it exits. Batches can be
+        nested; only the outermost one commits.
+        """
+        db = self._db()
+        if db.in_transaction:
+            yield
+            return
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+
+class SQLiteKeyTable(_SQLiteTable):
+    """
+    A dictionary-like table mapping users to their secret keys, with the
+    read interface of the dictionary returned by `serverutils.get_keys()`.
+    """
+    def __init__(self, path, table="keys"):
+        super().__init__(path, table)
+        self._db().execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "user TEXT PRIMARY KEY, key TEXT NOT NULL)"
+        )
+        self._get_sql = f"SELECT key FROM {table} WHERE user = ?"
+        self._set_sql = f"INSERT OR REPLACE INTO {table} (user, key) VALUES (?, ?)"
+
+    def __len__(self):
+        return self._db().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, user):
+        return self.get(user) is not None
+
+    def __getitem__(self, user):
+        key = self.get(user)
+        if key is None:
+            raise KeyError(user)
+        return key
+
+    def __setitem__(self, user, key):
+        self._db().execute(self._set_sql, (user, key))
+
+    def __delitem__(self, user):
+        if self.pop(user, None) is None:
+            raise KeyError(user)
+
+    def pop(self, user, *default):
+        row = self._db().execute(
+            f"DELETE FROM {self.table} WHERE user = ? RETURNING key", (user,)
+        ).fetchone()
+        if row is None:
+            if default:
+                return default[0]
+            raise KeyError(user)
+        return row[0]
+
+    def get(self, user, default=None):
+        row = self._db().execute(self._get_sql, (user,)).fetchone()
+        return default if row is None else row[0]
+
+    def keys(self):
+        return [row[0] for row in self._db().execute(f"SELECT user FROM {self.table}")]
+
+    def items(self):
+        return self._db().execute(f"SELECT user, key FROM {self.table}").fetchall()
+
+    def update(self, *args, **kwargs):
+        with self.batch():
+            self._db().executemany(
+                self._set_sql, dict(*args, **kwargs).items()
+            )
+
+    def replace(self, keys):
+        """
+        Replace the whole table with the users and keys of `keys`, in one
+        transaction, so that users no longer in `keys` are removed and
+        no reader sees the table half replaced.
+        """
+        with self.batch():
+            self._db().execute(f"DELETE FROM {self.table}")
+            self._db().executemany(self._set_sql, dict(keys).items())
+
+
+class SQLiteTTLStore(_SQLiteTable):
+    """
+    A dictionary-like store whose entries expire a fixed `timeout` after
+    the time stamp stored in their value, kept in the table `table` of
+    the SQLite database at `path`. Values are stored as JSON, with their
+    expiry time in an indexed column, so that expired entries can be
+    treated as missing when read and swept with `expire()` without
+    scanning the table.
+
+    Writes made inside `batch()` are committed together, in one
+    transaction.
+    """
+    def __init__(self, path, table, timeout, stamp=None, decode=None,
+                 capacity=None):
+        """
+        The SQLiteTTLStore class initializer initializes the following
+        attributes:
+
+        - path: The path of the SQLite database file.
+        - table: The name of the table holding the entries.
+        - timeout: How long, in seconds, an entry is good for.
+        - stamp: Function returning the time stamp (seconds since epoch)
+          stored in a value. By default the value itself is the time
+          stamp, as in the server's "authorized" list.
+        - decode: Function turning a value read back from JSON into the
+          value that was stored (e.g. a list back into a named tuple).
+        - capacity: The maximum number of entries, or None for no limit.
+          Entries over the limit are evicted, closest to expiring
+          first, by `expire()`, at most every CAPACITY_CHECK_INTERVAL
+          seconds.
+        - expired, evicted: Number of entries this process removed
+          because they expired, or to stay within `capacity`.
+        - _capacity_checked: When `expire()` last enforced the capacity
+          (monotonic clock).
+        """
+        super().__init__(path, table)
+        self.timeout = timeout
+        self.stamp = stamp if stamp is not None else (lambda value: value)
+        self.decode = decode if decode is not None else (lambda value: value)
+        self.capacity = capacity
+        self.expired = 0
+        self.evicted = 0
+        self._capacity_checked = None
+        db = self._db()
+        db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires INTEGER NOT NULL)"
+        )
+        db.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_expires "
+            f"ON {table} (expires)"
+        )
+        # statements used on every request, built once so that each
+        # connection's prepared statement cache is hit
+        self._get_sql = (
+            f"SELECT value FROM {table} WHERE key = ? AND expires >= ?"
+        )
+        self._set_sql = (
+            f"INSERT OR REPLACE INTO {table} (key, value, expires) "
+            "VALUES (?, ?, ?)"
+        )
+
+    def _encode(self, value):
+        return json.dumps(value)
+
+    def __len__(self):
+        row = self._db().execute(
+            f"SELECT COUNT(*) FROM {self.table} WHERE expires >= ?",
+            (int(time.time()),),
+        ).fetchone()
+        return row[0]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._db().execute(
+            self._set_sql,
+            (key, self._encode(value), self.stamp(value) + self.timeout),
+        )
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def get(self, key, default=None):
+        """
+        Return the value for `key`, or `default` if there is none or it
+        has expired.
+        """
+        row = self._db().execute(
+            self._get_sql, (key, int(time.time()))
+        ).fetchone()
+        if row is None:
+            return default
+        return self.decode(json.loads(row[0]))
+
+    def pop(self, key, *default):
+        row = self._db().execute(
+            f"DELETE FROM {self.table} WHERE key = ? RETURNING value",
+            (key,),
+        ).fetchone()
+        if row is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return self.decode(json.loads(row[0]))
+
+    def keys(self):
+        rows = self._db().execute(
+            f"SELECT key FROM {self.table} WHERE expires >= ?",
+            (int(time.time()),),
+        )
+        return [row[0] for row in rows]
+
+    def items(self):
+        rows = self._db().execute(
+            f"SELECT key, value FROM {self.table} WHERE expires >= ?",
+            (int(time.time()),),
+        )
+        return [(row[0], self.decode(json.loads(row[1]))) for row in rows]
+
+    def update(self, *args, **kwargs):
+        rows = [
+            (key, self._encode(value), self.stamp(value) + self.timeout)
+            for key, value in dict(*args, **kwargs).items()
+        ]
+        with self.batch():
+            self._db().executemany(self._set_sql, rows)
+
+    def clear(self):
+        self._db().execute(f"DELETE FROM {self.table}")
+
+    def expires(self, key):
+        """
+        Return the expiry time of the entry for `key`, or None.
+        """
+        row = self._db().execute(
+            f"SELECT expires FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def get_or_set(self, key, fresh, factory):
+        """
+        Atomically (across processes) get the value for `key`, or set it
+        to `factory()` if there is none or `fresh(value)` is false.
+        Return the value and whether it was newly set.
+        """
+        with self.batch():
+            value = self.get(key)
+            if value is not None and fresh(value):
+                return value, False
+            value = factory()
+            self[key] = value
+        return value, True
+
+    def get_many(self, keys):
+        """
+        Return a dict of the values of those of `keys` that have one,
+        read MAX_VARIABLES keys to a statement.
+        """
+        keys = list(dict.fromkeys(keys))
+        now = int(time.time())
+        db = self._db()
+        values = {}
+        for i in range(0, len(keys), MAX_VARIABLES):
+            chunk = keys[i:i + MAX_VARIABLES]
+            rows = db.execute(
+                f"SELECT key, value FROM {self.table} WHERE expires >= ? "
+                f"AND key IN ({', '.join('?' * len(chunk))})",
+                (now, *chunk),
+            )
+            for key, value in rows:
+                values[key] = self.decode(json.loads(value))
+        return values
+
+    def get_or_set_many(self, keys, fresh, factory):
+        """
+        As `get_or_set()` for each of `keys`, in one transaction. Return
+        a dict mapping each key to its value and whether it was newly
+        set.
+        """
+        results = {}
+        with self.batch():
+            current = self.get_many(keys)
+            new = {}
+            for key in dict.fromkeys(keys):
+                value = current.get(key)
+                if value is not None and fresh(value):
+                    results[key] = (value, False)
+                else:
+                    new[key] = value = factory()
+                    results[key] = (value, True)
+            if new:
+                self.update(new)
+        return results
+
+    def expire(self, now, limit=None):
+        """
+        Remove the entries whose expiry time is before `now`, at most
+        `limit` of them if given, then evict the entries closest to
+        expiring if the store is over its capacity (checked at most every
+        CAPACITY_CHECK_INTERVAL seconds). Return the list of keys removed
+        because they expired.
+        """
+        db = self._db()
+        rows = db.execute(
+            f"DELETE FROM {self.table} WHERE key IN ("
+            f"SELECT key FROM {self.table} WHERE expires < ? "
+            "ORDER BY expires LIMIT ?) RETURNING key",
+            (now, -1 if limit is None else limit),
+        ).fetchall()
+        expired = [row[0] for row in rows]
+        self.expired += len(expired)
+        clock = time.monotonic()
+        if self.capacity is not None and (
+                self._capacity_checked is None
+                or clock - self._capacity_checked >= CAPACITY_CHECK_INTERVAL):
+            self._capacity_checked = clock
+            count = db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            if count > self.capacity:
+                cur = db.execute(
+                    f"DELETE FROM {self.table} WHERE key IN ("
+                    f"SELECT key FROM {self.table} ORDER BY expires LIMIT ?)",
+                    (count - self.capacity,),
+                )
+                self.evicted += cur.rowcount
+        return expired
+
+    def stats(self):
+        """
+        Return a dict of the store's size and this process's
+        expiry/eviction counters.
+        """
+        return {
+            "size": len(self),
+            "capacity": self.capacity,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
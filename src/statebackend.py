@@ -0,0 +1,81 @@
+"""
+2D2FA State Backends
+
+Where the server keeps its three tables: the "keys" list (users' secret
+keys), the "authorized" list and the "identifier" list. A backend
+provides them as its `keys`, `auth` and `ident` attributes:
+
+- keys: read like a dictionary mapping each user to their key.
+- auth: an `expiry.TTLStore`-like store mapping each authorized user to
+  the time they were authorized.
+- ident: an `expiry.TTLStore`-like store mapping each user to their
+  current `serverutils.Identifier`.
+
+The stores support the dictionary operations, `get_or_set()`,
+`expires()`, `expire()`, `stats()` and `batch()` (see `expiry.TTLStore`).
+Backends are looked up by name in `BACKENDS`.
+"""
+
+import expiry
+import sqlitestore
+from serverutils import Identifier
+
+
+def _issued(entry):
+    return entry.issued
+
+
+class MemoryBackend:
+    """
+    The default backend: the tables live in this process's memory, the
+    keys in a dictionary and the lists in lock-striped TTL stores. They
+    are lost when the process exits and can't be shared with other
+    processes.
+    """
+    def __init__(self, keys, auth_timeout, ident_timeout, auth_capacity=None,
+                 ident_capacity=None, shards=16, path=None):
+        self.keys = keys
+        self.auth = expiry.ShardedTTLStore(
+            auth_timeout, capacity=auth_capacity, shards=shards
+        )
+        self.ident = expiry.ShardedTTLStore(
+            ident_timeout, stamp=_issued, capacity=ident_capacity,
+            shards=shards
+        )
+
+
+class SQLiteBackend:
+    """
+    The tables live in the SQLite database file at `path`, so that they
+    survive a restart and are shared by every process using the file
+    (e.g. the workers of `server.py --workers`). The given keys replace
+    the database's key table, so that users removed from the key file
+    since the last run can no longer log in.
+    """
+    def __init__(self, keys, auth_timeout, ident_timeout, auth_capacity=None,
+                 ident_capacity=None, shards=16, path="server_state.db"):
+        self.keys = sqlitestore.SQLiteKeyTable(path)
+        self.keys.replace(keys)
+        self.auth = sqlitestore.SQLiteTTLStore(
+            path, "auth", auth_timeout, capacity=auth_capacity
+        )
+        self.ident = sqlitestore.SQLiteTTLStore(
+            path, "ident", ident_timeout, stamp=_issued,
+            decode=lambda entry: Identifier(*entry), capacity=ident_capacity
+        )
+
+
+# backends by the name given to `server.py --backend`
+BACKENDS = {
+    "memory": MemoryBackend,
+    "sqlite": SQLiteBackend,
+}
+
+
+def make_backend(name, keys, auth_timeout, ident_timeout, **options):
+    """
+    Create the backend called `name` (see `BACKENDS`), holding `keys`.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Invalid state backend {name!r}.")
+    return BACKENDS[name](keys, auth_timeout, ident_timeout, **options)
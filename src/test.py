@@ -1,10 +1,29 @@
 """This file contains some simple test cases ensuring that the
 authentication methods implemented in our system work as desired.
 """
+import os
+import json
+import time
+import socket
+import asyncio
+import selectors
+import tempfile
+import threading
+import http.client
 import device
 import deviceutils
 import server
 import serverutils
+import expiry
+import sqlitestore
+import statebackend
+import keystore
+import protocol
+import aioserver
+import aiodevice
+import webserve
+import events
+import pages
 
 
 # displays results for a test function b
@@ -18,6 +37,29 @@ def result(b):
     print("")
     return f
 
+# runs a device KeepAliveMessage sending requests against a server
+# Message over a socket pair; returns both messages when done
+def keep_alive_exchange(requests, testkeys, binary=False):
+    ssock, csock = socket.socketpair()
+    ssock.setblocking(False)
+    csock.setblocking(False)
+    ssel = selectors.DefaultSelector()
+    csel = selectors.DefaultSelector()
+    smsg = serverutils.Message(ssel, ssock, "device")
+    ssel.register(ssock, selectors.EVENT_READ, data=smsg)
+    cmsg = deviceutils.KeepAliveMessage(csel, csock, "server", requests, binary)
+    csel.register(csock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=cmsg)
+    for _ in range(100):
+        for k, mask in csel.select(timeout=0):
+            cmsg.process_events(mask)
+        for k, mask in ssel.select(timeout=0):
+            smsg.process_events(mask, server.auth, server.ident, testkeys)
+            if smsg.request is not None and not smsg.response_created:
+                smsg.create_response(server.auth, server.ident, testkeys)
+        if cmsg.sock is None and smsg.sock is None:
+            break
+    return smsg, cmsg
+
 ####################
 # Test functions:
 ####################
@@ -124,7 +166,938 @@ def test_pin_bad_id():
     did = did + 1
     dpin = device.generate_pin(did)
     return not (serverutils.check_pin(user, dpin, server.ident, testkeys))
+
+# Test the keyed HMAC cache
+# a cached context must still be rebuilt when the user's key changes
+def test_hmac_cache_rekey():
+    user = "testuser"
+    cache = serverutils.HMACCache()
+    device.key = "test"
+    did = server.make_new_key(user)
+    dpin = device.generate_pin(did)
+    if not serverutils.check_pin(user, dpin, server.ident, {user: "test"}, cache):
+        return False
+    # same user, new key: the old context must not be reused
+    return not serverutils.check_pin(user, dpin, server.ident, {user: "other"}, cache)
+
+# Test that the HMAC cache stays within its size bound
+def test_hmac_cache_bound():
+    cache = serverutils.HMACCache(maxsize=2)
+    cache.get("a", "ka")
+    cache.get("b", "kb")
+    cache.get("a", "ka")    # "b" is now the least recently used
+    cache.get("c", "kc")
+    if len(cache) != 2:
+        return False
+    return "b" not in cache._contexts and "a" in cache._contexts
+
+# Test PIN checking against a precomputed PIN table
+# good PINs are found in the table, bad PINs and stale identifiers are not
+def test_pin_table():
+    user = "testuser"
+    key = "test"
+    testkeys = {user:key}
+    table = serverutils.PinTable()
+    did = server.make_new_key(user)
+    table.add(user, did, key)
+    device.key = key
+    dpin = device.generate_pin(did)
+    if table.lookup(user, did, key, dpin) is not True:
+        return False
+    if not serverutils.check_pin(user, dpin, server.ident, testkeys, pins=table):
+        return False
+    device.key = "different_key"
+    bpin = device.generate_pin(did)
+    if serverutils.check_pin(user, bpin, server.ident, testkeys, pins=table):
+        return False
+    # a newer identifier makes the table entry stale
+    server.make_new_key(user)
+    return table.lookup(user, server.ident[user][0], key, dpin) is None
+
+# Test that a PIN table entry added while the table rolls forward is
+# hashed for the new window, not left behind in the old one
+def test_pin_table_roll_race():
+    rolls = []
+
+    class RacingTable(serverutils.PinTable):
+        def _hash(self, *args):
+            if not rolls:
+                rolls.append(self.time_slice + 1)
+                self.roll(None, rolls[0])
+            return super()._hash(*args)
+
+    table = RacingTable()
+    table.add("testuser", 123456, "test")
+    identifier, key, pins, entry_slice = table._entries["testuser"]
+    window = list(range(rolls[0] - 2, rolls[0] + 3))
+    if entry_slice != rolls[0] or sorted(pins.values()) != window:
+        return False
+    # and is rolled with the rest of the table afterwards
+    if table.roll(None, rolls[0] + 1) != 1:
+        return False
+    # a roll can be spread over several calls
+    table.add("other", 654321, "test")
+    table.add("third", 111111, "test")
+    rolled = [table.roll(None, rolls[0] + 2, limit=2) for _ in range(3)]
+    return rolled == [2, 1, 0] and table._entries["third"][3] == rolls[0] + 2
+
+# Test batch PIN verification
+# results come back in request order and match check_pin
+def test_check_pins():
+    user = "testuser"
+    key = "test"
+    testkeys = {user:key}
+    device.key = key
+    did = server.make_new_key(user)
+    good = device.generate_pin(did)
+    device.key = "different_key"
+    bad = device.generate_pin(did)
+    requests = [(user, good), (user, bad), ("nobody", good), (user, good)]
+    results = serverutils.check_pins(requests, server.ident, testkeys)
+    return results == [True, False, False, True]
+
+# Test the verifier backends
+# a batch submitted to each backend comes back with its token and results
+def test_verifier():
+    user = "testuser"
+    key = "test"
+    testkeys = {user:key}
+    device.key = key
+    did = server.make_new_key(user)
+    requests = [(user, device.generate_pin(did)), (user, "bad")]
+    for mode in ("inline", "thread", "process"):
+        verifier = serverutils.Verifier(mode, testkeys, 1)
+        verifier.submit(requests, server.ident, testkeys, mode)
+        done = []
+        for _ in range(100):
+            done += verifier.completed()
+            if done:
+                break
+            time.sleep(0.05)
+        verifier.close()
+        if len(done) != 1:
+            return False
+        token, future = done[0]
+        if token != mode or future.result() != [True, False]:
+            return False
+    # a batch that can't be checked comes back failed, without raising
+    for mode in ("inline", "thread", "process"):
+        verifier = serverutils.Verifier(mode, testkeys, 1)
+        verifier.submit([(["a"], "x")], server.ident, testkeys, mode)
+        done = []
+        for _ in range(100):
+            done += verifier.completed()
+            if done:
+                break
+            time.sleep(0.05)
+        verifier.close()
+        if len(done) != 1 or done[0][1].exception() is None:
+            return False
+    return True
+
+# Test expiry of identifiers through the expiry heap
+# expired entries are removed, renewed and removed entries are left alone
+def test_expiry():
+    ident = expiry.TTLStore(120, stamp=lambda entry: entry.issued)
+    Identifier = serverutils.Identifier
+    ident.update({"old": Identifier(1, 1000), "renewed": Identifier(2, 1000),
+                  "new": Identifier(3, 1100)})
+    ident["renewed"] = Identifier(4, 1100)
+    ident.pop("new")
+    ident["new"] = Identifier(5, 1050)
+    if ident.expire(1121) != ["old"]:
+        return False
+    if sorted(ident.keys()) != ["new", "renewed"]:
+        return False
+    return ident.expire(1171) == ["new"] and ident.keys() == ["renewed"]
+
+# Test lazy expiry and the capacity bound of the TTL store
+def test_ttl_store():
+    now = int(time.time())
+    store = expiry.TTLStore(120, capacity=2)
+    store["stale"] = now - 200     # expired, but never swept
+    if "stale" in store or store.get("stale") is not None:
+        return False
+    store["a"] = now - 10
+    store["b"] = now
+    store["c"] = now               # full: evicts "a", closest to expiring
+    stats = store.stats()
+    if sorted(store.keys()) != ["b", "c"]:
+        return False
+    return stats["expired"] == 1 and stats["evicted"] == 1 and stats["size"] == 2
+
+# Test that entries found expired when read are still reported by the
+# next sweep, so that their "expired" event is published, unless they
+# were set again
+def test_lazy_expiry():
+    now = int(time.time())
+    store = expiry.TTLStore(120)
+    store["read"] = now - 200
+    store["renewed"] = now - 200
+    store.get("read")
+    store.get("renewed")
+    store["renewed"] = now
+    if store.expire(now) != ["read"] or store.expire(now) != []:
+        return False
+    user = "lapseduser"
+    server.auth[user] = now - server.AUTH_TIMEOUT - 10
+    with events.Subscription(server.auth_events, user) as subscription:
+        if server.auth.get(user) is not None:
+            return False
+        server.timeout_auth()
+        return subscription.get(timeout=1) == ("expired", None)
+
+# Test identifier issuance through the sharded store
+# an identifier is reused until it is within MIN_TIME of expiring
+def test_issue_identifier():
+    user = "testuser"
+    did = server.make_new_key(user)
+    if server.issue_identifier(user) != did:
+        return False
+    # make the identifier nearly expired
+    old = server.ident[user]
+    server.ident[user] = serverutils.Identifier(
+        old.identifier, old.issued - server.IDENT_TIMEOUT + server.MIN_TIME
+    )
+    nid = server.issue_identifier(user)
+    return server.ident[user].identifier == nid and server.ident[user].issued >= old.issued
+
+# Test that the SQLite store enforces its capacity when swept, but
+# counts its entries only every CAPACITY_CHECK_INTERVAL seconds
+def test_sqlite_capacity():
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as tmp:
+        store = sqlitestore.SQLiteTTLStore(
+            os.path.join(tmp, "state.db"), "auth", 120, capacity=2
+        )
+        store.update({"a": now - 10, "b": now, "c": now})
+        store.expire(now)
+        if store.evicted != 1 or "a" in store:
+            return False
+        store["d"] = now
+        store.expire(now)
+        if store.evicted != 1:
+            return False
+        store._capacity_checked -= sqlitestore.CAPACITY_CHECK_INTERVAL
+        store.expire(now)
+        return store.evicted == 2 and len(store) == 2
+
+# Test the SQLite store shared by worker processes
+# two stores on the same file (as in two workers) see the same entries
+def test_sqlite_store():
+    now = int(time.time())
+    Identifier = serverutils.Identifier
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "state.db")
+        stores = [
+            sqlitestore.SQLiteTTLStore(
+                path, "ident", 120, stamp=lambda entry: entry.issued,
+                decode=lambda entry: Identifier(*entry),
+            )
+            for _ in range(2)
+        ]
+        a, b = stores
+        entry, issued = a.get_or_set("user", lambda e: True, lambda: Identifier(7, now))
+        if not issued or b["user"] != Identifier(7, now):
+            return False
+        entry, issued = b.get_or_set("user", lambda e: True, lambda: Identifier(8, now))
+        if issued or entry.identifier != 7:
+            return False
+        b["old"] = Identifier(9, now - 200)
+        if "old" in a:
+            return False
+        return a.expire(now) == ["old"] and a.keys() == ["user"]
+
+# Test that restarting on an SQLite file with fewer keys removes the
+# users that were dropped from the key file
+def test_sqlite_key_revoke():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "state.db")
+        statebackend.make_backend("sqlite", {"a": "test", "b": "test"}, 120, 120, path=path)
+        backend = statebackend.make_backend("sqlite", {"a": "new"}, 120, 120, path=path)
+        return (backend.keys.get("a") == "new" and "b" not in backend.keys and
+                len(backend.keys) == 1)
+
+# Test the state backends
+# each backend holds the keys and lists, and batched writes are kept
+def test_backends():
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in statebackend.BACKENDS:
+            backend = statebackend.make_backend(
+                name, {"testuser": "test"}, 120, 120,
+                path=os.path.join(tmp, "state.db"),
+            )
+            if backend.keys.get("testuser") != "test" or "nobody" in backend.keys:
+                return False
+            device.key = "test"
+            did, issued = backend.ident.get_or_set(
+                "testuser", lambda e: True,
+                lambda: serverutils.Identifier(serverutils.generate_identifier(), int(time.time())),
+            )
+            pin = device.generate_pin(did.identifier)
+            if not serverutils.check_pin("testuser", pin, backend.ident, backend.keys):
+                return False
+            with backend.auth.batch():
+                backend.auth["a"] = int(time.time())
+                backend.auth["b"] = int(time.time())
+            if sorted(backend.auth.keys()) != ["a", "b"]:
+                return False
+    return True
+
+# Test the memory-mapped key store
+# every converted key is found, missing users are not
+def test_keystore():
+    keys = {f"user{i}": f"key{i}" for i in range(1000)}
+    keys["test_user"] = "test_key"
+    keys["n\u00e4me"] = "k\u00eby"
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, "keys.txt")
+        path = os.path.join(tmp, "keys.keys")
+        with open(json_path, "w") as f:
+            f.write(json.dumps(keys))
+        keystore.convert(json_path, path)
+        store = keystore.KeyStore(path)
+        try:
+            if len(store) != len(keys) or dict(store.items()) != keys:
+                return False
+            if any(store.get(user) != key for user, key in keys.items()):
+                return False
+            return store.get("nobody") is None and "nobody" not in store
+        finally:
+            store.close()
+
+# Test reloading the key file
+# changes are noticed and only the changed users are updated/invalidated,
+# in a dictionary (replaced whole) and in an SQLite key table (in place,
+# by one process only); a key store replaced by a reload is closed after
+# REQUEST_TIMEOUT
+def test_key_reload():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "keys.txt")
+        with open(path, "w") as f:
+            json.dump({"same": "k1", "rotated": "k2", "gone": "k3"}, f)
+        keys = serverutils.get_keys(path)
+        table = sqlitestore.SQLiteKeyTable(os.path.join(tmp, "state.db"))
+        table.replace(keys)
+        reloader = serverutils.KeyReloader(serverutils.KeyWatcher(path, interval=0), keys)
+        cache = serverutils.HMACCache()
+        for user, key in keys.items():
+            cache.get(user, key)
+        if reloader.check() is not None:
+            return False
+        with open(path, "w") as f:
+            json.dump({"same": "k1", "rotated": "k4", "added": "k5"}, f)
+        update = reloader.check()
+        if update is None or reloader.updates() != [update]:
+            return False
+        if update.changed != {"rotated": "k4", "added": "k5"} or update.removed != ["gone"]:
+            return False
+        new = serverutils.apply_key_changes(keys, update, cache)
+        expected = {"same": "k1", "rotated": "k4", "added": "k5"}
+        if new != expected or keys == expected:
+            return False
+        if serverutils.apply_key_changes(table, update, cache, write=False) is not table:
+            return False
+        if dict(table.items()) != keys:
+            return False
+        if serverutils.apply_key_changes(table, update, cache) is not table:
+            return False
+        if dict(table.items()) != expected or sorted(cache._contexts) != ["same"]:
+            return False
+        stores = []
+        for name, store_keys in (("old.keys", keys), ("new.keys", expected)):
+            keystore.write_keystore(os.path.join(tmp, name), store_keys)
+            stores.append(keystore.KeyStore(os.path.join(tmp, name)))
+        old_store, new_store = stores
+        old = server.keys, server.backend.keys, server.key_reloader, server.verifier
+        server.keys = server.backend.keys = old_store
+        server.verifier = serverutils.Verifier("inline")
+        server.key_reloader = serverutils.KeyReloader(None, old_store)
+        server.key_reloader._updates.append(update._replace(keys=new_store))
+        try:
+            server.reload_keys()
+            swapped = server.keys is new_store and not old_store._map.closed
+            replaced, store = server.retired_keys[0]
+            server.retired_keys[0] = (replaced - server.REQUEST_TIMEOUT, store)
+            server.reload_keys()
+        finally:
+            server.verifier.close()
+            server.keys, server.backend.keys, server.key_reloader, server.verifier = old
+            server.retired_keys.clear()
+            new_store.close()
+        return swapped and old_store._map.closed
+
+# Test a keep-alive connection
+# pipelined requests are answered in turn, matched by ID, and the
+# connection stays open until the device closes it
+def test_keep_alive():
+    user = "testuser"
+    key = "test"
+    testkeys = {user:key}
+    device.key = key
+    did = server.make_new_key(user)
+    requests = [deviceutils.create_request(user, "bad"),
+                deviceutils.create_request(user, device.generate_pin(did))]
+    smsg, cmsg = keep_alive_exchange(requests, testkeys)
+    results = {i: r["result"] for i, r in cmsg.responses.items()}
+    return (results == {0: "Authentication failed.",
+                        1: "Authorization granted."}
+            and smsg.requests_served == 2 and smsg.sock is None)
+
+# Test the binary framing
+# frames round trip, and PINs sent in binary frames get the same results
+def test_binary_framing():
+    user = "testuser"
+    key = "test"
+    testkeys = {user:key}
+    device.key = key
+    did = server.make_new_key(user)
+    good = device.generate_pin(did)
+    device.key = "different_key"
+    bad = device.generate_pin(did)
+    frame = protocol.pack_frame(protocol.KIND_PIN, protocol.pack_pin(user, good), 7)
+    kind, keep_alive, request_id, length = protocol.unpack_frame(frame)
+    body = frame[protocol.FRAME.size:]
+    if (kind, keep_alive, request_id, length) != (protocol.KIND_PIN, False, 7, len(body)):
+        return False
+    if protocol.unpack_pin(body) != (user, good):
+        return False
+    requests = [deviceutils.create_request(user, bad),
+                deviceutils.create_request(user, good)]
+    smsg, cmsg = keep_alive_exchange(requests, testkeys, binary=True)
+    results = {i: r["result"] for i, r in cmsg.responses.items()}
+    return (results == {0: "Authentication failed.",
+                        1: "Authorization granted."}
+            and smsg.requests_served == 2)
+
+# Test the receive buffer
+# data is consumed in order across compactions, and oversized input is
+# refused
+def test_recv_buffer():
+    buffer = protocol.RecvBuffer(size=8, limit=32)
+    buffer.feed(b"\x00\x03abc")
+    if buffer.unpack(protocol.PROTOHEADER) != (3,) or buffer.take(3) != b"abc":
+        return False
+    for i in range(10):
+        buffer.feed(b"0123456789")
+        with buffer.view(4) as view:
+            if bytes(view) != b"0123":
+                return False
+        buffer.consume(4)
+        if buffer.take(6) != b"456789" or len(buffer) != 0:
+            return False
+    try:
+        buffer.feed(bytes(33))
+        return False
+    except ValueError:
+        pass
+    message = serverutils.Message(None, None, None)
+    message._recv_buffer.feed(protocol.PROTOHEADER.pack(protocol.MAX_JSONHEADER_SIZE + 1))
+    try:
+        message._process_buffer()
+        return False
+    except ValueError:
+        return True
+
+# Test the send queue
+# queued parts arrive in order, however much each send takes
+def test_send_queue():
+    parts = [b"header", b"", b"{json}", bytes(range(256)) * 64]
+    queue = protocol.SendQueue()
+    queue.extend(parts)
+    if len(queue) != sum(map(len, parts)):
+        return False
+    ssock, csock = socket.socketpair()
+    ssock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    ssock.setblocking(False)
+    received = b""
+    while queue:
+        try:
+            queue.send_to(ssock)
+        except BlockingIOError:
+            pass
+        received += csock.recv(65536)
+    ssock.close()
+    while True:
+        data = csock.recv(65536)
+        if not data:
+            break
+        received += data
+    csock.close()
+    return received == b"".join(parts)
+    
+# Test the asyncio server engine
+# the identifier page is served over HTTP, and PINs sent to the device
+# port get the same results as with the selectors loop
+def test_async_engine():
+    user = "testuser"
+    key = "test"
+    testkeys = {user:key}
+    device.key = key
+
+    async def exchange():
+        engine, devices, http = await aioserver.start("127.0.0.1", 0, "127.0.0.1", 0)
+        port = devices.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection(*http.sockets[0].getsockname()[:2])
+        writer.write(f"GET /checkname?username={user} HTTP/1.1\r\n"
+                     "Connection: close\r\n\r\n".encode())
+        page = (await reader.read()).decode()
+        writer.close()
+        did = int(page.rsplit('">', 1)[1].split("<", 1)[0])
+        pins = [(user, device.generate_pin(did)), (user, "00" * 32)]
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(
+            None, deviceutils.send_messages, "127.0.0.1", port, pins, True
+        )
+        devices.close()
+        http.close()
+        engine.stop()
+        return page, results
+
+    old_keys, server.keys = server.keys, testkeys
+    server.verifier = serverutils.Verifier("thread", testkeys)
+    try:
+        page, results = asyncio.run(exchange())
+    finally:
+        server.verifier.close()
+        server.keys = old_keys
+    return (page.startswith("HTTP/1.1 200 OK") and
+            results == ["Authorization granted.", "Authentication failed."])
     
+# Test the asyncio device client
+# PINs sent concurrently over a pool of connections get their results,
+# and a server that can't be reached gives an error after the retries
+def test_async_client():
+    user = "testuser"
+    key = "test"
+    testkeys = {user:key}
+    device.key = key
+    closed = socket.socket()
+    closed.bind(("127.0.0.1", 0))
+    dead_port = closed.getsockname()[1]
+    closed.close()
+
+    async def exchange():
+        engine, devices, http = await aioserver.start("127.0.0.1", 0, "127.0.0.1", 0)
+        port = devices.sockets[0].getsockname()[1]
+        did = server.issue_identifier(user)
+        good = device.generate_pin(did)
+        pins = [(user, good), (user, "00" * 32)] * 150
+        async with aiodevice.Client(pool_size=2, binary=True, backoff=0.01) as client:
+            results = await client.send_pins("127.0.0.1", port, pins)
+            dead = await client.send_pin("127.0.0.1", dead_port, user, good)
+            pooled = len(client._pools[("127.0.0.1", port)].connections)
+        devices.close()
+        http.close()
+        engine.stop()
+        return results, dead, pooled
+
+    old_keys, server.keys = server.keys, testkeys
+    server.verifier = serverutils.Verifier("inline", testkeys)
+    try:
+        results, dead, pooled = asyncio.run(exchange())
+    finally:
+        server.verifier.close()
+        server.keys = old_keys
+    return ([r.granted for r in results] == [True, False] * 150 and
+            all(r.attempts == 1 for r in results) and pooled <= 2 and
+            dead.result is None and dead.error and
+            dead.attempts == aiodevice.RETRIES + 1)
+    
+# Test connection deadlines
+# a connection stuck partway through a request is closed after
+# REQUEST_TIMEOUT, while one that is still within it stays open
+def test_connection_deadlines():
+    sel = selectors.DefaultSelector()
+    pairs = [socket.socketpair() for _ in range(2)]
+    messages = []
+    for ssock, csock in pairs:
+        ssock.setblocking(False)
+        message = serverutils.Message(sel, ssock, "device")
+        sel.register(ssock, selectors.EVENT_READ, data=message)
+        # the first byte of the JSON header's length, and no more
+        csock.send(b"\x00")
+        message.read()
+        messages.append(message)
+    stuck, slow = messages
+    stuck.request_started -= server.REQUEST_TIMEOUT + 1
+    if slow.deadline(server.REQUEST_TIMEOUT, server.KEEPALIVE_TIMEOUT) != \
+            slow.request_started + server.REQUEST_TIMEOUT:
+        return False
+    old_deadlines, server.deadlines = server.deadlines, []
+    try:
+        for message in messages:
+            server.watch_deadline(message)
+        server.reap_connections()
+        remaining = len(server.deadlines)
+    finally:
+        server.deadlines = old_deadlines
+    for message in messages:
+        if message.sock is not None:
+            message.close()
+    for ssock, csock in pairs:
+        csock.close()
+    sel.close()
+    return stuck.sock is None and remaining == 1
+    
+# Test that closed connections don't pile up in the deadline heap
+# the heap is compacted once they outnumber open ones, and a closed
+# message has dropped its buffers
+def test_closed_deadlines():
+    sel = selectors.DefaultSelector()
+    old = server.deadlines
+    server.deadlines = []
+    pairs = []
+    try:
+        for _ in range(100):
+            ssock, csock = socket.socketpair()
+            pairs.append((ssock, csock))
+            message = serverutils.Message(sel, ssock, "device")
+            sel.register(ssock, selectors.EVENT_READ, data=message)
+            server.watch_deadline(message)
+            message.close()
+        remaining = len(server.deadlines)
+    finally:
+        server.deadlines = old
+        for ssock, csock in pairs:
+            csock.close()
+        sel.close()
+    return remaining < 100 and len(message._recv_buffer._buf) == 0
+    
+# Test the accept path
+# a burst of connections is accepted in one pass, and their requests,
+# sent along with connecting, are read and answered without waiting for
+# another pass
+def test_accept_batch():
+    user = "testuser"
+    key = "test"
+    device.key = key
+    did = server.make_new_key(user)
+    request = b"".join(deviceutils.Message(None, None, None, None)._pack_request(
+        deviceutils.create_request(user, device.generate_pin(did))
+    ))
+    old = server.sel, server.verifier, server.keys, server.deadlines
+    server.sel = selectors.DefaultSelector()
+    server.keys = {user:key}
+    server.deadlines = []
+    server.loop_stats.reset()
+    lsock = server.listen_socket("127.0.0.1", 0)
+    server.start_listening(lsock)
+    clients = []
+    for _ in range(3):
+        csock = socket.create_connection(lsock.getsockname())
+        csock.sendall(request)
+        clients.append(csock)
+    time.sleep(0.1)
+    try:
+        server.listen_pass(1)
+        stats = server.loop_stats.snapshot()
+        # the responses are sent on the next pass
+        server.listen_pass(1)
+        responses = [csock.recv(4096) for csock in clients]
+    finally:
+        for csock in clients:
+            csock.close()
+        server.sel.close()
+        server.verifier.close()
+        lsock.close()
+        server.sel, server.verifier, server.keys, server.deadlines = old
+    return (stats["accepted"] == 3 and stats["max_accepted"] == 3 and
+            stats["read_on_accept"] == 3 and len(server.loop_stats.latencies) == 3 and
+            all(b"Authorization granted." in r for r in responses))
+    
+# Test that malformed PIN requests are answered with an error, without
+# stopping the server loop: a good PIN sent afterwards still verifies
+def test_malformed_requests():
+    user = "testuser"
+    key = "test"
+    device.key = key
+    did = server.make_new_key(user)
+    packer = deviceutils.Message(None, None, None, None)
+
+    def pack(content):
+        return b"".join(packer._pack_request(
+            {"type": "text/json", "encoding": "utf-8", "content": content}
+        ))
+
+    old = server.sel, server.verifier, server.keys, server.deadlines
+    server.sel = selectors.DefaultSelector()
+    server.keys = {user:key}
+    server.deadlines = []
+    lsock = server.listen_socket("127.0.0.1", 0)
+    server.start_listening(lsock)
+    clients = []
+    responses = []
+    try:
+        for content in ([1, 2], {"user": ["a"], "pin": "x"},
+                        {"user": user, "pin": device.generate_pin(did)}):
+            csock = socket.create_connection(lsock.getsockname())
+            clients.append(csock)
+            csock.sendall(pack(content))
+            time.sleep(0.05)
+            server.listen_pass(1)
+            server.listen_pass(1)
+            responses.append(csock.recv(4096))
+    finally:
+        for csock in clients:
+            csock.close()
+        server.sel.close()
+        server.verifier.close()
+        lsock.close()
+        server.sel, server.verifier, server.keys, server.deadlines = old
+    bad_list, bad_user, good = responses
+    return (b"Error: invalid request." in bad_list and
+            b"Error: invalid request." in bad_user and
+            b"Authorization granted." in good)
+    
+# Test a device that shuts down its side of the connection after sending
+# its request: the request is still answered once its PIN is verified,
+# and the connection is then closed
+def test_half_close():
+    user = "testuser"
+    key = "test"
+    testkeys = {user:key}
+    device.key = key
+    did = server.make_new_key(user)
+    request = b"".join(deviceutils.Message(None, None, None, None)._pack_request(
+        deviceutils.create_request(user, device.generate_pin(did))
+    ))
+    ssock, csock = socket.socketpair()
+    ssock.setblocking(False)
+    sel = selectors.DefaultSelector()
+    smsg = serverutils.Message(sel, ssock, "device")
+    sel.register(ssock, selectors.EVENT_READ, data=smsg)
+    csock.sendall(request)
+    csock.shutdown(socket.SHUT_WR)
+    try:
+        for i in range(20):
+            for k, mask in sel.select(timeout=0):
+                smsg.process_events(mask, server.auth, server.ident, testkeys)
+            if smsg.request is not None and not smsg.response_created:
+                # the PIN is with the verifier for a few passes, during
+                # which the end of the request is read
+                smsg.verifying = i < 10
+                if not smsg.verifying:
+                    smsg.create_response(server.auth, server.ident, testkeys)
+            if smsg.sock is None:
+                break
+        csock.settimeout(1)
+        response = csock.recv(4096)
+    finally:
+        if smsg.sock is not None:
+            smsg.close()
+        csock.close()
+        sel.close()
+    return (smsg.peer_closed and smsg.sock is None and
+            b"Authorization granted." in response)
+    
+# Test the issue_identifier and auth_status requests
+# they give the same identifier as server.issue_identifier, and the
+# user's authorization before and after a good PIN
+def test_action_requests():
+    user = "actionuser"
+    key = "test"
+    testkeys = {user:key}
+    device.key = key
+    server.auth.pop(user, None)
+    old_keys, server.keys = server.keys, testkeys
+    try:
+        did = server.issue_identifier(user)
+        requests = [deviceutils.create_action_request("issue_identifier", user),
+                    deviceutils.create_action_request("auth_status", user),
+                    deviceutils.create_request(user, device.generate_pin(did)),
+                    deviceutils.create_action_request("auth_status", user),
+                    deviceutils.create_action_request("auth_status", "nobody")]
+        smsg, cmsg = keep_alive_exchange(requests, testkeys)
+    finally:
+        server.keys = old_keys
+    issued, before, pin, after, unknown = [cmsg.responses.get(i) for i in range(5)]
+    return (issued["identifier"] == did and
+            issued["expires"] == server.ident[user].issued + server.IDENT_TIMEOUT and
+            before["authorized"] is False and
+            pin["result"] == "Authorization granted." and
+            after["authorized"] is True and after["expires"] > time.time() and
+            unknown["result"].startswith("Error"))
+    
+
+# Test that the pooled WSGI server answers requests for the identifier
+# page, one after another and at the same time
+def test_pooled_http():
+    httpd = webserve.PooledWSGIServer("127.0.0.1", 0, server.app, threads=2)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    pages = []
+
+    def get(target):
+        conn = http.client.HTTPConnection("127.0.0.1", httpd.port, timeout=5)
+        conn.request("GET", target)
+        response = conn.getresponse()
+        pages.append((response.status, response.read().decode('utf-8')))
+        conn.close()
+
+    try:
+        get("/index")
+        # a connection that sends nothing holds one thread of the pool
+        # while the other answers
+        idle = socket.create_connection(("127.0.0.1", httpd.port))
+        clients = [threading.Thread(target=get, args=("/checkname?username=nobody",))
+                   for _ in range(3)]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        idle.close()
+    finally:
+        httpd.shutdown()
+        thread.join()
+        httpd.server_close()
+    return (len(pages) == 4 and all(status == 200 for status, page in pages) and
+            "username" in pages[0][1] and
+            all("nobody" in page for status, page in pages[1:]))
+    
+
+# Test that a user's event stream is told when a PIN authorizes them and
+# when the authorization expires
+def test_auth_events():
+    user = "eventuser"
+    key = "test"
+    testkeys = {user:key}
+    device.key = key
+    server.auth.pop(user, None)
+    old_keys, server.keys = server.keys, testkeys
+    try:
+        stream = server.auth_stream(user)
+        first = next(stream)
+        did = server.issue_identifier(user)
+        keep_alive_exchange([deviceutils.create_request(user, device.generate_pin(did))],
+                            testkeys)
+        authorized = next(stream)
+        server.auth.pop(user)
+        server.auth_events.publish(user, "expired")
+        expired = next(stream)
+        stream.close()
+        missing = server.app.test_client().get("/events?username=<b>nobody</b>")
+    finally:
+        server.keys = old_keys
+    return (first.startswith(b"retry: ") and b"event: status" in first and
+            b'"authorized": false' in first and
+            authorized.startswith(b"event: authorized") and
+            b'"authorized": true' in authorized and
+            expired.startswith(b"event: expired") and
+            b'"authorized": false' in expired and
+            len(server.auth_events) == 0 and missing.status_code == 404 and
+            missing.mimetype == "text/plain")
+    
+
+# Test the bulk auth status and identifier requests, with each backend
+# identifiers are reused as `issue_identifier()` would, unknown users
+# and bad requests are reported
+def test_bulk_requests():
+    old = server.keys, server.auth, server.ident
+    client = server.app.test_client()
+    ok = True
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in statebackend.BACKENDS:
+                backend = statebackend.make_backend(
+                    name, {"a": "test", "b": "test"}, server.AUTH_TIMEOUT,
+                    server.IDENT_TIMEOUT, path=os.path.join(tmp, "state.db"),
+                )
+                server.keys, server.auth, server.ident = backend.keys, backend.auth, backend.ident
+                did = server.issue_identifier("a")
+                server.auth["b"] = int(time.time())
+                issued = client.post("/issue_identifier", json=["a", "b", "nobody"]).get_json()
+                again = client.post("/issue_identifier", json={"users": ["b"]}).get_json()
+                status = client.get("/auth_status?username=a&username=b").get_json()
+                ok = ok and (issued["users"]["a"]["identifier"] == did and
+                             issued["users"]["a"]["new"] is False and
+                             issued["users"]["b"]["new"] is True and
+                             issued["users"]["nobody"] is None and
+                             again["users"]["b"]["identifier"] == server.issue_identifier("b") and
+                             again["users"]["b"]["new"] is False and
+                             status["users"]["a"] == {"authorized": False} and
+                             status["users"]["b"]["authorized"] is True and
+                             0 < status["users"]["b"]["ttl"] <= server.AUTH_TIMEOUT)
+        bad = client.post("/auth_status", data="[1, 2]").status_code
+        # issuing identifiers changes state, so a GET (e.g. a prefetch)
+        # doesn't
+        issues = len(server.ident)
+        get_issue = client.get("/issue_identifier?username=a").status_code
+        async_get = aioserver.bulk_reply("GET", "/issue_identifier?username=a", b"")[0]
+        issues = len(server.ident) - issues
+        too_many = server.bulk_reply("/auth_status", ["a"] * (server.MAX_BULK_USERS + 1))[0]
+    finally:
+        server.keys, server.auth, server.ident = old
+    return (ok and bad == 400 and too_many == 413 and get_issue == 405 and
+            async_get.startswith("405") and issues == 0)
+    
+
+# Test the HTML pages
+# values are escaped, and the host menu is only rendered again when the
+# keylist changes
+def test_pages():
+    page = pages.checkname_page('<b>"x"</b>', True, True, 42)
+    keys = [{"hostname": "Local", "user": "<u>"}]
+    menu = pages.HostMenu()
+    first = menu.render(keys)
+    same = menu.render(keys) is first and menu.renders == 1
+    keys.append({"hostname": "Other", "user": "b"})
+    grown = "Other" in menu.render(keys) and menu.renders == 2
+    menu.invalidate()
+    menu.render(keys)
+    return ('<b>' not in page and "&lt;b&gt;&quot;x&quot;" in page and
+            "is authorized" in page and "000042" in page and
+            "&lt;u&gt;" in first and same and grown and menu.renders == 3 and
+            'value="1&quot;&gt;"' in pages.enter_id_page('1">'))
+    
+# Test that concurrent device sessions each send their PIN to the host
+# they selected, made with that host's key
+def test_device_sessions():
+    sent = []
+    old_keys, old_send = device.keys, deviceutils.send_message
+    device.keys = [
+        {"hostname": "A", "address": "a", "port": 1, "user": "ua", "key": "ka"},
+        {"hostname": "B", "address": "b", "port": 2, "user": "ub", "key": "kb"},
+    ]
+    deviceutils.send_message = lambda host, port, user, pin, binary: \
+        sent.append((host, port, user, pin))
+    start = threading.Barrier(8)
+    codes = []
+
+    def session(n):
+        client = device.app.test_client()
+        start.wait()
+        for _ in range(20):
+            reply = client.post("/do_auth", data={
+                "ident": str(n), "hostindex": str(n % 2), "submit": "submit"})
+            codes.append(reply.status_code)
+
+    # the PINs each session may send, in the time slice it starts or ends in
+    pins = {}
+
+    def expect():
+        for n in range(8):
+            pins[device.generate_pin(n, "ka" if n % 2 == 0 else "kb")] = n
+
+    try:
+        expect()
+        threads = [threading.Thread(target=session, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        expect()
+        bad = device.app.test_client().post(
+            "/enter_id", data={"hostindex": "5", "submit": "submit"})
+    finally:
+        device.keys, deviceutils.send_message = old_keys, old_send
+    return (len(sent) == 160 and codes == [200] * 160 and
+            bad.status_code == 400 and
+            all(pin in pins and (host, port, user) ==
+                (("a", 1, "ua") if pins[pin] % 2 == 0 else ("b", 2, "ub"))
+                for host, port, user, pin in sent))
+    
+
 
 ####################
 # Run tests:
@@ -132,31 +1105,130 @@ def test_pin_bad_id():
 fc = 0
 
 print("Testing identifier generation:")
-fc + result(test_id_gen())
+fc += result(test_id_gen())
 
 print("Testing serverutils.get_identifier on empty identifier list")
-fc + result(test_empty_id())
+fc += result(test_empty_id())
 
 print("Testing the storage and retrieval of an identifier in server.ident")
-fc + result(test_id_store())
+fc += result(test_id_store())
 
 print("Testing serverutils.get_keys on empty key list")
-fc + result(test_empty_getkeys())
+fc += result(test_empty_getkeys())
 
 print("Testing retrieval of a user key from server.keys with serverutils.get_keys")
-fc + result(test_getkeys())
+fc += result(test_getkeys())
 
 print("Testing PIN generation on device and validation on server")
-fc + result(test_pin())
+fc += result(test_pin())
 
 print("Testing that bad PINs are not authenticated")
-fc + result(test_bad_pin())
+fc += result(test_bad_pin())
 
 print("Test that a PIN for a user with no/expired identifier is declined")
-fc + result(test_pin_no_id())
+fc += result(test_pin_no_id())
 
 print("Testing that a PIN generated with an incorrect identifier is declined")
-fc + result(test_pin_bad_id())
+fc += result(test_pin_bad_id())
+
+print("Testing that a cached HMAC context is rebuilt when the key changes")
+fc += result(test_hmac_cache_rekey())
+
+print("Testing that the HMAC cache evicts the least recently used context")
+fc += result(test_hmac_cache_bound())
+
+print("Testing PIN checks against a precomputed PIN table")
+fc += result(test_pin_table())
+
+print("Testing PIN table entries added while the table rolls forward")
+fc += result(test_pin_table_roll_race())
+
+print("Testing batch PIN verification with serverutils.check_pins")
+fc += result(test_check_pins())
+
+print("Testing the inline, thread and process verifier backends")
+fc += result(test_verifier())
+
+print("Testing that identifiers are timed out through the expiry heap")
+fc += result(test_expiry())
+
+print("Testing lazy expiry and eviction in the TTL store")
+fc += result(test_ttl_store())
+
+print("Testing that entries expired when read are reported by the next sweep")
+fc += result(test_lazy_expiry())
+
+print("Testing atomic identifier issuance with server.issue_identifier")
+fc += result(test_issue_identifier())
+
+print("Testing the SQLite store shared between worker processes")
+fc += result(test_sqlite_store())
+
+print("Testing the capacity bound of the SQLite store")
+fc += result(test_sqlite_capacity())
+
+print("Testing the memory and SQLite state backends")
+fc += result(test_backends())
+
+print("Testing that keys removed from the key file are removed from the SQLite backend")
+fc += result(test_sqlite_key_revoke())
+
+print("Testing lookups in the memory-mapped key store")
+fc += result(test_keystore())
+
+print("Testing that key file changes are applied incrementally")
+fc += result(test_key_reload())
+
+print("Testing pipelined requests over a keep-alive connection")
+fc += result(test_keep_alive())
+
+print("Testing the binary framing of PINs and results")
+fc += result(test_binary_framing())
+
+print("Testing the receive buffer and its size limits")
+fc += result(test_recv_buffer())
+
+print("Testing the send queue")
+fc += result(test_send_queue())
+
+print("Testing the asyncio server engine")
+fc += result(test_async_engine())
+
+print("Testing the asyncio device client")
+fc += result(test_async_client())
+
+print("Testing that connections stuck partway through a request are closed")
+fc += result(test_connection_deadlines())
+
+print("Testing that closed connections are dropped from the deadline heap")
+fc += result(test_closed_deadlines())
+
+print("Testing that a burst of connections is accepted and read in one pass")
+fc += result(test_accept_batch())
+
+print("Testing that malformed PIN requests don't stop the server loop")
+fc += result(test_malformed_requests())
+
+print("Testing that a half-closed connection still gets its response")
+fc += result(test_half_close())
+
+print("Testing the issue_identifier and auth_status requests")
+fc += result(test_action_requests())
+
+print("Testing the pooled WSGI server for the identifier page")
+fc += result(test_pooled_http())
+
+print("Testing the server-sent events of a user's authorization")
+fc += result(test_auth_events())
+
+print("Testing the bulk auth status and identifier requests")
+fc += result(test_bulk_requests())
+
+print("Testing the HTML pages")
+fc += result(test_pages())
+
+print("Testing concurrent device sessions")
+fc += result(test_device_sessions())
 
 print("Tests complete")
 print(fc, "tests failed")
\ No newline at end of file
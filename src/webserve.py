@@ -0,0 +1,287 @@
+"""
+2D2FA Web Serving
+
+Serve the Flask apps of the server and the device (their HTML front
+ends) with a production WSGI server instead of Flask's development
+server:
+
+- "waitress": waitress's multi-threaded server, if it is installed.
+- "gunicorn": gunicorn's threaded workers, several worker processes each
+  with a pool of threads, if it is installed (not on Windows).
+- "werkzeug": Werkzeug's server (installed with Flask) with a bounded
+  pool of threads, in several pre-forked worker processes sharing the
+  listening socket if asked for (not on Windows).
+- "flask": Flask's development server, as `app.run()`.
+
+"auto" picks gunicorn for several workers and waitress for one, if they
+are installed, and werkzeug otherwise. Requests aren't logged one by one
+unless the access log is turned on (see `ACCESS_LOG`), and log records
+are passed through a queue to a background thread (see
+`setup_logging()`), so that a request only has to enqueue its log
+record, not write it out.
+"""
+
+import os
+import sys
+import queue
+import signal
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+
+SERVERS = ("auto", "waitress", "gunicorn", "werkzeug", "flask")
+
+# worker processes, and threads handling requests in each
+WORKERS = 1
+THREADS = 16
+
+# most connections waiting in the listening socket's queue to be accepted
+BACKLOG = 1024
+
+# seconds a connection may sit idle, waiting for a (keep-alive) request,
+# before it is closed and, with werkzeug, gives its thread back to the pool
+IDLE_TIMEOUT = 5
+
+LOG_FORMAT = "%(asctime)s %(process)d %(name)s %(levelname)s %(message)s"
+
+# whether to log a line for each request (with werkzeug, gunicorn and
+# flask; waitress doesn't keep an access log). Off by default, so that a
+# request isn't logged, or even formatted for the log, at all
+ACCESS_LOG = False
+
+# the `QueueListener` writing out this process's log records, see
+# `setup_logging()`
+_listener = None
+
+
+def setup_logging(level=logging.INFO, access_log=None):
+    """
+    Send the log records of this process through a queue to a thread
+    that writes them to stderr, so that logging doesn't hold up a
+    response. Call again in a forked worker process, which doesn't
+    inherit the thread. If `access_log` is given, it turns the access
+    log (`ACCESS_LOG`) on or off.
+    """
+    global _listener, ACCESS_LOG
+    if access_log is not None:
+        ACCESS_LOG = access_log
+    if _listener is not None:
+        try:
+            _listener.stop()
+        except RuntimeError:
+            # forked from a process whose listener thread isn't ours
+            pass
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _listener = QueueListener(records, handler)
+    _listener.start()
+    root = logging.getLogger()
+    for old in [h for h in root.handlers if isinstance(h, QueueHandler)]:
+        root.removeHandler(old)
+    root.addHandler(QueueHandler(records))
+    root.setLevel(level)
+    # Flask's development server logs each request to this logger
+    logging.getLogger("werkzeug").setLevel(
+        logging.NOTSET if ACCESS_LOG else logging.WARNING
+    )
+    return _listener
+
+
+def choose(server="auto", workers=WORKERS):
+    """
+    Return the name of the server to use for `server`, resolving "auto"
+    to the best one installed.
+    """
+    if server != "auto":
+        return server
+    if workers > 1 and BaseApplication is not None:
+        return "gunicorn"
+    if workers <= 1 and waitress is not None:
+        return "waitress"
+    return "werkzeug"
+
+
+def serve(app, host, port, workers=WORKERS, threads=THREADS, server="auto"):
+    """
+    Serve the WSGI `app` on `host` and `port` until interrupted, with
+    `workers` processes of `threads` threads each. Must be called from
+    the main thread; with several workers, the app must keep any state
+    shared between requests somewhere all the workers see it.
+    """
+    server = choose(server, workers)
+    if server not in SERVERS:
+        raise ValueError(f"Unknown server {server!r}.")
+    logging.getLogger(__name__).info(
+        "Serving on http://%s:%s with %s, %d workers x %d threads",
+        host, port, server, workers, threads,
+    )
+    if server == "waitress":
+        if waitress is None:
+            raise RuntimeError("waitress is not installed.")
+        if workers > 1:
+            raise ValueError("waitress runs a single worker process.")
+        waitress.serve(app, host=host, port=port, threads=threads,
+                       backlog=BACKLOG, channel_timeout=IDLE_TIMEOUT)
+    elif server == "gunicorn":
+        if BaseApplication is None:
+            raise RuntimeError("gunicorn is not installed.")
+        _GunicornApplication(app, {
+            "bind": f"{host}:{port}",
+            "workers": workers,
+            "threads": threads,
+            "worker_class": "gthread",
+            "backlog": BACKLOG,
+            "keepalive": IDLE_TIMEOUT,
+            "accesslog": "-" if ACCESS_LOG else None,
+            "post_fork": lambda arbiter, worker: setup_logging(),
+        }).run()
+    elif server == "werkzeug":
+        _serve_werkzeug(app, host, port, workers, threads)
+    else:
+        app.run(host=host, port=port, threaded=True)
+
+
+class _RequestHandler(WSGIRequestHandler):
+    # close connections that don't send their request, so that they don't
+    # keep hold of a thread of the pool. (Werkzeug closes every connection
+    # after its response, there are no keep-alive connections to wait on.)
+    timeout = IDLE_TIMEOUT
+
+    def log_request(self, code="-", size="-"):
+        if ACCESS_LOG:
+            super().log_request(code, size)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug's WSGI server, handling each connection on a bounded pool
+    of threads rather than a new thread per connection. As with
+    Werkzeug's threaded server, the threads are daemon threads, so that
+    a long response (e.g. an event stream) doesn't hold up exiting.
+    """
+    multithread = True
+    request_queue_size = BACKLOG
+
+    def __init__(self, host, port, app, threads=THREADS):
+        """
+        The PooledWSGIServer class initializer initializes the following
+        attributes:
+
+        - threads: The number of threads handling connections.
+        - _connections: Accepted connections waiting for a thread.
+        - _workers: The threads, started by `serve_forever()`.
+        """
+        super().__init__(host, port, app, handler=_RequestHandler)
+        self.threads = threads
+        self._connections = queue.SimpleQueue()
+        self._workers = []
+
+    def serve_forever(self, poll_interval=0.5):
+        # the threads are started here rather than in __init__, so that
+        # each worker process forked by `_serve_werkzeug()` has its own
+        if not self._workers:
+            for _ in range(self.threads):
+                worker = threading.Thread(target=self._work, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+        super().serve_forever(poll_interval)
+
+    def process_request(self, request, client_address):
+        self._connections.put((request, client_address))
+
+    def _work(self):
+        while True:
+            connection = self._connections.get()
+            if connection is None:
+                return
+            request, client_address = connection
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            self._connections.put(None)
+        self._workers = []
+
+
+def _serve_werkzeug(app, host, port, workers, threads):
+    """
+    Serve with a `PooledWSGIServer`, forked into `workers` processes
+    that all accept connections from its listening socket.
+    """
+    server = PooledWSGIServer(host, port, app, threads)
+    if workers <= 1:
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+        return
+    # another worker may accept a connection first; don't wait for it
+    server.socket.setblocking(False)
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+                setup_logging(logging.getLogger().level)
+                server.serve_forever()
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            except Exception:
+                logging.getLogger(__name__).exception("Worker failed")
+                status = 1
+            finally:
+                os._exit(status)
+        children.append(pid)
+    server.socket.close()
+    # stop the workers too when this process is told to stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+if BaseApplication is not None:
+    class _GunicornApplication(BaseApplication):
+        """
+        Runs a WSGI app under gunicorn with the given settings, instead
+        of from gunicorn's command line.
+        """
+        def __init__(self, app, options):
+            self.application = app
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for name, value in self.options.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return self.application